@@ -0,0 +1,34 @@
+"""drop unique constraint on user_profiles.user_logo_url
+
+Логотипы переносятся в облако под ключами по хэшу содержимого, поэтому
+у двух профилей с одинаковой картинкой будет один и тот же URL.
+
+Revision ID: b7d1e4a9c2f3
+Revises: 43fa88c095e2
+Create Date: 2025-04-14 12:20:41.118204
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d1e4a9c2f3'
+down_revision = '43fa88c095e2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_constraint(
+        'user_profiles_user_logo_url_key',
+        'user_profiles',
+        type_='unique'
+    )
+
+
+def downgrade():
+    op.create_unique_constraint(
+        'user_profiles_user_logo_url_key',
+        'user_profiles',
+        ['user_logo_url']
+    )
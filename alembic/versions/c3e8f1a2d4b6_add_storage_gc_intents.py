@@ -0,0 +1,42 @@
+"""add storage_gc_intents table
+
+Очередь отложенного удаления папок видео из облака: сохранение профиля только
+записывает намерение, удаление выполняет сборщик по расписанию.
+
+Revision ID: c3e8f1a2d4b6
+Revises: b7d1e4a9c2f3
+Create Date: 2025-04-16 10:02:13.540219
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3e8f1a2d4b6'
+down_revision = 'b7d1e4a9c2f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'storage_gc_intents',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('prefix', sa.String(length=512), nullable=False, unique=True),
+        sa.Column('source_url', sa.String(length=512), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('last_error', sa.String(length=1000), nullable=True),
+        sa.Column('next_attempt_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=False),
+    )
+    op.create_index(
+        'ix_storage_gc_intents_next_attempt_at',
+        'storage_gc_intents',
+        ['next_attempt_at']
+    )
+
+
+def downgrade():
+    op.drop_index('ix_storage_gc_intents_next_attempt_at', table_name='storage_gc_intents')
+    op.drop_table('storage_gc_intents')
@@ -0,0 +1,31 @@
+"""add lower(name) index on user_profiles
+
+Поиск профилей по имени идет по lower(name) = lower(:name) - без индекса по выражению
+это полный проход по таблице.
+
+Revision ID: d4f9b2c7e1a5
+Revises: c3e8f1a2d4b6
+Create Date: 2025-04-22 12:40:51.204117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4f9b2c7e1a5'
+down_revision = 'c3e8f1a2d4b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_user_profiles_name_lower',
+        'user_profiles',
+        [sa.text('lower(name)')]
+    )
+
+
+def downgrade():
+    op.drop_index('ix_user_profiles_name_lower', table_name='user_profiles')
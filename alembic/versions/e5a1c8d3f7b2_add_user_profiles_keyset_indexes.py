@@ -0,0 +1,55 @@
+"""add keyset pagination indexes on user_profiles
+
+Список по городу листается курсором: city = :city AND (ключ, id) < (:ключ, :id) ORDER BY ключ DESC, id DESC.
+Без составного индекса (city, ключ, id) Postgres сортирует все профили города на каждой странице.
+Индексы частичные - в выдачу по городу попадают только видимые профили.
+Очередь модерации идет по id среди профилей с is_moderated = false.
+
+Revision ID: e5a1c8d3f7b2
+Revises: d4f9b2c7e1a5
+Create Date: 2025-04-24 10:15:37.482913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a1c8d3f7b2'
+down_revision = 'd4f9b2c7e1a5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_user_profiles_city_id',
+        'user_profiles',
+        ['city', sa.text('id DESC')],
+        postgresql_where=sa.text('is_incognito = false')
+    )
+    op.create_index(
+        'ix_user_profiles_city_created_at',
+        'user_profiles',
+        ['city', sa.text('created_at DESC'), sa.text('id DESC')],
+        postgresql_where=sa.text('is_incognito = false')
+    )
+    op.create_index(
+        'ix_user_profiles_city_popularity',
+        'user_profiles',
+        ['city', sa.text('coalesce(followers_count, 0) DESC'), sa.text('id DESC')],
+        postgresql_where=sa.text('is_incognito = false')
+    )
+    op.create_index(
+        'ix_user_profiles_unmoderated_id',
+        'user_profiles',
+        ['id'],
+        postgresql_where=sa.text('is_moderated = false')
+    )
+
+
+def downgrade():
+    op.drop_index('ix_user_profiles_unmoderated_id', table_name='user_profiles')
+    op.drop_index('ix_user_profiles_city_popularity', table_name='user_profiles')
+    op.drop_index('ix_user_profiles_city_created_at', table_name='user_profiles')
+    op.drop_index('ix_user_profiles_city_id', table_name='user_profiles')
@@ -0,0 +1,159 @@
+""" Замер кодеков кэша профилей: размер значений, время кодирования/декодирования и память Redis.
+    Генерирует профили той же формы, что build_profile_cache_data, и сравнивает прежнюю схему
+    (JSON профиля + JSON-копия профилей в странице) с текущей (cache_codec + страницы из ID).
+    Запуск: python bench_cache_codec.py --profiles 5000 [--redis-host localhost] """
+
+import json
+import time
+import random
+import string
+import asyncio
+import argparse
+from datetime import datetime, timedelta
+
+import redis.asyncio as redis
+
+from cache_codec import (
+    encode_value,
+    decode_value,
+    FORMAT_MSGPACK_ZSTD,
+    FORMAT_MSGPACK_LZ4,
+    FORMAT_MSGPACK_ZLIB,
+    zstandard,
+    lz4_frame,
+)
+
+PAGE_SIZE = 50  # Как в cashe.py
+BENCH_KEY_PREFIX = "bench:codec:"
+
+
+def random_text(length: int) -> str:
+    return "".join(random.choices(string.ascii_letters + " ", k=length))
+
+
+def make_profile(profile_id: int) -> dict:
+    """ Профиль в форме build_profile_cache_data """
+    base_url = f"https://bucket.s3.eu-central-1.amazonaws.com/user_{profile_id}/{random_text(8)}"
+    return {
+        "id": profile_id,
+        "name": random_text(12),
+        "user_logo_url": f"{base_url}/logo.png",
+        "video_url": f"{base_url}/video.mp4",
+        "preview_url": f"{base_url}/hls/playlist.m3u8",
+        "poster_url": f"{base_url}/poster.jpg",
+        "activity_and_hobbies": random_text(random.randint(40, 400)),
+        "is_moderated": random.random() < 0.8,
+        "is_incognito": random.random() < 0.1,
+        "is_in_mlm": random.randint(0, 3),
+        "adress": [random_text(30)],
+        "city": random_text(10),
+        "coordinates": {"longitude": random.uniform(-180, 180), "latitude": random.uniform(-90, 90)},
+        "followers_count": random.randint(0, 5000),
+        "created_at": (datetime.now() - timedelta(days=random.randint(0, 900))).isoformat(),
+        "hashtags": [random_text(8).strip().lower() for _ in range(random.randint(0, 6))],
+        "website_or_social": f"https://t.me/{random_text(10).replace(' ', '')}",
+        "is_admin": False,
+        "language": random.choice(["ru", "en", "es"]),
+        "user_link": random_text(10).replace(" ", ""),
+        "user": {"id": profile_id, "wallet_number": "0x" + "".join(random.choices("0123456789abcdef", k=40))},
+    }
+
+
+def json_encode(value) -> bytes:
+    return json.dumps(value, default=str).encode()
+
+
+def json_decode(raw: bytes):
+    return json.loads(raw)
+
+
+def codec_variants() -> dict:
+    """ Варианты кодирования: имя -> (encode, decode) """
+    variants = {
+        "json": (json_encode, json_decode),
+        "msgpack": (lambda value: encode_value(value, compression=None), decode_value),
+        "msgpack+zlib": (lambda value: encode_value(value, compression=FORMAT_MSGPACK_ZLIB), decode_value),
+    }
+    if zstandard is not None:
+        variants["msgpack+zstd"] = (lambda value: encode_value(value, compression=FORMAT_MSGPACK_ZSTD), decode_value)
+    if lz4_frame is not None:
+        variants["msgpack+lz4"] = (lambda value: encode_value(value, compression=FORMAT_MSGPACK_LZ4), decode_value)
+    return variants
+
+
+def bench_cpu(name: str, encode, decode, profiles: list, rounds: int) -> dict:
+    encode_times, decode_times = [], []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        blobs = [encode(profile) for profile in profiles]
+        encode_times.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for blob in blobs:
+            decode(blob)
+        decode_times.append(time.perf_counter() - started)
+
+    total_bytes = sum(len(blob) for blob in blobs)
+    return {
+        "codec": name,
+        "avg_bytes": round(total_bytes / len(profiles)),
+        "total_kb": round(total_bytes / 1024),
+        "encode_us": round(min(encode_times) / len(profiles) * 1e6, 1),
+        "decode_us": round(min(decode_times) / len(profiles) * 1e6, 1),
+    }
+
+
+async def bench_redis_memory(client: redis.Redis, profiles: list) -> list:
+    """ MEMORY USAGE для прежней схемы (JSON + копии в страницах) и текущей (кодек + ID в страницах) """
+    pages = [profiles[i:i + PAGE_SIZE] for i in range(0, len(profiles), PAGE_SIZE)]
+    schemes = {
+        "json, pages with profiles": (json_encode, lambda page: json_encode(page)),
+        "codec, pages with ids": (encode_value, lambda page: encode_value([profile["id"] for profile in page])),
+    }
+
+    results = []
+    for name, (encode_profile, encode_page) in schemes.items():
+        async with client.pipeline(transaction=False) as pipe:
+            for profile in profiles:
+                pipe.set(f"{BENCH_KEY_PREFIX}profile:{profile['id']}", encode_profile(profile))
+            for page_number, page in enumerate(pages, start=1):
+                pipe.set(f"{BENCH_KEY_PREFIX}page_{page_number}", encode_page(page))
+            await pipe.execute()
+
+        keys = [f"{BENCH_KEY_PREFIX}profile:{profile['id']}" for profile in profiles]
+        keys += [f"{BENCH_KEY_PREFIX}page_{page_number}" for page_number in range(1, len(pages) + 1)]
+        async with client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.memory_usage(key)
+            usages = await pipe.execute()
+
+        results.append({"scheme": name, "redis_mb": round(sum(usage or 0 for usage in usages) / 1024 / 1024, 2)})
+        await client.delete(*keys)
+    return results
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Замер кодеков кэша профилей")
+    parser.add_argument("--profiles", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--redis-host", default=None, help="Если указан - замерить память в Redis (MEMORY USAGE)")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    args = parser.parse_args()
+
+    random.seed(42)
+    profiles = [make_profile(profile_id) for profile_id in range(1, args.profiles + 1)]
+
+    for name, (encode, decode) in codec_variants().items():
+        print(bench_cpu(name, encode, decode, profiles, args.rounds))
+
+    if args.redis_host:
+        client = redis.Redis(host=args.redis_host, port=args.redis_port, db=0)
+        try:
+            for result in await bench_redis_memory(client, profiles):
+                print(result)
+        finally:
+            await client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
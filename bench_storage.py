@@ -0,0 +1,86 @@
+""" Замер скорости загрузки в хранилище для каждого бэкенда на одной машине.
+    Генерирует папку, похожую на результат обработки видео (основной файл + HLS-сегменты),
+    и грузит ее так же, как воркер (параллельно, большие файлы частями).
+    Запуск: python bench_storage.py --backends local memory [s3] --segments 60 --segment-kb 512 --video-mb 40 """
+
+import os
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+from video_handle.storage_backends import create_storage, STORAGE_BACKENDS
+
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", 8))  # Как у воркера
+
+
+def make_fixture(root: str, segments: int, segment_kb: int, video_mb: int) -> list:
+    """ Файлы для загрузки: [(локальный путь, ключ)] """
+    files = []
+    video_path = os.path.join(root, "video.mp4")
+    with open(video_path, "wb") as f:
+        f.write(os.urandom(video_mb * 1024 * 1024))
+    files.append((video_path, "bench/video.mp4"))
+
+    hls_dir = os.path.join(root, "hls")
+    os.makedirs(hls_dir)
+    for i in range(segments):
+        segment_path = os.path.join(hls_dir, f"segment_{i:03d}.ts")
+        with open(segment_path, "wb") as f:
+            f.write(os.urandom(segment_kb * 1024))
+        files.append((segment_path, f"bench/hls/segment_{i:03d}.ts"))
+    return files
+
+
+async def bench_backend(name: str, files: list, rounds: int) -> dict:
+    storage = create_storage(name)
+    await storage.check()
+    total_bytes = sum(os.path.getsize(path) for path, _ in files)
+    semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+    async def upload_one(path: str, key: str):
+        async with semaphore:
+            await storage.put_file(key, path)
+
+    timings = []
+    try:
+        for round_number in range(rounds):
+            prefix = f"bench/{round_number}/"
+            started = time.perf_counter()
+            await asyncio.gather(*(upload_one(path, prefix + key[len("bench/"):]) for path, key in files))
+            timings.append(time.perf_counter() - started)
+            await storage.delete_prefix(prefix)
+    finally:
+        await storage.close()
+
+    best = min(timings)
+    return {
+        "backend": name,
+        "files": len(files),
+        "mb": round(total_bytes / 1024 / 1024, 1),
+        "best_sec": round(best, 3),
+        "mb_per_sec": round(total_bytes / 1024 / 1024 / best, 1),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Замер скорости загрузки в хранилище")
+    parser.add_argument("--backends", nargs="+", default=["local", "memory"], choices=list(STORAGE_BACKENDS))
+    parser.add_argument("--segments", type=int, default=60)
+    parser.add_argument("--segment-kb", type=int, default=512)
+    parser.add_argument("--video-mb", type=int, default=40)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="bench_storage_")
+    try:
+        files = make_fixture(root, args.segments, args.segment_kb, args.video_mb)
+        for name in args.backends:
+            print(await bench_backend(name, files, args.rounds))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,127 @@
+""" Модуль кодирования значений кэша Redis.
+
+    Профили и страницы хранятся не в JSON, а в msgpack (компактнее и быстрее разбирается),
+    значения больше порога дополнительно сжимаются. Первый байт значения - заголовок с форматом,
+    поэтому алгоритм сжатия можно менять без сброса кэша: старые значения читаются по своему заголовку.
+    Значения в старом формате (JSON без заголовка) тоже читаются, пока не истекут.
+
+    Закодированные значения - байты, читать их нужно клиентом Redis без decode_responses. """
+
+import os
+import json
+import zlib
+from typing import Any, Optional
+
+import msgpack
+
+from logging_config import get_logger
+
+logger = get_logger()
+
+# Необязательные библиотеки сжатия: если не установлены, используется zlib из стандартной библиотеки
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# Заголовки формата (первый байт значения)
+FORMAT_MSGPACK = 0x01
+FORMAT_MSGPACK_ZSTD = 0x02
+FORMAT_MSGPACK_LZ4 = 0x03
+FORMAT_MSGPACK_ZLIB = 0x04
+
+# auto - лучший из доступных (zstd, lz4, zlib); none - без сжатия
+CACHE_COMPRESSION = os.getenv("CACHE_COMPRESSION", "auto").lower()
+CACHE_COMPRESS_MIN_BYTES = int(os.getenv("CACHE_COMPRESS_MIN_BYTES", 512))  # Мелкие значения сжатие только увеличит
+CACHE_ZSTD_LEVEL = int(os.getenv("CACHE_ZSTD_LEVEL", 3))
+CACHE_ZLIB_LEVEL = int(os.getenv("CACHE_ZLIB_LEVEL", 6))
+
+
+class CodecError(Exception):
+    """ Значение кэша не удалось разобрать (неизвестный формат или поврежденные данные) """
+
+
+def _resolve_compression(name: str) -> Optional[int]:
+    if name == "none":
+        return None
+    if name in ("auto", "zstd") and zstandard is not None:
+        return FORMAT_MSGPACK_ZSTD
+    if name in ("auto", "lz4") and lz4_frame is not None:
+        return FORMAT_MSGPACK_LZ4
+    if name not in ("auto", "zlib"):
+        logger.warning(f"Сжатие {name} недоступно, используется zlib.")
+    return FORMAT_MSGPACK_ZLIB
+
+
+COMPRESSION_FORMAT = _resolve_compression(CACHE_COMPRESSION)
+
+# Компрессоры zstd не потокобезопасны, но event loop однопоточный - держим по одному на процесс
+_zstd_compressor = zstandard.ZstdCompressor(level=CACHE_ZSTD_LEVEL) if zstandard is not None else None
+_zstd_decompressor = zstandard.ZstdDecompressor() if zstandard is not None else None
+
+
+def _compress(data: bytes, fmt: int) -> bytes:
+    if fmt == FORMAT_MSGPACK_ZSTD:
+        return _zstd_compressor.compress(data)
+    if fmt == FORMAT_MSGPACK_LZ4:
+        return lz4_frame.compress(data)
+    return zlib.compress(data, CACHE_ZLIB_LEVEL)
+
+
+def _decompress(data: bytes, fmt: int) -> bytes:
+    if fmt == FORMAT_MSGPACK_ZSTD:
+        if _zstd_decompressor is None:
+            raise CodecError("Значение сжато zstd, но zstandard не установлен")
+        return _zstd_decompressor.decompress(data)
+    if fmt == FORMAT_MSGPACK_LZ4:
+        if lz4_frame is None:
+            raise CodecError("Значение сжато lz4, но lz4 не установлен")
+        return lz4_frame.decompress(data)
+    return zlib.decompress(data)
+
+
+# Кодирование значения для записи в Redis
+def encode_value(value: Any, compression: Optional[int] = COMPRESSION_FORMAT) -> bytes:
+    """
+    msgpack + сжатие, если значение больше CACHE_COMPRESS_MIN_BYTES.
+    Несериализуемые типы (datetime, Decimal) приводятся к строке, как json.dumps(default=str).
+    """
+    packed = msgpack.packb(value, default=str, use_bin_type=True)
+    if compression is not None and len(packed) >= CACHE_COMPRESS_MIN_BYTES:
+        compressed = _compress(packed, compression)
+        if len(compressed) < len(packed):
+            return bytes((compression,)) + compressed
+    return bytes((FORMAT_MSGPACK,)) + packed
+
+
+# Декодирование значения из Redis
+def decode_value(raw: bytes) -> Any:
+    """
+    Разбирает значение по заголовку. Значения старого формата (JSON) читаются как есть.
+
+    :raises CodecError: Значение не удалось разобрать.
+    """
+    if not raw:
+        raise CodecError("Пустое значение")
+    if isinstance(raw, str):
+        raw = raw.encode()
+
+    fmt = raw[0]
+    try:
+        if fmt == FORMAT_MSGPACK:
+            return msgpack.unpackb(raw[1:], raw=False)
+        if fmt in (FORMAT_MSGPACK_ZSTD, FORMAT_MSGPACK_LZ4, FORMAT_MSGPACK_ZLIB):
+            return msgpack.unpackb(_decompress(raw[1:], fmt), raw=False)
+        if raw[:1] in (b"{", b"["):
+            return json.loads(raw)  # Значение записано до перехода на msgpack
+    except CodecError:
+        raise
+    except Exception as e:
+        raise CodecError(f"Не удалось разобрать значение кэша: {e}") from e
+
+    raise CodecError(f"Неизвестный формат значения кэша: {fmt}")
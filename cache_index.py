@@ -0,0 +1,339 @@
+""" Модуль индексов кэша Redis.
+
+    Вместо KEYS (блокирует однопоточный Redis на время прохода по всему пространству ключей)
+    кэш сам ведет множества ID: измененные счетчики подписчиков (dirty), пользователи с избранным,
+    закэшированные профили.
+    Индексы пополняются при записи, а читаются курсором (SSCAN) пачками.
+    Для первого запуска после обновления индекс один раз достраивается через SCAN.
+
+    Здесь же обратный индекс хэштегов: tag:{name}:newest и tag:{name}:popularity - отсортированные
+    множества ID профилей с хэштегом, profile_tags:{id} - хэштеги профиля (чтобы снять его со старых тегов),
+    и фасеты для фильтрации: facet:{признак}:{значение} - множества ID профилей.
+
+    Смешанная лента (без сортировки) - сортированное множество feed:mixed с оценкой-смесью новизны,
+    популярности, МЛМ и наличия видео. """
+
+import os
+import math
+import time
+from datetime import datetime
+from typing import AsyncIterator, Callable, Iterable, List, Optional
+
+import redis.asyncio as redis
+from redis.exceptions import ResponseError
+
+from logging_config import get_logger
+
+logger = get_logger()
+
+# Индексы (множества ID)
+DIRTY_SUBSCRIBERS_COUNT_KEY = "dirty:subscribers_count"  # Профили, счетчик которых изменился после последней синхронизации
+FAVORITES_INDEX_KEY = "index:favorites"  # Пользователи, у которых есть favorites:{user_id}
+CACHED_PROFILES_INDEX_KEY = "index:profiles"  # Профили, у которых есть profile:{id}
+
+# Какой шаблон ключей покрывает индекс (для достройки через SCAN)
+INDEX_PATTERNS = {
+    DIRTY_SUBSCRIBERS_COUNT_KEY: "subscribers_count:*",  # При первом запуске считаем измененными все счетчики
+    FAVORITES_INDEX_KEY: "favorites:*",
+    CACHED_PROFILES_INDEX_KEY: "profile:*",
+}
+
+INDEX_BOOTSTRAP_MARKER_PREFIX = "index:bootstrapped:"
+INDEX_BOOTSTRAP_LEASE_SEK = 600  # Сколько живет маркер незавершенной достройки
+SCAN_BATCH_SIZE = 500  # COUNT для SCAN/SSCAN: сколько элементов Redis просматривает за один шаг
+
+# Обратный индекс хэштегов
+TAG_KEY_PREFIX = "tag:"  # tag:{name}:newest / tag:{name}:popularity
+PROFILE_TAGS_KEY_PREFIX = "profile_tags:"  # profile_tags:{id} - хэштеги профиля
+TAG_SORTS = ("newest", "popularity")
+
+
+# ID из ключа вида prefix:{id}
+def id_from_key(key: str) -> Optional[int]:
+    try:
+        return int(key.rsplit(":", 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+# Проход по ключам курсором (вместо KEYS)
+async def scan_keys(client: redis.Redis, pattern: str, count: int = SCAN_BATCH_SIZE) -> AsyncIterator[str]:
+    async for key in client.scan_iter(match=pattern, count=count):
+        yield key
+
+
+# Проход по индексу курсором, пачками
+async def iter_index_batches(client: redis.Redis, index_key: str, batch_size: int = SCAN_BATCH_SIZE) -> AsyncIterator[List[int]]:
+    """ Отдает ID из индекса пачками по batch_size (SSCAN, без блокировки Redis) """
+    batch = []
+    async for member in client.sscan_iter(index_key, count=batch_size):
+        batch.append(int(member))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Все ID индекса (для небольших индексов и сравнения с БД)
+async def get_index_ids(client: redis.Redis, index_key: str) -> set:
+    ids = set()
+    async for batch in iter_index_batches(client, index_key):
+        ids.update(batch)
+    return ids
+
+
+# Одноразовая достройка индекса по существующим ключам (после обновления, пока индекс не велся)
+async def bootstrap_index(client: redis.Redis, index_key: str, key_to_id: Callable[[str], Optional[int]] = id_from_key) -> int:
+    """
+    Заполняет индекс по ключам, найденным через SCAN. Выполняется один раз (маркер в Redis).
+    На время прохода маркер ставится с коротким TTL (одновременно достраивает один процесс),
+    постоянным он становится только после полного прохода - если проход упал, следующий запуск повторит его.
+
+    :return: Количество добавленных ID.
+    """
+    marker_key = f"{INDEX_BOOTSTRAP_MARKER_PREFIX}{index_key}"
+    if not await client.set(marker_key, "running", nx=True, ex=INDEX_BOOTSTRAP_LEASE_SEK):
+        return 0
+
+    added = 0
+    batch = []
+    async for key in scan_keys(client, INDEX_PATTERNS[index_key]):
+        entity_id = key_to_id(key)
+        if entity_id is None:
+            continue
+        batch.append(entity_id)
+        if len(batch) >= SCAN_BATCH_SIZE:
+            added += await client.sadd(index_key, *batch)
+            batch = []
+    if batch:
+        added += await client.sadd(index_key, *batch)
+    await client.set(marker_key, 1)
+
+    logger.info(f"Индекс {index_key} достроен по существующим ключам: {added} ID.")
+    return added
+
+
+# Убираем из индекса ID, ключи которых уже удалены или истекли
+async def prune_index(client: redis.Redis, index_key: str, ids: List[int]) -> None:
+    if ids:
+        await client.srem(index_key, *ids)
+
+
+# Атомарное изъятие множества измененных ID на обработку
+async def claim_dirty_set(client: redis.Redis, dirty_key: str) -> Optional[str]:
+    """
+    Переименовывает множество в {dirty_key}:processing, новые изменения копятся в пустом dirty_key.
+    Если прошлая обработка упала, ее множество забирается повторно.
+
+    :return: Ключ множества на обработку или None, если изменений нет.
+    """
+    processing_key = f"{dirty_key}:processing"
+    if await client.exists(processing_key):
+        return processing_key
+    try:
+        await client.rename(dirty_key, processing_key)
+    except ResponseError:
+        return None  # Множества нет - изменений не было
+    return processing_key
+
+
+# Завершение обработки: успех - удаляем, ошибка - возвращаем ID в dirty для следующей попытки
+async def release_dirty_set(client: redis.Redis, dirty_key: str, processing_key: str, success: bool) -> None:
+    if not success:
+        await client.sunionstore(dirty_key, [dirty_key, processing_key])
+    await client.delete(processing_key)
+
+
+# Ключ отсортированного множества профилей с хэштегом
+def tag_index_key(tag: str, sort_by: str) -> str:
+    return f"{TAG_KEY_PREFIX}{tag}:{sort_by}"
+
+
+# Нормализация хэштега так же, как при сохранении профиля
+def normalize_tag(tag: str) -> str:
+    return tag.strip().lower().lstrip("#")
+
+
+# Постановка команд обновления индекса хэштегов одного профиля в пайплайн
+def queue_profile_hashtags(
+    pipe,
+    profile_id: int,
+    old_tags: Iterable[str],
+    tags: Iterable[str],
+    created_at: Optional[datetime],
+    followers_count: int,
+    is_visible: bool
+) -> None:
+    """
+    Снимает профиль с тегов, которых у него больше нет, и ставит на актуальные.
+    Скрытые профили (инкогнито) в выдачу по тегам не попадают, но их хэштеги запоминаются.
+
+    :param created_at: Дата создания (None - профиль только что создан, берется текущее время).
+    """
+    tags = set(tags)
+    created_at_timestamp = int(created_at.timestamp()) if created_at else int(time.time())
+
+    # Видимый профиль снимаем только с убранных тегов, скрытый - со всех
+    tags_to_remove = set(old_tags) - tags if is_visible else set(old_tags) | tags
+    for tag in tags_to_remove:
+        for sort_by in TAG_SORTS:
+            pipe.zrem(tag_index_key(tag, sort_by), profile_id)
+
+    if is_visible:
+        for tag in tags:
+            pipe.zadd(tag_index_key(tag, "newest"), {profile_id: created_at_timestamp})
+            pipe.zadd(tag_index_key(tag, "popularity"), {profile_id: followers_count or 0})
+
+    profile_tags_key = f"{PROFILE_TAGS_KEY_PREFIX}{profile_id}"
+    pipe.delete(profile_tags_key)
+    if tags:
+        pipe.sadd(profile_tags_key, *tags)
+
+
+# Обновление индекса хэштегов профиля после сохранения
+async def index_profile_hashtags(
+    client: redis.Redis,
+    profile_id: int,
+    tags: Optional[Iterable[str]],
+    created_at: Optional[datetime],
+    followers_count: int,
+    is_visible: bool
+) -> None:
+    """
+    :param tags: Актуальные хэштеги профиля (None - не менялись, берутся из profile_tags:{id}).
+    """
+    old_tags = await client.smembers(f"{PROFILE_TAGS_KEY_PREFIX}{profile_id}")
+    if tags is None:
+        tags = old_tags
+
+    # Популярность - живое значение счетчика, если он уже есть в кэше
+    live_count = await client.get(f"subscribers_count:{profile_id}")
+    if live_count is not None:
+        followers_count = max(int(live_count), 0)
+
+    async with client.pipeline(transaction=True) as pipe:
+        queue_profile_hashtags(pipe, profile_id, old_tags, tags, created_at, followers_count, is_visible)
+        await pipe.execute()
+
+
+# Снятие удаленного профиля со всех тегов
+async def remove_profile_hashtags(client: redis.Redis, profile_id: int) -> None:
+    profile_tags_key = f"{PROFILE_TAGS_KEY_PREFIX}{profile_id}"
+    old_tags = await client.smembers(profile_tags_key)
+    async with client.pipeline(transaction=True) as pipe:
+        for tag in old_tags:
+            for sort_by in TAG_SORTS:
+                pipe.zrem(tag_index_key(tag, sort_by), profile_id)
+        pipe.delete(profile_tags_key)
+        await pipe.execute()
+
+
+# ФАСЕТЫ: множества ID профилей по значению признака (город, язык, флаги)
+
+FACET_KEY_PREFIX = "facet:"  # facet:{признак}:{значение}
+FACET_VALUES_KEY_PREFIX = "facet_values:"  # facet_values:{признак} - встречавшиеся значения (для подсчета)
+PROFILE_FACETS_KEY_PREFIX = "profile_facets:"  # profile_facets:{id} - ключи фасетов профиля
+FACET_DIMENSIONS = ("city", "language", "is_in_mlm", "has_video", "visible", "moderated")
+
+
+# Ключ фасета
+def facet_key(dimension: str, value) -> str:
+    return f"{FACET_KEY_PREFIX}{dimension}:{normalize_facet_value(value)}"
+
+
+# Значения фасетов сравниваются без учета регистра и пробелов по краям
+def normalize_facet_value(value) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return str(value).strip().lower()
+
+
+# Значения фасетов профиля по данным из кэша (build_profile_cache_data)
+def profile_facets(profile_data: dict) -> dict:
+    video_url = profile_data.get("video_url") or ""
+    facets = {
+        "is_in_mlm": int(profile_data.get("is_in_mlm") or 0),
+        "has_video": bool(video_url) and "mock" not in video_url.lower(),  # Мок-видео не считается
+        "visible": not profile_data.get("is_incognito", False),
+        "moderated": bool(profile_data.get("is_moderated")),
+    }
+    if profile_data.get("city"):
+        facets["city"] = profile_data["city"]
+    if profile_data.get("language"):
+        facets["language"] = profile_data["language"]
+    return {dimension: normalize_facet_value(value) for dimension, value in facets.items()}
+
+
+# Постановка команд обновления фасетов одного профиля в пайплайн
+def queue_profile_facets(pipe, profile_id: int, old_facet_keys: Iterable[str], facets: dict) -> None:
+    new_facet_keys = {f"{FACET_KEY_PREFIX}{dimension}:{value}" for dimension, value in facets.items()}
+
+    for key in set(old_facet_keys) - new_facet_keys:
+        pipe.srem(key, profile_id)
+    for dimension, value in facets.items():
+        pipe.sadd(f"{FACET_KEY_PREFIX}{dimension}:{value}", profile_id)
+        pipe.sadd(f"{FACET_VALUES_KEY_PREFIX}{dimension}", value)
+
+    profile_facets_key = f"{PROFILE_FACETS_KEY_PREFIX}{profile_id}"
+    pipe.delete(profile_facets_key)
+    if new_facet_keys:
+        pipe.sadd(profile_facets_key, *new_facet_keys)
+
+
+# Обновление фасетов профиля
+async def index_profile_facets(client: redis.Redis, profile_id: int, profile_data: dict) -> None:
+    old_facet_keys = await client.smembers(f"{PROFILE_FACETS_KEY_PREFIX}{profile_id}")
+    async with client.pipeline(transaction=True) as pipe:
+        queue_profile_facets(pipe, profile_id, old_facet_keys, profile_facets(profile_data))
+        await pipe.execute()
+
+
+# Снятие удаленного профиля со всех фасетов
+async def remove_profile_facets(client: redis.Redis, profile_id: int) -> None:
+    profile_facets_key = f"{PROFILE_FACETS_KEY_PREFIX}{profile_id}"
+    old_facet_keys = await client.smembers(profile_facets_key)
+    async with client.pipeline(transaction=True) as pipe:
+        for key in old_facet_keys:
+            pipe.srem(key, profile_id)
+        pipe.delete(profile_facets_key)
+        await pipe.execute()
+
+
+# СМЕШАННАЯ ЛЕНТА: оценка профиля для выдачи без сортировки
+
+FEED_MIXED_KEY = "feed:mixed"
+
+# Веса смеси. Новизна привязана ко времени создания, а не к возрасту: оценка не "стареет",
+# и ленту не нужно пересчитывать целиком каждый час - только при изменении профиля или подписчиков.
+# Единица оценки - FEED_RECENCY_SCALE_SEK свежести: при весах по умолчанию x10 подписчиков
+# поднимают профиль как сутки новизны, МЛМ и видео - как полсуток.
+FEED_RECENCY_SCALE_SEK = float(os.getenv("FEED_RECENCY_SCALE_SEK", 86400))
+FEED_WEIGHT_RECENCY = float(os.getenv("FEED_WEIGHT_RECENCY", 1.0))
+FEED_WEIGHT_POPULARITY = float(os.getenv("FEED_WEIGHT_POPULARITY", 1.0))
+FEED_WEIGHT_MLM = float(os.getenv("FEED_WEIGHT_MLM", 0.5))
+FEED_WEIGHT_VIDEO = float(os.getenv("FEED_WEIGHT_VIDEO", 0.5))
+
+
+# Оценка профиля в смешанной ленте
+def mixed_feed_score(created_at_ts: float, followers_count: int, is_in_mlm: bool, has_video: bool) -> float:
+    """
+    Та же формула в SQL - mixed_feed_order_expression в views.py (выдача из БД при холодном кэше).
+    Время создания - целые секунды, как в profiles:newest (по нему оценки пересчитывает refresh_mixed_feed):
+    иначе пересчет и запись профиля давали бы разные оценки одному и тому же профилю.
+    """
+    score = (
+        FEED_WEIGHT_RECENCY * int(created_at_ts) / FEED_RECENCY_SCALE_SEK
+        + FEED_WEIGHT_POPULARITY * math.log10(1 + max(followers_count, 0))
+        + FEED_WEIGHT_MLM * bool(is_in_mlm)
+        + FEED_WEIGHT_VIDEO * bool(has_video)
+    )
+    return round(score, 6)  # Без шума последних разрядов: иначе сверка видит изменения там, где их нет
+
+
+# Оценка по данным профиля из кэша (build_profile_cache_data) и живому счетчику подписчиков
+def profile_mixed_feed_score(profile_data: dict, created_at: datetime, followers_count: int) -> float:
+    facets = profile_facets(profile_data)
+    return mixed_feed_score(
+        int(created_at.timestamp()), followers_count, facets["is_in_mlm"] != "0", facets["has_video"] == "1"
+    )
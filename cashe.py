@@ -2,9 +2,8 @@
     получение 50 профилей на первоначальную отдачу клиентам.
     Описание логики актуализации данных в кэше Redis и актуализации данных в БД """
 
-import random
 import os
-from datetime import timedelta
+import time
 import secrets
 import json
 import hashlib
@@ -14,7 +13,8 @@ import redis.asyncio as redis
 from pydantic import HttpUrl
 from redis.exceptions import RedisError
 from typing import Optional
-from sqlalchemy import func, desc, or_, update, delete, and_
+from sqlalchemy import or_, update, delete, and_, values, column, Integer, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import OperationalError, IntegrityError, SQLAlchemyError
 from sqlalchemy.orm import joinedload, subqueryload, selectinload
@@ -22,25 +22,107 @@ from sqlalchemy.future import select
 from geoalchemy2.shape import to_shape
 from shapely.wkt import loads as wkt_loads
 from shapely.geometry import Point, MultiPoint
-from typing import List, Dict, Set, Tuple
+from typing import Awaitable, Callable, List, Dict, Set, Tuple
 from dotenv import load_dotenv
 
 from logging_config import get_logger
 from database import get_db_session, get_db_session_for_worker
 from models import UserProfiles, Favorite, Hashtag, ProfileHashtag, User
-from utils import datetime_to_str, process_coordinates_for_response, parse_coordinates, generate_unique_link, move_image_to_user_logo
+from utils import parse_coordinates, generate_unique_link, move_image_to_user_logo
 from schemas import serialize_form_data, FormData
-from video_handle.video_handler_worker import delete_video_folder, delete_old_media_files
+from video_handle.video_handler_worker import delete_old_media_files, offload_media_file, remove_local_media_files
+from video_handle.storage_gc import enqueue_storage_gc
 from mock_urls import mock_options
+from local_cache import local_cache, publish_invalidation, MISS
+from cache_codec import encode_value, decode_value, CodecError
+from cursors import encode_cursor, decode_cursor, cursor_page_message
+from discovery import new_discovery_token, parse_discovery_token, permuted_positions
+from seen_filter import filter_unseen, mark_seen, reset_seen
+from response_cache import bump_response_cache_version
+from single_flight import single_flight, refresh_in_background, acquire_lease, release_lease, jittered_ttl
+from cache_index import (
+    DIRTY_SUBSCRIBERS_COUNT_KEY,
+    FAVORITES_INDEX_KEY,
+    CACHED_PROFILES_INDEX_KEY,
+    bootstrap_index,
+    iter_index_batches,
+    get_index_ids,
+    prune_index,
+    claim_dirty_set,
+    release_dirty_set,
+    PROFILE_TAGS_KEY_PREFIX,
+    tag_index_key,
+    normalize_tag,
+    queue_profile_hashtags,
+    index_profile_hashtags,
+    remove_profile_hashtags,
+    FACET_VALUES_KEY_PREFIX,
+    facet_key,
+    PROFILE_FACETS_KEY_PREFIX,
+    profile_facets,
+    queue_profile_facets,
+    index_profile_facets,
+    remove_profile_facets,
+    FEED_MIXED_KEY,
+    mixed_feed_score,
+    profile_mixed_feed_score
+)
 
 
 logger = get_logger()
 
 # Настраиваем соединение с Redis
 redis_client = redis.Redis(host='redis', port=6379, db=0, decode_responses=True) # Надо ли этот тут?
+# Профили и страницы лежат в кэше в бинарном виде (cache_codec) - для них отдельный клиент без декодирования
+redis_binary_client = redis.Redis(host='redis', port=6379, db=0)
 
 # Константы для TTL пользователей, пагинированных страниц с профилями, сортированных по новизне/популярности сетов (12 часов)
 CACHE_PROFILES_TTL_SEK = 43200
+# Профиль, которому осталось жить меньше этого, отдается из кэша и обновляется в фоне (stale-while-revalidate)
+CACHE_PROFILES_STALE_SEK = int(os.getenv("CACHE_PROFILES_STALE_SEK", 1800))
+
+# Страницы для просмотра без сортировки строятся поколениями: pages:{gen}:page_{n} + pages:{gen}:meta,
+# запросы читают поколение из указателя pages:generation, пересборка идет только в фоне
+PAGES_GENERATION_KEY = "pages:generation"  # Указатель на текущее поколение
+PAGES_GENERATION_SEQ_KEY = "pages:generation_seq"  # Счетчик поколений
+PAGES_REFRESH_FLIGHT_KEY = "pages:refresh"  # Ключ single-flight: одновременно пересобирает только один процесс
+PAGES_REFRESH_LEASE_SEK = 600
+PAGES_FRESHNESS_SEK = int(os.getenv("PAGES_FRESHNESS_SEK", 600))  # Старше - запрос запускает фоновую пересборку
+PAGES_OLD_GENERATION_TTL_SEK = 120  # Сколько живет прошлое поколение (дочитать уже начатые запросы)
+PAGE_SIZE = 50
+
+PROFILE_KEY_PREFIX = "profile:"  # Кэш профиля: profile:{id}
+HYDRATE_BATCH_SIZE = 500  # Ключей в одном MGET при полном проходе
+REFRESH_BATCH_SIZE = int(os.getenv("REFRESH_BATCH_SIZE", 500))  # Строк из БД за один шаг потоковой пересборки
+REFRESH_PIPELINE_PROFILES = int(os.getenv("REFRESH_PIPELINE_PROFILES", 25))  # Профилей (около 10-15 команд каждый) в одном пайплайне
+
+# Журнал изменений избранного: add/remove пишутся в стрим, синхронизация применяет их к БД пачками
+FAVORITES_EVENTS_STREAM = "favorites:events"
+FAVORITES_EVENTS_CURSOR_KEY = "favorites:events:cursor"  # ID последнего примененного события
+FAVORITES_EVENTS_BACKFILL_MARKER = "favorites:events:backfilled"
+FAVORITES_EVENTS_BACKFILL_LEASE_SEK = 600  # Сколько живет маркер незавершенного переноса
+FAVORITES_EVENTS_MAXLEN = 1_000_000  # Защита от бесконечного роста, если синхронизация долго не работает
+FAVORITES_EVENTS_BATCH_SIZE = 1000
+
+POPULARITY_RECONCILE_BATCH_SIZE = 1000  # Профилей на одну пачку сверки рейтинга
+
+# Фильтрация по фасетам: результат пересечения живет недолго и переиспользуется одинаковыми запросами
+FACET_QUERY_TTL_SEK = 30
+FACET_QUERY_KEY_PREFIX = "facet_query:"
+FACET_COUNT_DIMENSIONS = ("city", "language", "is_in_mlm", "has_video", "moderated")  # По каким признакам отдаем количество
+
+# Время жизни записей локального кэша процесса (профили меняются - короче, страницы поколения неизменны - дольше)
+LOCAL_CACHE_PROFILE_TTL_SEK = 30
+LOCAL_CACHE_PAGE_TTL_SEK = 120
+
+# Поиск профиля по кошельку, имени и ссылке: ключ -> ID профилей
+LOOKUP_KEY_PREFIX = "lookup:"  # lookup:{wallet|name|link}:{значение} -> ID через запятую ("" - не найден)
+PROFILE_LOOKUP_KEY_PREFIX = "profile_lookup:"  # profile_lookup:{id} - ключи поиска, в которых есть профиль
+LOOKUP_TTL_SEK = int(os.getenv("LOOKUP_TTL_SEK", 3600))
+LOOKUP_NEGATIVE_TTL_SEK = int(os.getenv("LOOKUP_NEGATIVE_TTL_SEK", 30))  # Недолго: профиль могут вот-вот создать
+
+# Лента без просмотренных: сколько раз за запрос дочитывать ленту, если вся пачка уже просмотрена
+SEEN_FEED_MAX_READS = 10
 
 load_dotenv()
 
@@ -57,6 +139,120 @@ AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 
 # ЛОГИКА РАБОТЫ С ИЗБРАННЫМ
 
+# Изменение счетчика подписчиков одним атомарным вызовом: счетчик (не ниже нуля),
+# рейтинг популярности (общий и по хэштегам профиля) и отметка для синхронизации с БД.
+# В общем рейтинге только профили с подписчиками: при нуле профиль из него убирается.
+# KEYS: subscribers_count:{id}, profiles:popularity, dirty:subscribers_count, tag:{name}:popularity...
+# ARGV: delta, profile_id
+SUBSCRIBERS_COUNT_SCRIPT = """
+local count = redis.call('INCRBY', KEYS[1], ARGV[1])
+if count < 0 then
+    redis.call('SET', KEYS[1], 0)
+    count = 0
+end
+if count > 0 then
+    redis.call('ZADD', KEYS[2], count, ARGV[2])
+else
+    redis.call('ZREM', KEYS[2], ARGV[2])
+end
+redis.call('SADD', KEYS[3], ARGV[2])
+for i = 4, #KEYS do
+    redis.call('ZADD', KEYS[i], 'XX', count, ARGV[2])
+end
+return count
+"""
+
+# Добавление/удаление из избранного одним атомарным вызовом: проверка членства, изменение множества,
+# счетчика (не ниже нуля), рейтинга популярности (общего и по хэштегам), отметка для синхронизации
+# и событие в журнал. Возвращает {изменилось (0/1), счетчик подписчиков}.
+# KEYS: favorites:{user_id}, subscribers_count:{profile_id}, profiles:popularity,
+#       dirty:subscribers_count, index:favorites, favorites:events, tag:{name}:popularity...
+# ARGV: op (add/remove), user_id, profile_id, maxlen журнала
+FAVORITE_TOGGLE_SCRIPT = """
+local is_member = redis.call('SISMEMBER', KEYS[1], ARGV[3])
+local adding = ARGV[1] == 'add'
+
+if (adding and is_member == 1) or ((not adding) and is_member == 0) then
+    return {0, tonumber(redis.call('GET', KEYS[2]) or '0')}
+end
+
+local count
+if adding then
+    redis.call('SADD', KEYS[1], ARGV[3])
+    redis.call('SADD', KEYS[5], ARGV[2])
+    count = redis.call('INCR', KEYS[2])
+else
+    redis.call('SREM', KEYS[1], ARGV[3])
+    count = redis.call('DECR', KEYS[2])
+    if count < 0 then
+        redis.call('SET', KEYS[2], 0)
+        count = 0
+    end
+end
+
+if count > 0 then
+    redis.call('ZADD', KEYS[3], count, ARGV[3])
+else
+    redis.call('ZREM', KEYS[3], ARGV[3])
+end
+redis.call('SADD', KEYS[4], ARGV[3])
+for i = 7, #KEYS do
+    redis.call('ZADD', KEYS[i], 'XX', count, ARGV[3])
+end
+redis.call('XADD', KEYS[6], 'MAXLEN', '~', ARGV[4], '*', 'op', ARGV[1], 'user_id', ARGV[2], 'profile_id', ARGV[3])
+return {1, count}
+"""
+
+# Скрипты регистрируются один раз, дальше вызываются через EVALSHA (с откатом на EVAL после рестарта Redis)
+subscribers_count_script = redis_client.register_script(SUBSCRIBERS_COUNT_SCRIPT)
+favorite_toggle_script = redis_client.register_script(FAVORITE_TOGGLE_SCRIPT)
+
+
+# Ключи рейтингов популярности по хэштегам профиля (скрипты получают их в KEYS, а не собирают сами)
+async def profile_tag_popularity_keys(profile_id: int, client: redis.Redis) -> List[str]:
+    """
+    Хэштеги читаются до вызова скрипта: если они сменятся между чтением и скриптом, новый тег получит
+    живой счетчик при индексации профиля (index_profile_hashtags), а снятый - не вернется (ZADD XX).
+    """
+    tags = await client.smembers(f"{PROFILE_TAGS_KEY_PREFIX}{profile_id}")
+    return [tag_index_key(tag, "popularity") for tag in sorted(tags)]
+
+
+# Атомарное изменение счетчика подписчиков
+async def change_subscribers_count(profile_id: int, delta: int, client: Optional[redis.Redis] = None) -> int:
+    client = client or redis_client
+    tag_keys = await profile_tag_popularity_keys(profile_id, client)
+    return int(await subscribers_count_script(
+        keys=[f"subscribers_count:{profile_id}", "profiles:popularity", DIRTY_SUBSCRIBERS_COUNT_KEY, *tag_keys],
+        args=[delta, profile_id],
+        client=client
+    ))
+
+
+# Атомарное добавление/удаление из избранного вместе со счетчиком
+async def toggle_favorite(user_id: int, profile_id: int, op: str, client: Optional[redis.Redis] = None) -> Tuple[bool, int]:
+    """
+    :param op: add или remove.
+    :return: (изменилось ли избранное, текущее количество подписчиков профиля).
+    """
+    client = client or redis_client
+    tag_keys = await profile_tag_popularity_keys(profile_id, client)
+    changed, count = await favorite_toggle_script(
+        keys=[
+            f"favorites:{user_id}",
+            f"subscribers_count:{profile_id}",
+            "profiles:popularity",
+            DIRTY_SUBSCRIBERS_COUNT_KEY,
+            FAVORITES_INDEX_KEY,
+            FAVORITES_EVENTS_STREAM,
+            *tag_keys,
+        ],
+        args=[op, user_id, profile_id, FAVORITES_EVENTS_MAXLEN],
+        client=client
+    )
+    return bool(changed), int(count)
+
+
 # Увеличить счётчик подписчиков
 async def increment_subscribers_count(profile_id: int):
     """
@@ -66,13 +262,7 @@ async def increment_subscribers_count(profile_id: int):
     :return: Новое количество подписчиков.
     """
     try:
-        # Проверяем, существует ли ключ для счетчика подписчиков
-        if not await redis_client.exists(f'subscribers_count:{profile_id}'):
-            # Если ключа нет, создаем его с начальным значением 0
-            await redis_client.set(f'subscribers_count:{profile_id}', 0)
-
-        # Увеличиваем счетчик подписчиков на 1
-        new_count = await redis_client.incr(f'subscribers_count:{profile_id}')
+        new_count = await change_subscribers_count(profile_id, 1)
 
         # Логируем результат
         logger.info(f"Количество подписчиков профиля {profile_id} увеличено. Новое значение: {new_count}")
@@ -87,26 +277,13 @@ async def increment_subscribers_count(profile_id: int):
 # Уменьшить счётчик подписчиков
 async def decrement_subscribers_count(profile_id: int):
     """
-    Уменьшить количество подписчиков на 1.
+    Уменьшить количество подписчиков на 1 (не ниже нуля).
 
     :param profile_id: ID профиля.
     :return: Новое количество подписчиков.
     """
     try:
-        # Проверяем, существует ли ключ для счетчика подписчиков
-        if not await redis_client.exists(f'subscribers_count:{profile_id}'):
-            # Если ключа нет, создаем его с начальным значением 0
-            await redis_client.set(f'subscribers_count:{profile_id}', 0)
-
-        # Уменьшаем счетчик подписчиков на 1
-        new_count = await redis_client.decr(f'subscribers_count:{profile_id}')
-
-        # Проверяем, не стало ли значение отрицательным
-        if new_count < 0:
-            # Если стало, сбрасываем счетчик на 0
-            await redis_client.set(f'subscribers_count:{profile_id}', 0)
-            logger.warning(f"Счетчик подписчиков профиля {profile_id} стал отрицательным. Сброшен на 0.")
-            new_count = 0
+        new_count = await change_subscribers_count(profile_id, -1)
 
         # Логируем результат
         logger.info(f"Количество подписчиков профиля {profile_id} уменьшено. Новое значение: {new_count}")
@@ -147,30 +324,24 @@ async def get_subscribers_count_from_cache(profile_id: int):
 
 
 # Добавить элемент в список избранного
-async def add_to_favorites(user_id: int, profile_id: int):
+async def add_to_favorites(user_id: int, profile_id: int, client: Optional[redis.Redis] = None):
     """
-    Добавить профиль в избранное пользователя.
+    Добавить профиль в избранное пользователя и увеличить счетчик подписчиков (один атомарный вызов).
 
     :param user_id: ID пользователя.
     :param profile_id: ID профиля для добавления.
-    :return: Статус операции.
+    :param client: Клиент Redis (по умолчанию - клиент модуля).
+    :return: Статус операции и текущее количество подписчиков.
     """
     try:
-        # Проверяем, есть ли профиль уже в избранном
-        already_in_favorites = await redis_client.sismember(f'favorites:{user_id}', profile_id)
+        added, subscribers_count = await toggle_favorite(user_id, profile_id, "add", client)
 
-        # Если профиль уже в избранном, возвращаем статус
-        if already_in_favorites:
+        if not added:
             logger.info(f"Профиль {profile_id} уже в избранном пользователя {user_id}.")
-            return {"status": "already_in_favorites"}
-
-        # Добавляем профиль в избранное
-        await redis_client.sadd(f'favorites:{user_id}', profile_id)
-
-        # Логируем результат
-        logger.info(f"Профиль {profile_id} добавлен в избранное пользователя {user_id}.")
+            return {"status": "already_in_favorites", "subscribers_count": subscribers_count}
 
-        return {"status": "added"}
+        logger.info(f"Профиль {profile_id} добавлен в избранное пользователя {user_id}. Подписчиков: {subscribers_count}.")
+        return {"status": "added", "subscribers_count": subscribers_count}
     except Exception as e:
         # Логируем ошибку, если что-то пошло не так
         logger.error(f"Ошибка при добавлении профиля {profile_id} в избранное пользователя {user_id}: {str(e)}")
@@ -178,30 +349,24 @@ async def add_to_favorites(user_id: int, profile_id: int):
 
 
 # Удалить элемент из списка избранного
-async def remove_from_favorites(user_id: int, profile_id: int):
+async def remove_from_favorites(user_id: int, profile_id: int, client: Optional[redis.Redis] = None):
     """
-    Удалить профиль из избранного пользователя.
+    Удалить профиль из избранного пользователя и уменьшить счетчик подписчиков (один атомарный вызов).
 
     :param user_id: ID пользователя.
     :param profile_id: ID профиля для удаления.
-    :return: Статус операции.
+    :param client: Клиент Redis (по умолчанию - клиент модуля).
+    :return: Статус операции и текущее количество подписчиков.
     """
     try:
-        # Проверяем, есть ли профиль в избранном
-        exists_in_favorites = await redis_client.sismember(f'favorites:{user_id}', profile_id)
+        removed, subscribers_count = await toggle_favorite(user_id, profile_id, "remove", client)
 
-        # Если профиля нет в избранном, возвращаем статус
-        if not exists_in_favorites:
+        if not removed:
             logger.info(f"Профиль {profile_id} не найден в избранном пользователя {user_id}.")
-            return {"status": "not_in_favorites"}
-
-        # Удаляем профиль из избранного
-        await redis_client.srem(f'favorites:{user_id}', profile_id)
+            return {"status": "not_in_favorites", "subscribers_count": subscribers_count}
 
-        # Логируем результат
-        logger.info(f"Профиль {profile_id} удален из избранного пользователя {user_id}.")
-
-        return {"status": "removed"}
+        logger.info(f"Профиль {profile_id} удален из избранного пользователя {user_id}. Подписчиков: {subscribers_count}.")
+        return {"status": "removed", "subscribers_count": subscribers_count}
     except Exception as e:
         # Логируем ошибку, если что-то пошло не так
         logger.error(f"Ошибка при удалении профиля {profile_id} из избранного пользователя {user_id}: {str(e)}")
@@ -241,6 +406,7 @@ async def get_favorites_from_cache(user_id: int) -> List[dict]:
 
                 # Сохраняем избранное в Redis для будущих запросов
                 await redis_client.sadd(f'favorites:{user_id}', *favorite_ids)
+                await redis_client.sadd(FAVORITES_INDEX_KEY, user_id)
                 logger.info(f"Избранное пользователя {user_id} сохранено в Redis.")
         else:
             # Если избранное найдено в Redis, преобразуем ID из строк в числа
@@ -256,87 +422,341 @@ async def get_favorites_from_cache(user_id: int) -> List[dict]:
         raise
 
 
-# Функция для слива данных (счетчик подписчиков и избранное) из Redis в БД
-async def sync_data_to_db():
+# Пакетная запись счетчиков подписчиков в БД одним UPDATE ... FROM (VALUES ...)
+async def apply_followers_counts(db: AsyncSession, counts: Dict[int, int]) -> Set[int]:
     """
-    Синхронизирует данные из Redis в базу данных:
-    - Обновляет счетчики подписчиков для профилей.
-    - Добавляет новые связи "избранное" в базу данных.
-    - Удаляет записи из Redis, если юзер или профиль удалены в БД.
+    Обновляет followers_count для пачки профилей одним запросом.
+
+    :param db: Сессия БД.
+    :param counts: {profile_id: followers_count}.
+    :return: ID профилей, которые есть в БД и были обновлены.
+    """
+    if not counts:
+        return set()
+
+    counts_values = values(
+        column("id", Integer),
+        column("followers_count", Integer),
+        name="counts"
+    ).data(list(counts.items()))
+
+    result = await db.execute(
+        update(UserProfiles)
+        .where(UserProfiles.id == counts_values.c.id)
+        .values(followers_count=counts_values.c.followers_count)
+        .returning(UserProfiles.id)
+        .execution_options(synchronize_session=False)
+    )
+    return set(result.scalars().all())
+
+
+# Синхронизация только измененных счетчиков подписчиков
+async def sync_followers_counts_to_db() -> int:
+    """
+    Забирает множество измененных счетчиков (атомарно, RENAME), читает значения пачками через MGET
+    и пишет их в БД одним UPDATE на пачку. Стоимость зависит от активности, а не от числа профилей.
+    При ошибке ID возвращаются в множество измененных.
+
+    :return: Количество обновленных профилей.
     """
+    await bootstrap_index(redis_client, DIRTY_SUBSCRIBERS_COUNT_KEY)
+
+    processing_key = await claim_dirty_set(redis_client, DIRTY_SUBSCRIBERS_COUNT_KEY)
+    if not processing_key:
+        return 0
+
+    updated = 0
+    success = False
     try:
-        # Открываем сессию для работы с базой данных
         async with get_db_session_for_worker() as db:
+            async for profile_ids_batch in iter_index_batches(redis_client, processing_key):
+                counters = await redis_client.mget([f"subscribers_count:{profile_id}" for profile_id in profile_ids_batch])
+                counts = {
+                    profile_id: max(int(value), 0)
+                    for profile_id, value in zip(profile_ids_batch, counters)
+                    if value is not None
+                }
+
+                updated_ids = await apply_followers_counts(db, counts)
+                updated += len(updated_ids)
+
+                # Профили, удаленные в БД, убираем из Redis
+                deleted_ids = set(counts) - updated_ids
+                if deleted_ids:
+                    await redis_client.delete(*[f"subscribers_count:{profile_id}" for profile_id in deleted_ids])
+                    logger.info(f"Профили {sorted(deleted_ids)} удалены в БД. Их счетчики удалены из Redis.")
 
-            # Обновляем счетчики подписчиков
-            profile_keys = await redis_client.keys('subscribers_count:*')
-            for profile_key in profile_keys:
-                profile_id = int(profile_key.split(':')[-1])
-                subscribers_count = await redis_client.get(profile_key)
-
-                if subscribers_count:
-                    # Проверяем, существует ли профиль в БД
-                    profile_stmt = await db.execute(select(UserProfiles).filter_by(id=profile_id))
-                    profile = profile_stmt.scalar_one_or_none()
-
-                    if profile:
-                        # Обновляем счетчик подписчиков
-                        profile.followers_count = int(subscribers_count)
-                        db.add(profile)
-                    else:
-                        # Если профиль удален в БД, удаляем запись из Redis
-                        await redis_client.delete(profile_key)
-                        logger.info(f"Профиль {profile_id} удален в БД. Запись {profile_key} удалена из Redis.")
-
-            # Обновляем избранное
-            user_keys = await redis_client.keys('favorites:*')
-            for user_key in user_keys:
-                user_id = int(user_key.split(':')[-1])
-                favorite_profiles = await redis_client.smembers(user_key)
-
-                if favorite_profiles:
-                    # Проверяем, существует ли юзер в БД
-                    user_stmt = await db.execute(select(User).filter_by(id=user_id))
-                    user = user_stmt.scalar_one_or_none()
-
-                    if user:
-                        for profile_id in favorite_profiles:
-                            profile_id = int(profile_id)
-
-                            # Проверяем, существует ли профиль в БД
-                            profile_stmt = await db.execute(select(UserProfiles).filter_by(id=profile_id))
-                            profile = profile_stmt.scalar_one_or_none()
-
-                            if profile:
-                                # Проверяем, есть ли такая связь в базе данных
-                                exists_stmt = await db.execute(
-                                    select(Favorite).filter_by(user_id=user_id, profile_id=profile_id)
-                                )
-                                exists = exists_stmt.scalar_one_or_none()
-
-                                if not exists:
-                                    # Добавляем новую связь "избранное"
-                                    new_favorite = Favorite(user_id=user_id, profile_id=profile_id)
-                                    db.add(new_favorite)
-                            else:
-                                # Если профиль удален в БД, удаляем его из избранного в Redis
-                                await redis_client.srem(user_key, profile_id)
-                                logger.info(f"Профиль {profile_id} удален в БД. Удален из избранного пользователя {user_id}.")
-                    else:
-                        # Если юзер удален в БД, удаляем его избранное из Redis
-                        await redis_client.delete(user_key)
-                        logger.info(f"Пользователь {user_id} удален в БД. Запись {user_key} удалена из Redis.")
-
-            # Сохраняем все изменения в базе данных
             await db.commit()
+        success = True
+    finally:
+        await release_dirty_set(redis_client, DIRTY_SUBSCRIBERS_COUNT_KEY, processing_key, success)
+
+    logger.info(f"Синхронизировано счетчиков подписчиков: {updated}.")
+    return updated
+
 
-        logger.info("Данные о избранном и счетчике подписчиков успешно синхронизированы из кеша в базу данных для всех пользователей.")
+# Одноразовый перенос уже накопленного в Redis избранного в журнал (до появления журнала оно жило только в множествах)
+async def backfill_favorites_events() -> int:
+    """
+    Маркер на время переноса ставится с коротким TTL и становится постоянным только после полного прохода:
+    если перенос упал, следующий запуск повторит его (повторные add применяются к БД без дублей).
+    """
+    if not await redis_client.set(FAVORITES_EVENTS_BACKFILL_MARKER, "running", nx=True, ex=FAVORITES_EVENTS_BACKFILL_LEASE_SEK):
+        return 0
+
+    await bootstrap_index(redis_client, FAVORITES_INDEX_KEY)
+
+    events = 0
+    async for user_ids_batch in iter_index_batches(redis_client, FAVORITES_INDEX_KEY):
+        for user_id in user_ids_batch:
+            favorite_profiles = await redis_client.smembers(f"favorites:{user_id}")
+            if not favorite_profiles:
+                await prune_index(redis_client, FAVORITES_INDEX_KEY, [user_id])
+                continue
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for profile_id in favorite_profiles:
+                    pipe.xadd(FAVORITES_EVENTS_STREAM, {"op": "add", "user_id": user_id, "profile_id": profile_id})
+                await pipe.execute()
+            events += len(favorite_profiles)
+    await redis_client.set(FAVORITES_EVENTS_BACKFILL_MARKER, 1)
+
+    logger.info(f"Избранное из Redis перенесено в журнал: {events} событий.")
+    return events
+
+
+# Применение пачки событий избранного к БД
+async def apply_favorite_events_batch(db: AsyncSession, events: List[Tuple[str, dict]]) -> Tuple[int, int]:
+    """
+    Схлопывает события по паре (user_id, profile_id) - побеждает последнее, затем применяет
+    добавления одним INSERT ... ON CONFLICT DO NOTHING и удаления одним DELETE.
+    Связи с уже удаленными пользователями/профилями при вставке пропускаются.
+
+    :return: (добавлено, удалено).
+    """
+    last_op: Dict[Tuple[int, int], str] = {}
+    for _, fields in events:
+        try:
+            last_op[(int(fields["user_id"]), int(fields["profile_id"]))] = fields["op"]
+        except (KeyError, ValueError):
+            logger.warning(f"Пропущено некорректное событие избранного: {fields}")
+
+    to_add = [pair for pair, op in last_op.items() if op == "add"]
+    to_remove = [pair for pair, op in last_op.items() if op == "remove"]
+    added = removed = 0
+
+    if to_add:
+        pairs = values(column("user_id", Integer), column("profile_id", Integer), name="pairs").data(to_add)
+        result = await db.execute(
+            pg_insert(Favorite)
+            .from_select(
+                ["user_id", "profile_id"],
+                select(pairs.c.user_id, pairs.c.profile_id)
+                .join(User, User.id == pairs.c.user_id)
+                .join(UserProfiles, UserProfiles.id == pairs.c.profile_id)
+            )
+            .on_conflict_do_nothing(index_elements=["user_id", "profile_id"])
+        )
+        added = result.rowcount or 0
+
+    if to_remove:
+        result = await db.execute(
+            delete(Favorite)
+            .where(tuple_(Favorite.user_id, Favorite.profile_id).in_(to_remove))
+            .execution_options(synchronize_session=False)
+        )
+        removed = result.rowcount or 0
+
+    return added, removed
+
+
+# Потребитель журнала избранного
+async def sync_favorites_to_db(max_batches: int = 50) -> Tuple[int, int]:
+    """
+    Читает журнал избранного после сохраненного курсора пачками по FAVORITES_EVENTS_BATCH_SIZE,
+    применяет каждую пачку в своей транзакции и только после коммита сдвигает курсор
+    и обрезает примененную часть стрима.
+
+    :param max_batches: Ограничение пачек за один запуск.
+    :return: (добавлено, удалено) в БД.
+    """
+    await backfill_favorites_events()
+
+    cursor = await redis_client.get(FAVORITES_EVENTS_CURSOR_KEY) or "0-0"
+    total_added = total_removed = 0
+
+    for _ in range(max_batches):
+        events = await redis_client.xrange(FAVORITES_EVENTS_STREAM, min=f"({cursor}", count=FAVORITES_EVENTS_BATCH_SIZE)
+        if not events:
+            break
+
+        async with get_db_session_for_worker() as db:
+            added, removed = await apply_favorite_events_batch(db, events)
+            await db.commit()
+
+        cursor = events[-1][0]
+        await redis_client.set(FAVORITES_EVENTS_CURSOR_KEY, cursor)
+        await redis_client.xtrim(FAVORITES_EVENTS_STREAM, minid=cursor, approximate=False)
+        await redis_client.xdel(FAVORITES_EVENTS_STREAM, cursor)
+
+        total_added += added
+        total_removed += removed
+
+        if len(events) < FAVORITES_EVENTS_BATCH_SIZE:
+            break
+
+    if total_added or total_removed:
+        logger.info(f"Журнал избранного применен к БД: добавлено {total_added}, удалено {total_removed}.")
+    return total_added, total_removed
+
+
+# Функция для слива данных (счетчик подписчиков и избранное) из Redis в БД
+async def sync_data_to_db():
+    """
+    Синхронизирует данные из Redis в базу данных:
+    - Обновляет счетчики подписчиков для измененных профилей (пакетно).
+    - Применяет журнал добавлений и удалений избранного (пакетно).
+    """
+    try:
+        await sync_followers_counts_to_db()
+        await sync_favorites_to_db()
+
+        logger.info("Данные о избранном и счетчике подписчиков успешно синхронизированы из кеша в базу данных.")
 
     except Exception as e:
         logger.error(f"Ошибка синхронизации данных из кеша в базу данных: {str(e)}")
         raise
 
 
+# Сверка рейтинга популярности и счетчиков с БД (исправление расхождений, без полной пересборки)
+async def reconcile_popularity(batch_size: int = POPULARITY_RECONCILE_BATCH_SIZE) -> Dict[str, int]:
+    """
+    Проходит по профилям БД пачками (keyset по id) и для каждой пачки одним MGET/ZMSCORE сверяет:
+    - счетчик subscribers_count:{id} - если его нет, засевает значением из БД (SETNX);
+    - оценку в profiles:popularity - должна совпадать со счетчиком (живым значением),
+      профиль без подписчиков из рейтинга убирается.
+    Затем убирает из рейтинга ID удаленных профилей.
+
+    :return: Статистика исправлений.
+    """
+    stats = {"checked": 0, "seeded": 0, "fixed": 0, "removed": 0}
+    last_id = 0
+
+    while True:
+        async with get_db_session_for_worker() as session:
+            rows = (await session.execute(
+                select(UserProfiles.id, UserProfiles.followers_count)
+                .where(UserProfiles.id > last_id)
+                .order_by(UserProfiles.id)
+                .limit(batch_size)
+            )).all()
+
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        profile_ids = [row[0] for row in rows]
+
+        counters = await redis_client.mget([f"subscribers_count:{profile_id}" for profile_id in profile_ids])
+        scores = await redis_client.zmscore("profiles:popularity", profile_ids)
+
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for (profile_id, db_count), counter, score in zip(rows, counters, scores):
+                if counter is None:
+                    expected = db_count or 0
+                    pipe.set(f"subscribers_count:{profile_id}", expected, nx=True)
+                    stats["seeded"] += 1
+                else:
+                    expected = max(int(counter), 0)
+
+                # Профилей без подписчиков в рейтинге нет (как в скриптах избранного и при кэшировании)
+                if expected > 0 and (score is None or int(score) != expected):
+                    pipe.zadd("profiles:popularity", {profile_id: expected})
+                    stats["fixed"] += 1
+                elif expected == 0 and score is not None:
+                    pipe.zrem("profiles:popularity", profile_id)
+                    stats["fixed"] += 1
+            await pipe.execute()
+
+        stats["checked"] += len(rows)
+
+    # Удаленные профили
+    async for member_batch in iter_sorted_set_batches(redis_client, "profiles:popularity", batch_size):
+        async with get_db_session_for_worker() as session:
+            existing_ids = set((await session.execute(
+                select(UserProfiles.id).where(UserProfiles.id.in_(member_batch))
+            )).scalars().all())
+        stale_ids = [profile_id for profile_id in member_batch if profile_id not in existing_ids]
+        if stale_ids:
+            await redis_client.zrem("profiles:popularity", *stale_ids)
+            stats["removed"] += len(stale_ids)
+
+    logger.info(f"Сверка рейтинга популярности: {stats}")
+    return stats
+
+
+# Пересчет смешанной ленты (feed:mixed) по расписанию: только изменившиеся оценки
+async def refresh_mixed_feed(batch_size: int = POPULARITY_RECONCILE_BATCH_SIZE) -> Dict[str, int]:
+    """
+    Изменения профиля попадают в ленту сразу (on_profile_changed), а подписчики меняются скриптами
+    избранного без пересчета ленты - здесь оценки догоняют их. Проход по profiles:newest пачками:
+    на пачку один пайплайн (время создания, счетчики, МЛМ и видео из фасетов, текущие оценки),
+    записываются только изменившиеся оценки. Затем из ленты убираются профили, которых нет в кэше.
+
+    Веса смеси - FEED_WEIGHT_* (cache_index.py), после их смены лента пересчитывается этим же проходом.
+
+    :return: Статистика пересчета.
+    """
+    stats = {"checked": 0, "updated": 0, "removed": 0}
+
+    async for profile_ids in iter_sorted_set_batches(redis_client, "profiles:newest", batch_size):
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.zmscore("profiles:newest", profile_ids)
+            pipe.mget([f"subscribers_count:{profile_id}" for profile_id in profile_ids])
+            pipe.smismember(facet_key("is_in_mlm", 0), profile_ids)
+            pipe.smismember(facet_key("has_video", True), profile_ids)
+            pipe.zmscore(FEED_MIXED_KEY, profile_ids)
+            created_scores, counters, not_mlm_flags, video_flags, feed_scores = await pipe.execute()
+
+        changed = {}
+        for profile_id, created_at_ts, counter, not_mlm, has_video, feed_score in zip(
+            profile_ids, created_scores, counters, not_mlm_flags, video_flags, feed_scores
+        ):
+            if created_at_ts is None:
+                continue  # Профиль убран из индекса между ZSCAN и чтением
+            score = mixed_feed_score(created_at_ts, int(counter or 0), not not_mlm, bool(has_video))
+            if feed_score is None or abs(feed_score - score) > 1e-6:
+                changed[profile_id] = score
+
+        if changed:
+            await redis_client.zadd(FEED_MIXED_KEY, changed)
+        stats["checked"] += len(profile_ids)
+        stats["updated"] += len(changed)
+
+    # Профили, удаленные из кэша
+    async for member_batch in iter_sorted_set_batches(redis_client, FEED_MIXED_KEY, batch_size):
+        created_scores = await redis_client.zmscore("profiles:newest", member_batch)
+        stale_ids = [profile_id for profile_id, score in zip(member_batch, created_scores) if score is None]
+        if stale_ids:
+            await redis_client.zrem(FEED_MIXED_KEY, *stale_ids)
+            stats["removed"] += len(stale_ids)
+
+    if stats["updated"] or stats["removed"]:
+        await bump_response_cache_version(redis_client)
+    logger.info(f"Пересчет смешанной ленты: {stats}")
+    return stats
+
+
+# Проход по участникам сортированного множества курсором (ZSCAN), пачками
+async def iter_sorted_set_batches(client: redis.Redis, key: str, batch_size: int):
+    batch = []
+    async for member, _ in client.zscan_iter(key, count=batch_size):
+        batch.append(int(member))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 # ЛОГИКА РАБОТЫ С ПЕРВОНАЧАЛЬНОЙ ОТДАЧЕЙ 50 ПРОФИЛЕЙ
 
 # Кэширование профилей в Redis
@@ -386,12 +806,435 @@ async def get_cached_profiles(redis_client: redis.Redis):
         raise HTTPException(status_code=500, detail="Ошибка при получении данных из кэша")
 
 
+# ГИДРАТАЦИЯ ПРОФИЛЕЙ ИЗ КЭША
+
+# Данные профиля в том виде, в котором он лежит в кэше под ключом profile:{id}
+def build_profile_cache_data(profile: UserProfiles) -> dict:
+    """
+    Сериализация профиля для кэша. Хэштеги и пользователь должны быть загружены заранее (selectinload).
+
+    :param profile: ORM-объект профиля.
+    :return: Словарь с данными профиля.
+    """
+    return profile_cache_data(
+        profile,
+        [ph.hashtag.tag for ph in profile.profile_hashtags],
+        profile.user.id if profile.user else None,
+        profile.user.wallet_number if profile.user else None,
+    )
+
+
+# Колонки профиля для кэша (пересборка читает их, а не ORM-объекты со связями)
+PROFILE_CACHE_COLUMNS = (
+    UserProfiles.id,
+    UserProfiles.name,
+    UserProfiles.user_logo_url,
+    UserProfiles.video_url,
+    UserProfiles.preview_url,
+    UserProfiles.poster_url,
+    UserProfiles.activity_and_hobbies,
+    UserProfiles.is_moderated,
+    UserProfiles.is_incognito,
+    UserProfiles.is_in_mlm,
+    UserProfiles.adress,
+    UserProfiles.city,
+    UserProfiles.coordinates,
+    UserProfiles.followers_count,
+    UserProfiles.created_at,
+    UserProfiles.website_or_social,
+    UserProfiles.is_admin,
+    UserProfiles.language,
+    UserProfiles.user_link,
+    UserProfiles.user_id,
+    User.wallet_number,
+)
+
+
+# Сериализация полей профиля (ORM-объект или строка выборки PROFILE_CACHE_COLUMNS)
+def profile_cache_data(profile, hashtags: List[str], user_id: Optional[int], wallet_number: Optional[str]) -> dict:
+    # Обрабатываем координаты
+    coordinates = None
+    points = []  # Все точки [долгота, широта] - для ответов поиска по кошельку, имени и ссылке
+    if profile.coordinates:
+        geometry = to_shape(profile.coordinates)  # Преобразуем WKB в Shapely
+        if isinstance(geometry, Point):
+            coordinates = {
+                "longitude": float(geometry.x),
+                "latitude": float(geometry.y),
+            }
+            points = [[float(geometry.x), float(geometry.y)]]
+        elif isinstance(geometry, MultiPoint):
+            first_point = list(geometry.geoms)[0]
+            coordinates = {
+                "longitude": float(first_point.x),
+                "latitude": float(first_point.y),
+            }
+            points = [[float(point.x), float(point.y)] for point in geometry.geoms]
+
+    return {
+        "id": profile.id,
+        "name": profile.name,
+        "user_logo_url": profile.user_logo_url,
+        "video_url": profile.video_url,
+        "preview_url": profile.preview_url,
+        "poster_url": profile.poster_url,
+        "activity_and_hobbies": profile.activity_and_hobbies,
+        "is_moderated": profile.is_moderated,
+        "is_incognito": profile.is_incognito,
+        "is_in_mlm": profile.is_in_mlm,
+        "adress": profile.adress,
+        "city": profile.city,
+        "coordinates": coordinates,
+        "points": points,
+        "followers_count": profile.followers_count,
+        "created_at": profile.created_at.isoformat() if profile.created_at else None,
+        "hashtags": hashtags,
+        "website_or_social": profile.website_or_social,
+        "is_admin": profile.is_admin,
+        "language": profile.language,
+        "user_link": profile.user_link,
+        "user": {
+            "id": user_id,
+            "wallet_number": wallet_number,
+        },
+    }
+
+
+# Загрузка профилей из БД с записью в кэш (общая для промахов и фонового обновления)
+async def load_profiles_into_cache(profile_ids: List[int], client: Optional[redis.Redis] = None) -> List[dict]:
+    client = client or redis_binary_client
+    async with get_db_session_for_worker() as session:
+        result = await session.execute(
+            select(UserProfiles)
+            .where(UserProfiles.id.in_(profile_ids))
+            .options(
+                selectinload(UserProfiles.profile_hashtags).selectinload(ProfileHashtag.hashtag),
+                selectinload(UserProfiles.user)
+            )
+        )
+        profiles_from_db = result.scalars().all()
+
+    profiles_data = []
+    if profiles_from_db:
+        async with client.pipeline(transaction=False) as pipe:
+            for profile in profiles_from_db:
+                profile_data = build_profile_cache_data(profile)
+                profiles_data.append(profile_data)
+                pipe.setex(f"{PROFILE_KEY_PREFIX}{profile.id}", jittered_ttl(CACHE_PROFILES_TTL_SEK), encode_value(profile_data))
+                pipe.sadd(CACHED_PROFILES_INDEX_KEY, profile.id)
+                pipe.set(f"subscribers_count:{profile.id}", profile.followers_count or 0, nx=True)
+            await pipe.execute()
+
+        # Свежие данные вместо локальных копий в других процессах
+        await publish_invalidation(redis_client, [f"{PROFILE_KEY_PREFIX}{profile_data['id']}" for profile_data in profiles_data])
+
+    return profiles_data
+
+
+# Ключ single-flight для набора ID (одинаковые наборы грузятся один раз)
+def profiles_flight_key(profile_ids: List[int]) -> str:
+    digest = hashlib.sha1(",".join(map(str, sorted(profile_ids))).encode()).hexdigest()
+    return f"profiles:{digest}"
+
+
+# Пакетное получение профилей: один MGET, одна выборка из БД по промахам, запись промахов обратно в кэш
+async def hydrate_profiles(profile_ids: List, client: Optional[redis.Redis] = None) -> List[dict]:
+    """
+    Возвращает профили в порядке profile_ids. Отсутствующие и в кэше, и в БД пропускаются.
+    Промахи грузит из БД один исполнитель (single-flight), профили с истекающим TTL
+    отдаются сразу и обновляются в фоне.
+
+    :param profile_ids: ID профилей (числа или строки из Redis).
+    :param client: Клиент Redis без decode_responses (по умолчанию - бинарный клиент модуля).
+    :return: Список профилей.
+    """
+    client = client or redis_binary_client
+    ids = [int(profile_id) for profile_id in profile_ids]
+    if not ids:
+        return []
+
+    found: Dict[int, dict] = {}
+    missing_ids = []
+    stale_ids = []
+
+    # Сначала локальный кэш процесса, в Redis идем только за недостающими
+    redis_ids = []
+    for profile_id in ids:
+        local_value = local_cache.get(f"{PROFILE_KEY_PREFIX}{profile_id}")
+        if local_value is MISS:
+            redis_ids.append(profile_id)
+        else:
+            found[profile_id] = local_value
+
+    if redis_ids:
+        # Значения и оставшееся время жизни - за один проход
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.mget([f"{PROFILE_KEY_PREFIX}{profile_id}" for profile_id in redis_ids])
+            for profile_id in redis_ids:
+                pipe.pttl(f"{PROFILE_KEY_PREFIX}{profile_id}")
+            cached_values, *ttls = await pipe.execute()
+    else:
+        cached_values, ttls = [], []
+
+    for profile_id, cached_value, ttl_ms in zip(redis_ids, cached_values, ttls):
+        if cached_value:
+            try:
+                found[profile_id] = decode_value(cached_value)
+                local_cache.set(f"{PROFILE_KEY_PREFIX}{profile_id}", found[profile_id], len(cached_value), LOCAL_CACHE_PROFILE_TTL_SEK)
+                if 0 <= ttl_ms < CACHE_PROFILES_STALE_SEK * 1000:
+                    stale_ids.append(profile_id)
+                continue
+            except CodecError as e:
+                logger.error(f"Ошибка при декодировании профиля {profile_id}: {str(e)}")
+        missing_ids.append(profile_id)
+
+    if stale_ids:
+        refresh_in_background(client, profiles_flight_key(stale_ids), lambda: load_profiles_into_cache(stale_ids, client))
+
+    if missing_ids:
+        missing_ids = list(dict.fromkeys(missing_ids))
+        profiles_from_db = await single_flight(
+            client, profiles_flight_key(missing_ids), lambda: load_profiles_into_cache(missing_ids, client)
+        )
+        for profile_data in profiles_from_db:
+            found[profile_data["id"]] = profile_data
+
+        logger.info(f"Гидратация профилей: в кэше {len(ids) - len(missing_ids)}, из БД {len(profiles_from_db)}, не найдено {len(missing_ids) - len(profiles_from_db)}.")
+
+    return [found[profile_id] for profile_id in ids if profile_id in found]
+
+
+# ПОИСК ПРОФИЛЯ ПО КОШЕЛЬКУ, ИМЕНИ И ССЫЛКЕ
+
+# Ключ поиска (имя - без учета регистра, как lower(name) в БД)
+def lookup_key(kind: str, value: str) -> str:
+    if kind == "name":
+        value = value.lower()
+    return f"{LOOKUP_KEY_PREFIX}{kind}:{value}"
+
+
+# ID профилей по ключу поиска: из кэша, при промахе - loader из БД (один на ключ), пустой результат кэшируется коротко
+async def lookup_profile_ids(kind: str, value: str, loader: Callable[[], Awaitable[List[int]]]) -> List[int]:
+    key = lookup_key(kind, value)
+    cached = await redis_client.get(key)
+    if cached is not None:
+        return [int(profile_id) for profile_id in cached.split(",") if profile_id]
+
+    async def load() -> List[int]:
+        profile_ids = list(await loader())
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.set(key, ",".join(str(profile_id) for profile_id in profile_ids),
+                     ex=LOOKUP_TTL_SEK if profile_ids else LOOKUP_NEGATIVE_TTL_SEK)
+            # Профиль помнит свои ключи поиска, чтобы при изменении сбросить их
+            for profile_id in profile_ids:
+                pipe.sadd(f"{PROFILE_LOOKUP_KEY_PREFIX}{profile_id}", key)
+                pipe.expire(f"{PROFILE_LOOKUP_KEY_PREFIX}{profile_id}", LOOKUP_TTL_SEK)
+            await pipe.execute()
+        return profile_ids
+
+    return await single_flight(redis_binary_client, key, load)
+
+
+# Обновление ключей поиска после изменения профиля (None - профиль удален)
+async def refresh_profile_lookups(profile_id: int, profile_data: Optional[dict]) -> None:
+    """
+    Старые ключи профиля (прежние имя и ссылка) и ключ нового имени сбрасываются - список тезок
+    соберется заново при следующем запросе. Кошелек и ссылка уникальны, их ключи записываются сразу
+    (заодно перекрывают отрицательную запись, если профиль искали до создания).
+    """
+    profile_lookup_key = f"{PROFILE_LOOKUP_KEY_PREFIX}{profile_id}"
+    stale_keys = set(await redis_client.smembers(profile_lookup_key))
+
+    new_keys = {}
+    if profile_data:
+        stale_keys.add(lookup_key("name", profile_data["name"]))
+        wallet_number = (profile_data.get("user") or {}).get("wallet_number")
+        if wallet_number:
+            new_keys[lookup_key("wallet", wallet_number)] = profile_id
+        if profile_data.get("user_link"):
+            new_keys[lookup_key("link", profile_data["user_link"])] = profile_id
+
+    async with redis_client.pipeline(transaction=True) as pipe:
+        if stale_keys:
+            pipe.delete(*stale_keys)
+        pipe.delete(profile_lookup_key)
+        for key, value in new_keys.items():
+            pipe.set(key, value, ex=LOOKUP_TTL_SEK)
+        if new_keys:
+            pipe.sadd(profile_lookup_key, *new_keys)
+            pipe.expire(profile_lookup_key, LOOKUP_TTL_SEK)
+        await pipe.execute()
+
+
+# ОБНОВЛЕНИЕ КЭША ПРИ ИЗМЕНЕНИИ ПРОФИЛЯ
+
+# Хук изменения профиля: вызывается каждым путем записи после коммита
+async def on_profile_changed(profile_id: int) -> None:
+    """
+    Точечно обновляет кэш одного профиля вместо полной пересборки:
+    - заново сериализует профиль в profile:{id} и сбрасывает его локальные копии во всех процессах;
+    - обновляет индексы новизны, популярности, хэштегов, фасетов, оценку в смешанной ленте и ключи поиска;
+    - сбрасывает кэш готовых ответов списков (новая версия);
+    - если профиль появился или исчез из кэша, в фоне пересобирает только страницы из feed:mixed
+      (без обращения к БД, под той же арендой, что и полная пересборка).
+    Удаленный профиль убирается из кэша и индексов.
+
+    Ошибки только логируются: сохранение в БД уже прошло, кэш догонит плановая пересборка.
+    """
+    try:
+        async with get_db_session_for_worker() as session:
+            result = await session.execute(
+                select(UserProfiles)
+                .where(UserProfiles.id == profile_id)
+                .options(
+                    selectinload(UserProfiles.profile_hashtags).selectinload(ProfileHashtag.hashtag),
+                    selectinload(UserProfiles.user)
+                )
+            )
+            profile = result.scalars().first()
+
+        if profile is None:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.delete(f"{PROFILE_KEY_PREFIX}{profile_id}")
+                pipe.srem(CACHED_PROFILES_INDEX_KEY, profile_id)
+                pipe.zrem("profiles:newest", profile_id)
+                pipe.zrem("profiles:popularity", profile_id)
+                pipe.zrem(FEED_MIXED_KEY, profile_id)
+                membership_changed = (await pipe.execute())[1]
+            await remove_profile_hashtags(redis_client, profile_id)
+            await remove_profile_facets(redis_client, profile_id)
+            await refresh_profile_lookups(profile_id, None)
+        else:
+            profile_data = build_profile_cache_data(profile)
+            await redis_binary_client.setex(
+                f"{PROFILE_KEY_PREFIX}{profile.id}", jittered_ttl(CACHE_PROFILES_TTL_SEK), encode_value(profile_data)
+            )
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.sadd(CACHED_PROFILES_INDEX_KEY, profile.id)
+                if profile.created_at:
+                    pipe.zadd("profiles:newest", {profile.id: int(profile.created_at.timestamp())})
+                # Популярность ведут скрипты избранного - только засеваем новые профили
+                if profile.followers_count:
+                    pipe.zadd("profiles:popularity", {profile.id: profile.followers_count}, nx=True)
+                pipe.set(f"subscribers_count:{profile.id}", profile.followers_count or 0, nx=True)
+                pipe.get(f"subscribers_count:{profile.id}")
+                results = await pipe.execute()
+            membership_changed, live_count = results[0], results[-1]
+
+            # Место в смешанной ленте - сразу, без ожидания плановой пересборки
+            if profile.created_at:
+                await redis_client.zadd(FEED_MIXED_KEY, {
+                    profile.id: profile_mixed_feed_score(profile_data, profile.created_at, int(live_count or 0))
+                })
+
+            await index_profile_hashtags(
+                redis_client, profile.id, profile_data["hashtags"], profile.created_at,
+                profile.followers_count or 0, not profile.is_incognito
+            )
+            await index_profile_facets(redis_client, profile.id, profile_data)
+            await refresh_profile_lookups(profile.id, profile_data)
+
+        await publish_invalidation(redis_client, [f"{PROFILE_KEY_PREFIX}{profile_id}"])
+        await bump_response_cache_version(redis_client)
+
+        if membership_changed:
+            trigger_pages_rebuild(redis_client)
+
+        logger.info(f"Кэш профиля {profile_id} обновлен после изменения.")
+
+    except Exception as e:
+        logger.error(f"Не удалось обновить кэш профиля {profile_id}: {e}")
+
+
+# Страница сортированного множества по убыванию оценки: по смещению или по курсору (граница оценки)
+async def read_sorted_set_page(
+    client: redis.Redis, key: str, cursor_kind: str, offset: int, per_page: int, cursor: Optional[str] = None
+) -> Tuple[List[Tuple[str, float]], Optional[str]]:
+    """
+    Курсор: оценка и id последнего профиля + сколько профилей с этой же оценкой уже отдано
+    (у равных оценок нет другого порядка, кроме позиции внутри группы).
+
+    :return: ([(id, оценка), ...], курсор следующей страницы или None, если страница последняя).
+    """
+    if cursor:
+        last_score, _, ties = decode_cursor(cursor, cursor_kind, float, int, int)
+        rows = await client.zrevrangebyscore(key, last_score, "-inf", start=ties, num=per_page, withscores=True)
+    else:
+        last_score, ties = None, 0
+        rows = await client.zrevrange(key, offset, offset + per_page - 1, withscores=True)
+
+    next_cursor = None
+    if len(rows) == per_page:
+        page_last_score = rows[-1][1]
+        same_score = 0
+        for _, score in reversed(rows):
+            if score != page_last_score:
+                break
+            same_score += 1
+        if page_last_score == last_score:
+            same_score += ties
+        next_cursor = encode_cursor(cursor_kind, page_last_score, int(rows[-1][0]), same_score)
+
+    return rows, next_cursor
+
+
+# Курсор смешанной ленты, указывающий сразу за профилем (формат read_sorted_set_page)
+async def feed_cursor_after(client: redis.Redis, profile_id: int) -> Optional[str]:
+    """
+    Оценки в ленте могут совпадать (время создания - целые секунды, профили одной транзакции),
+    поэтому в курсор идет позиция профиля среди равных ему по оценке: его ранг минус число профилей
+    с оценкой строго выше.
+
+    :return: Курсор или None, если профиля уже нет в ленте.
+    """
+    async with client.pipeline(transaction=True) as pipe:
+        pipe.zscore(FEED_MIXED_KEY, profile_id)
+        pipe.zrevrank(FEED_MIXED_KEY, profile_id)
+        last_score, rank = await pipe.execute()
+    if last_score is None or rank is None:
+        return None
+
+    higher_count = await client.zcount(FEED_MIXED_KEY, f"({last_score}", "+inf")
+    return encode_cursor(FEED_MIXED_KEY, last_score, profile_id, rank - higher_count + 1)
+
+
+# Страница смешанной ленты без профилей, которые пользователь уже видел (фильтр просмотренных)
+async def read_unseen_feed_page(user_id: int, cursor: Optional[str] = None) -> Tuple[List[int], Optional[str]]:
+    """
+    Читает feed:mixed с курсора ровно столько, сколько не хватает до страницы, и пропускает просмотренные -
+    курсор следующей страницы стоит сразу за последним прочитанным профилем, ничего не теряется.
+    За запрос читается не больше SEEN_FEED_MAX_READS пачек: если все они просмотрены, страница будет
+    неполной или пустой, но с курсором - клиент листает дальше.
+    Фильтр сбрасывается, только если чтение дошло до конца ленты и не нашло ни одного непросмотренного
+    профиля - с курсором или без: листая по курсору от начала, пользователь либо получил каждый профиль,
+    либо уже видел его. Тогда лента начинается заново с первой страницы (иначе после полного просмотра
+    большой ленты он получал бы пустые страницы, пока фильтр не истечет).
+
+    :return: (ID профилей страницы, курсор следующей страницы).
+    """
+    profile_ids, next_cursor = [], cursor
+    for _ in range(SEEN_FEED_MAX_READS):
+        needed = PAGE_SIZE - len(profile_ids)
+        rows, next_cursor = await read_sorted_set_page(redis_client, FEED_MIXED_KEY, FEED_MIXED_KEY, 0, needed, next_cursor)
+        profile_ids += await filter_unseen(redis_client, user_id, [int(member) for member, _ in rows])
+        if len(profile_ids) >= PAGE_SIZE or next_cursor is None:
+            break
+
+    if not profile_ids and next_cursor is None and await redis_client.zcard(FEED_MIXED_KEY):
+        logger.info(f"Пользователь {user_id} просмотрел всю ленту, фильтр просмотренных сброшен.")
+        await reset_seen(redis_client, user_id)
+        rows, next_cursor = await read_sorted_set_page(redis_client, FEED_MIXED_KEY, FEED_MIXED_KEY, 0, PAGE_SIZE)
+        profile_ids = [int(member) for member, _ in rows]
+
+    return profile_ids, next_cursor
+
+
 # Получение профилей по хэштегам с кэшированием и сортировкой
 async def get_profiles_by_hashtag(
-    hashtag: str, page: int, per_page: int, sort_by: Optional[str]
+    hashtag: str, page: int, per_page: int, sort_by: Optional[str], cursor: Optional[str] = None
 ):
     """
-    Получает профили пользователей по хэштегу с кэшированием, сортировкой и пагинацией.
+    Получает профили пользователей по хэштегу из обратного индекса в Redis с сортировкой и пагинацией.
 
     Параметры:
         hashtag (str): Хэштег для поиска (с решеткой или без).
@@ -400,231 +1243,239 @@ async def get_profiles_by_hashtag(
         sort_by (Optional[str]): Тип сортировки:
             - "newest": По дате создания (новые сначала).
             - "popularity": По количеству подписчиков (популярные сначала).
+        cursor (Optional[str]): Курсор следующей страницы из прошлого ответа (граница по оценке вместо смещения).
 
     Возвращает:
-        dict: Данные о профилях и пагинации.
+        dict: Данные о профилях, пагинации и next_cursor.
 
     Исключения:
         HTTPException: При ошибке запроса к базе данных или Redis.
     """
-    # Убираем решетку и приводим к нижнему регистру сразу при получении хэштега
-    normalized_hashtag = hashtag.lstrip("#").lower()
+    # Нормализуем хэштег так же, как при сохранении профиля
+    normalized_hashtag = normalize_tag(hashtag)
 
-    # Формируем ключ для кэша
-    cache_key = f"profiles_hashtag_{normalized_hashtag}_page_{page}_per_page_{per_page}_sort_{sort_by}"
+    try:
+        # Профили с хэштегом лежат в обратном индексе tag:{name}:{sort}, без сортировки - по новизне
+        index_key = tag_index_key(normalized_hashtag, sort_by or "newest")
 
-    # Проверка наличия данных в кэше
-    cached_data = await redis_client.get(cache_key)
-    if cached_data:
-        logger.info(f"Данные найдены в кэше для ключа {cache_key}.")
-        return json.loads(cached_data)
+        total = await redis_client.zcard(index_key)
+        total_pages = (total + per_page - 1) // per_page
 
-    try:
-        async with get_db_session_for_worker() as db:
-            # Запрос к БД с поиском по точному совпадению нормализованного хэштега
-            query = (
-                select(UserProfiles)
-                .join(UserProfiles.profile_hashtags)
-                .join(ProfileHashtag.hashtag)
-                .filter(
-                    Hashtag.tag == normalized_hashtag,
-                    UserProfiles.is_incognito == False,
-                )
-                .options(
-                    selectinload(UserProfiles.profile_hashtags).selectinload(ProfileHashtag.hashtag),
-                    selectinload(UserProfiles.user)  # Добавляем загрузку пользователя
-                )
-            )
+        offset = (page - 1) * per_page
+        cursor_kind = f"hashtag:{normalized_hashtag}:{sort_by or 'newest'}"
 
-            # Применяем сортировку
-            if sort_by == "newest":
-                query = query.order_by(desc(UserProfiles.created_at))
-            elif sort_by == "popularity":
-                query = query.order_by(desc(UserProfiles.followers_count))
-
-            # Пагинация
-            offset = (page - 1) * per_page
-            query = query.offset(offset).limit(per_page)
-
-            # Выполняем запрос
-            result = await db.execute(query)
-            profiles = result.scalars().all()
-
-            logger.info(f"Найдено профилей: {len(profiles)}")
-
-            # Получаем общее количество профилей
-            total_query = (
-                select(func.count())
-                .select_from(UserProfiles)
-                .join(UserProfiles.profile_hashtags)
-                .join(ProfileHashtag.hashtag)
-                .filter(
-                    Hashtag.tag == normalized_hashtag,
-                    UserProfiles.is_incognito == False,
-                )
-            )
-            total = (await db.execute(total_query)).scalar()
+        rows, next_cursor = await read_sorted_set_page(redis_client, index_key, cursor_kind, offset, per_page, cursor)
 
-            logger.info(f"Общее количество профилей: {total}")
+        # Данные профилей - одним MGET, промахи - одной выборкой из БД
+        profiles_data = await hydrate_profiles([member for member, _ in rows])
 
-            # Рассчитываем общее количество страниц
-            total_pages = (total + per_page - 1) // per_page
+        logger.info(f"Найдено профилей: {len(profiles_data)}, всего по хэштегу {normalized_hashtag}: {total}")
 
-            # Формируем сообщение о пагинации
-            if total == 0:
-                message = "Нет профилей для отображения."
+        # Формируем сообщение о пагинации (по курсору номер страницы и диапазон неизвестны)
+        if cursor:
+            message = cursor_page_message(len(profiles_data), total, next_cursor)
+        elif total == 0:
+            message = "Нет профилей для отображения."
+        else:
+            start_index = offset + 1
+            end_index = min(page * per_page, total)
+            if start_index > end_index:
+                message = "Нет профилей для отображения на этой странице."
             else:
-                start_index = (page - 1) * per_page + 1
-                end_index = min(page * per_page, total)
-                if start_index > end_index:
-                    message = "Нет профилей для отображения на этой странице."
-                else:
-                    message = f"Показаны профили {start_index}-{end_index} из {total}."
+                message = f"Показаны профили {start_index}-{end_index} из {total}."
 
             # Проверяем, является ли текущая страница последней и неполной
             is_last_page = page == total_pages
-            is_incomplete_page = len(profiles) < per_page
+            is_incomplete_page = len(profiles_data) < per_page
 
             if is_last_page and is_incomplete_page:
                 message += " Это последняя страница. Начните просмотр профилей со страницы номер 1."
 
-            # Формируем данные профилей для ответа
-            profiles_data = [
-                {
-                    "id": profile.id,
-                    "name": profile.name,
-                    "user_logo_url": profile.user_logo_url,
-                    "video_url": profile.video_url,
-                    "preview_url": profile.preview_url,
-                    "poster_url": profile.poster_url,
-                    "activity_and_hobbies": profile.activity_and_hobbies,
-                    "is_moderated": profile.is_moderated,
-                    "is_incognito": profile.is_incognito,
-                    "is_in_mlm": profile.is_in_mlm,
-                    "adress": [profile.adress] if profile.adress else [],  # Преобразуем в список
-                    "city": profile.city,
-                    "coordinates": await process_coordinates_for_response(profile.coordinates),
-                    "followers_count": profile.followers_count,
-                    "created_at": await datetime_to_str(profile.created_at),
-                    "hashtags": [ph.hashtag.tag for ph in profile.profile_hashtags],
-                    "website_or_social": profile.website_or_social,
-                    "is_admin": profile.is_admin,
-                    "language": profile.language,
-                    "user_link": profile.user_link,
-                    "user": {  # Добавляем информацию о пользователе
-                        "id": profile.user.id,
-                        "wallet_number": profile.user.wallet_number
-                    }
-                }
-                for profile in profiles
-            ]
+        return {
+            "theme": "Макс, это для тебя корешок ^^",
+            "page_number": None if cursor else page,
+            "total_profiles": total,
+            "total_pages": total_pages,
+            "message": message,
+            "profiles": profiles_data,
+            "next_cursor": next_cursor,
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка получения профилей по хэштегу {hashtag}: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка сервера при получении профилей.")
 
-            # Формируем ответ
-            response_data = {
-                "theme": "Макс, это для тебя корешок ^^",
-                "page_number": page,
-                "total_profiles": total,
-                "total_pages": total_pages,
-                "message": message,
-                "profiles": profiles_data,
-            }
 
-            # Сохраняем данные в кэш с TTL в 2 часа
-            await redis_client.setex(cache_key, timedelta(hours=2), json.dumps(response_data))
-            logger.info(f"Данные сохранены в кэш для ключа {cache_key}.")
+# Случайная выдача с сидом на сессию: перестановка списка ID без сортировки и без повторов между страницами
+async def get_discovery_page(page: int, per_page: int, token: Optional[str] = None, user_id: Optional[int] = None) -> Dict:
+    """
+    Список - profiles:newest по возрастанию (новые профили добавляются в конец и не сдвигают позиции),
+    позиции страницы считает перестановка по сиду сессии (discovery.py), профили берутся одним
+    пайплайном ZRANGE по позициям и гидратацией. Удаление профиля во время сессии сдвигает позиции
+    (см. discovery.py) - на стыке страниц возможен одиночный повтор или пропуск.
+
+    :param token: Токен сессии из прошлого ответа (None - новая сессия с новым сидом).
+    :param user_id: Пользователь, для которого пропускаются уже просмотренные профили (страница может быть короче).
+    :return: Страница профилей и discovery_token для следующих страниц.
+    """
+    try:
+        if not token:
+            token = new_discovery_token(await redis_client.zcard("profiles:newest"))
+        seed, total = parse_discovery_token(token)
+
+        positions = permuted_positions(seed, total, (page - 1) * per_page, per_page)
+        profile_ids = []
+        if positions:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for position in positions:
+                    pipe.zrange("profiles:newest", position, position)
+                profile_ids = [members[0] for members in await pipe.execute() if members]  # Позиции за концом - удаленные профили
+
+        if user_id:
+            profile_ids = await filter_unseen(redis_client, user_id, profile_ids)
+
+        profiles = await hydrate_profiles(profile_ids)
+        total_pages = ceil(total / per_page)
+
+        if user_id:
+            await mark_seen(redis_client, user_id, [profile["id"] for profile in profiles])
+
+        if not positions:
+            message = "Профили просмотрены. Начните новую сессию без токена."
+        elif not profiles:
+            message = "Все профили этой страницы уже просмотрены, запросите следующую."
+        else:
+            message = f"Показаны профили {(page - 1) * per_page + 1}-{(page - 1) * per_page + len(positions)} из {total}."
 
-            return response_data
+        return {
+            "theme": "Макс, это для тебя корешок ^^",
+            "page_number": page,
+            "total_profiles": total,
+            "total_pages": total_pages,
+            "message": message,
+            "profiles": profiles,
+            "discovery_token": token,
+        }
 
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Ошибка получения профилей по хэштегу {hashtag}: {e}")
+        logger.error(f"Ошибка случайной выдачи профилей (страница {page}): {e}")
         raise HTTPException(status_code=500, detail="Ошибка сервера при получении профилей.")
 
 
+# Фильтрация профилей по фасетам (город, язык, МЛМ, наличие видео) без обращения к БД
+async def query_profiles_by_facets(
+    filters: Dict[str, object],
+    page: int,
+    per_page: int,
+    sort_by: Optional[str] = None,
+    include_hidden: bool = False
+) -> dict:
+    """
+    Пересекает множества фасетов с индексом новизны (ZINTERSTORE), для популярности дополнительно
+    подмешивает рейтинг. Результат пересечения кэшируется на FACET_QUERY_TTL_SEK для одинаковых запросов.
+
+    :param filters: {признак: значение} (city, language, is_in_mlm, has_video, moderated), None-значения пропускаются.
+    :param sort_by: newest (по умолчанию) или popularity.
+    :param include_hidden: Учитывать скрытые (инкогнито) профили - по умолчанию они исключаются всегда,
+        независимо от фильтров. Модерация - обычный фильтр moderated: без него в выдаче и прошедшие модерацию,
+        и ожидающие ее профили (как в остальных списках, отклоненные модерацией профили становятся скрытыми).
+    :return: Страница профилей, пагинация и количество профилей по значениям признаков (facets).
+    """
+    facet_keys = sorted(facet_key(dimension, value) for dimension, value in filters.items() if value is not None)
+    if not include_hidden:
+        facet_keys.append(facet_key("visible", True))
+
+    # Ключ результата по набору фасетов и сортировке
+    digest = hashlib.sha1("|".join(facet_keys).encode()).hexdigest()
+    base_key = f"{FACET_QUERY_KEY_PREFIX}{digest}:newest"  # Оценка - время создания
+    result_key = f"{FACET_QUERY_KEY_PREFIX}{digest}:{sort_by or 'newest'}"
+
+    try:
+        # Базовое пересечение нужно и для подсчета фасетов - пересобираем, если истек любой из ключей
+        query_keys = {base_key, result_key}
+        if await redis_client.exists(*query_keys) < len(query_keys):
+            async with redis_client.pipeline(transaction=True) as pipe:
+                # Множества фасетов дают оценку 0, индекс новизны - время создания
+                weights = {key: 0 for key in facet_keys}
+                weights["profiles:newest"] = 1
+                pipe.zinterstore(base_key, weights)
+                pipe.expire(base_key, FACET_QUERY_TTL_SEK)
+
+                if sort_by == "popularity":
+                    # В рейтинге только профили с подписчиками: объединяем с базой (остальные получают 0)
+                    # и снова пересекаем с базой, чтобы не добавить лишних
+                    pipe.zunionstore(result_key, {base_key: 0, "profiles:popularity": 1})
+                    pipe.zinterstore(result_key, {result_key: 1, base_key: 0})
+                    pipe.expire(result_key, FACET_QUERY_TTL_SEK)
+                await pipe.execute()
+
+        total = await redis_client.zcard(result_key)
+        total_pages = (total + per_page - 1) // per_page
+        offset = (page - 1) * per_page
+        profile_ids = await redis_client.zrevrange(result_key, offset, offset + per_page - 1) if offset < total else []
+
+        profiles_data = await hydrate_profiles(profile_ids)
+
+        # Количество профилей результата по каждому значению признаков
+        dimension_values = {}
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for dimension in FACET_COUNT_DIMENSIONS:
+                pipe.smembers(f"{FACET_VALUES_KEY_PREFIX}{dimension}")
+            for dimension, values in zip(FACET_COUNT_DIMENSIONS, await pipe.execute()):
+                dimension_values[dimension] = sorted(values)
+
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for dimension, values in dimension_values.items():
+                for value in values:
+                    pipe.zintercard(2, [base_key, facet_key(dimension, value)])
+            counts = iter(await pipe.execute())
+
+        facets = {}
+        for dimension, values in dimension_values.items():
+            value_counts = {value: next(counts) for value in values}
+            facets[dimension] = dict(sorted(
+                ((value, count) for value, count in value_counts.items() if count),
+                key=lambda item: item[1],
+                reverse=True
+            ))
+
+        if total == 0:
+            message = "Нет профилей для отображения."
+        elif offset >= total:
+            message = "Нет профилей для отображения на этой странице."
+        else:
+            message = f"Показаны профили {offset + 1}-{min(page * per_page, total)} из {total}."
+
+        return {
+            "theme": "Макс, это для тебя корешок ^^",
+            "page_number": page,
+            "total_profiles": total,
+            "total_pages": total_pages,
+            "message": message,
+            "profiles": profiles_data,
+            "facets": facets,
+        }
+
+    except RedisError as e:
+        logger.error(f"Ошибка Redis при фильтрации профилей по фасетам {filters}: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка сервера при фильтрации профилей.")
+
+
 # Получение профилей по id
 async def get_profiles_by_ids(profile_ids: List[int]) -> List[dict]:
     """
-    Получает профили по их ID, сначала проверяя Redis, затем базу данных.
+    Получает профили по их ID (в том же порядке), сначала проверяя Redis, затем базу данных.
 
     :param profile_ids: Список ID профилей для поиска.
     :return: Список профилей в виде словарей.
     :raises HTTPException: Если произошла ошибка при получении данных.
     """
     try:
-        profiles_from_redis = []
-        missing_ids = []
-
-        # Шаг 1: Проверяем Redis
-        for profile_id in profile_ids:
-            profile_data = await redis_client.get(f"profile:{profile_id}")
-            if profile_data:
-                profiles_from_redis.append(json.loads(profile_data))  # Данные из Redis
-            else:
-                missing_ids.append(profile_id)  # Данных нет, добавляем в список для БД
-
-        # Лог: Сколько данных найдено в Redis
-        logger.info(f"Найдено {len(profiles_from_redis)} профилей в Redis. Отсутствует {len(missing_ids)} профилей.")
-
-        # Шаг 2: Если в Redis чего-то нет, лезем в БД
-        if missing_ids:
-            logger.info(f"Загружаем {len(missing_ids)} профилей из базы данных...")
-            async with get_db_session_for_worker() as session:
-                # Формируем запрос
-                query = (
-                    select(UserProfiles)
-                    .where(UserProfiles.id.in_(missing_ids))  # Ищем только недостающие
-                )
-                # Выполняем запрос
-                result = await session.execute(query)
-                profiles_from_db = result.scalars().all()  # Данные из БД
-
-                # Лог: Сколько профилей найдено в БД
-                logger.info(f"Найдено {len(profiles_from_db)} профилей в базе данных.")
-
-                # Если данные отсутствуют и в БД, возвращаем пустой список
-                if not profiles_from_db:
-                    logger.info(f"Профили с ID {missing_ids} отсутствуют в базе данных.")
-                    return profiles_from_redis
-
-                # Обрабатываем данные из БД
-                processed_profiles = []
-                for profile in profiles_from_db:
-                    profile_data = {
-                        "id": profile.id,
-                        "name": profile.name,
-                        "user_logo_url": profile.user_logo_url,
-                        "video_url": profile.video_url,
-                        "preview_url": profile.preview_url,
-                        "poster_url": profile.poster_url,
-                        "activity_and_hobbies": profile.activity_and_hobbies,
-                        "is_moderated": profile.is_moderated,
-                        "is_incognito": profile.is_incognito,
-                        "is_in_mlm": profile.is_in_mlm,
-                        "adress": profile.adress,
-                        "city": profile.city,
-                        "coordinates": profile.coordinates,
-                        "followers_count": profile.followers_count,
-                        "created_at": profile.created_at.isoformat(),
-                        "hashtags": [tag.tag for tag in profile.hashtags],
-                        "website_or_social": profile.website_or_social,
-                        "is_admin": profile.is_admin,
-                        "language": profile.language,
-                        "user_link": profile.user_link,
-                        "user": {
-                            "id": profile.user.id,
-                            "wallet_number": profile.user.wallet_number
-                        }
-                    }
-                    processed_profiles.append(profile_data)
-
-                # Лог: Данные загружены из БД
-                logger.info(f"Успешно загружено {len(processed_profiles)} профилей из базы данных.")
-
-            # Объединяем данные из Redis и БД
-            all_profiles = profiles_from_redis + processed_profiles
-            return all_profiles
-
-        # Если всё найдено в Redis, просто возвращаем
-        return profiles_from_redis
+        return await hydrate_profiles(profile_ids)
 
     except Exception as e:
         logger.error(f"Ошибка при получении профилей: {str(e)}")
@@ -685,6 +1536,7 @@ async def save_profile_to_db_without_video(
 
         # Если new_user_image == True, обрабатываем новое изображение
         user_logo_path = None
+        offloaded_logo_path = None  # Локальная копия логотипа, перенесенного в облако (удаляется после коммита)
         if new_user_image:
             try:
                 image_path = image_data.get("image_path")
@@ -712,6 +1564,12 @@ async def save_profile_to_db_without_video(
 
                 user_logo_path = user_logo_path.lstrip('.')
 
+                # Переносим логотип в облако (ключ по хэшу содержимого, кэш навсегда)
+                local_logo_path = user_logo_path
+                user_logo_path = await offload_media_file(user_logo_path, "logos", logger, remove_local=False)
+                if user_logo_path != local_logo_path:
+                    offloaded_logo_path = local_logo_path
+
             except Exception as e:
                 logger.error(f"Ошибка при извлечении путей из JSON: {str(e)}")
                 raise HTTPException(status_code=400, detail="Ошибка при извлечении путей из JSON.")
@@ -754,20 +1612,12 @@ async def save_profile_to_db_without_video(
 
                     # Удаление старого постера
                     if delete_video:
-                        # Удаляем видео и превью через delete_video_folder (папками)
+                        # Папки видео и превью ставим в очередь на удаление из облака (в этой же транзакции)
                         if profile.video_url:
-                            try:
-                                await delete_video_folder(profile.video_url, logger)
-                                logger.info(f"Папка видео удалена: {profile.video_url}")
-                            except Exception as e:
-                                logger.error(f"Ошибка удаления видео: {e}")
+                            await enqueue_storage_gc(session, profile.video_url, logger)
 
                         if profile.preview_url:
-                            try:
-                                await delete_video_folder(profile.preview_url, logger)
-                                logger.info(f"Папка превью удалена: {profile.preview_url}")
-                            except Exception as e:
-                                logger.error(f"Ошибка удаления превью: {e}")
+                            await enqueue_storage_gc(session, profile.preview_url, logger)
 
                         # Удаляем постер через delete_old_media_files (отдельный файл)
                         if profile.poster_url:
@@ -821,18 +1671,10 @@ async def save_profile_to_db_without_video(
 
                         # Удаляем старые файлы, если они не моки
                         if old_video_url and not old_video_url.startswith("https://stt-market-videos.s3.eu-north-1.amazonaws.com/videos/mock_video_"):
-                            try:
-                                await delete_video_folder(old_video_url, logger)
-                                logger.info(f"Видео удалено из облака: {old_video_url}")
-                            except Exception as e:
-                                logger.error(f"Ошибка удаления видео: {e}")
+                            await enqueue_storage_gc(session, old_video_url, logger)
 
                         if old_preview_url and not old_preview_url.startswith("https://stt-market-videos.s3.eu-north-1.amazonaws.com/videos/mock_video_"):
-                            try:
-                                await delete_video_folder(old_preview_url, logger)
-                                logger.info(f"Превью удалено из облака: {old_preview_url}")
-                            except Exception as e:
-                                logger.error(f"Ошибка удаления превью: {e}")
+                            await enqueue_storage_gc(session, old_preview_url, logger)
 
                         if old_poster_url and not old_poster_url.startswith("https://stt-market-videos.s3.eu-north-1.amazonaws.com/videos/mock_video_"):
                             try:
@@ -945,6 +1787,12 @@ async def save_profile_to_db_without_video(
 
                 await session.commit()
 
+                # В БД уже ссылка на облако - локальная копия логотипа больше не нужна
+                remove_local_media_files([offloaded_logo_path], logger)
+
+                # Кэш профиля и индексы обновляются сразу, не дожидаясь пересборки
+                await on_profile_changed(profile.id)
+
                 message = "Профиль успешно обновлен" if not is_new_profile else "Профиль успешно сохранен"
                 logger.info(f"{message}.")
                 return {
@@ -990,51 +1838,20 @@ async def save_profile_to_db_without_video(
 # Функция для формирования страниц из закешированных профилей по алгоритму
 async def create_pages_from_cached_profiles(redis_client: redis.Redis) -> Tuple[int, int]:
     """
-    Формирует страницы по 50 профилей из закешированных данных в Redis.
-    Учитываются только публичные профили (is_incognito=False).
-    Профили распределяются по страницам глобально, без привязки к пользователям.
+    Формирует страницы по 50 профилей в порядке смешанной ленты (feed:mixed).
+    Оценки ленты уже посчитаны при кэшировании профилей, поэтому профили здесь не читаются и не сортируются:
+    страницы - срез ленты на момент сборки (номера страниц не сдвигаются, пока клиент листает поколение).
+    Страница хранит только ID профилей, сами профили берутся из profile:{id} при чтении.
 
     :param redis_client: Клиент Redis.
     :return: Кортеж (общее количество профилей, общее количество страниц).
     """
     try:
-        # Получаем все закешированные профили из Redis
-        cached_profile_keys = await redis_client.keys("profile:*")
-        all_profiles = []
-        for key in cached_profile_keys:
-            profile_data = await redis_client.get(key)
-            if profile_data:
-                profile = json.loads(profile_data)
-                # Фильтруем только публичные профили
-                # if not profile.get("is_incognito", False):
-                #     all_profiles.append(profile)
-                all_profiles.append(profile)  # Добавляем все профили
-
-        # Разделяем профили на категории
-        popular_profiles = sorted(all_profiles, key=lambda x: x.get("followers_count", 0), reverse=True)[:10]
-        new_profiles = sorted(all_profiles, key=lambda x: x.get("created_at", ""), reverse=True)[:10]
-        mlm_profiles = [p for p in all_profiles if p.get("is_in_mlm", False)][:10]
-        random_profiles = random.sample(all_profiles, min(10, len(all_profiles)))
-        no_video_profiles = [p for p in all_profiles if not p.get("video_url")][:10]
-
-        # Объединяем профили в единый список без дубликатов
-        profiles_to_show = popular_profiles + new_profiles + mlm_profiles + random_profiles + no_video_profiles
-        unique_profiles = list({p["id"]: p for p in profiles_to_show}.values())
-        logger.info(f"Собрано уникальных профилей по алгоритму: {len(unique_profiles)}")
-
-        # Если уникальных профилей меньше 50, добавляем случайные из оставшихся
-        if len(unique_profiles) < 50:
-            remaining_profiles = [p for p in all_profiles if p["id"] not in {x["id"] for x in unique_profiles}]
-            if remaining_profiles:
-                logger.info(f"Добавляем {50 - len(unique_profiles)} случайных профилей из оставшихся.")
-                unique_profiles.extend(
-                    random.sample(remaining_profiles, min(50 - len(unique_profiles), len(remaining_profiles))))
-
-        # Теперь формируем страницы из всех профилей, а не только из уникальных по алгоритму
-        page_size = 50
-        pages = [all_profiles[i:i + page_size] for i in range(0, len(all_profiles), page_size)]
-        total_pages = ceil(len(all_profiles) / page_size)  # Округляем вверх
-        total_profiles = len(all_profiles)  # Общее количество профилей
+        profile_ids = [int(member) for member in await redis_client.zrevrange(FEED_MIXED_KEY, 0, -1)]
+
+        pages = [profile_ids[i:i + PAGE_SIZE] for i in range(0, len(profile_ids), PAGE_SIZE)]
+        total_pages = ceil(len(profile_ids) / PAGE_SIZE)  # Округляем вверх
+        total_profiles = len(profile_ids)  # Общее количество профилей
         logger.info(f"Сформировано страниц: {total_pages}")
 
         # Если страниц нет, завершаем выполнение
@@ -1042,20 +1859,35 @@ async def create_pages_from_cached_profiles(redis_client: redis.Redis) -> Tuple[
             logger.warning("Нет данных для формирования страниц.")
             return total_profiles, 0
 
-        # Кешируем страницы в Redis с TTL 12 часов
-        for page_number, page_profiles in enumerate(pages, start=1):
-            cache_key = f"page_{page_number}"
-            try:
-                await redis_client.setex(
-                    cache_key,
-                    CACHE_PROFILES_TTL_SEK,
-                    json.dumps(page_profiles)
-                )
-            except redis.RedisError as e:
-                logger.error(f"Ошибка Redis при кешировании страницы {page_number}: {str(e)}")
-                raise
-
-        logger.info(f"В кэше размещено {total_pages} страниц.")
+        # Пишем новое поколение целиком, и только потом переключаем указатель:
+        # читатели всегда видят согласованный набор страниц и итогов
+        generation = await redis_client.incr(PAGES_GENERATION_SEQ_KEY)
+        previous_generation = await redis_client.get(PAGES_GENERATION_KEY)
+        generation_ttl = jittered_ttl(CACHE_PROFILES_TTL_SEK)  # Общий для поколения: страницы истекают вместе с итогами
+
+        try:
+            async with redis_binary_client.pipeline(transaction=False) as pipe:
+                for page_number, page_profile_ids in enumerate(pages, start=1):
+                    pipe.setex(f"pages:{generation}:page_{page_number}", generation_ttl, encode_value(page_profile_ids))
+                meta_key = f"pages:{generation}:meta"
+                pipe.hset(meta_key, mapping={
+                    "total_profiles": total_profiles,
+                    "total_pages": total_pages,
+                    "built_at": int(time.time()),
+                })
+                pipe.expire(meta_key, generation_ttl)
+                pipe.set(PAGES_GENERATION_KEY, generation)
+                await pipe.execute()
+        except redis.RedisError as e:
+            logger.error(f"Ошибка Redis при кешировании поколения страниц {generation}: {str(e)}")
+            raise
+
+        # Прошлое поколение доживает немного, чтобы дочитать уже начатый просмотр
+        if previous_generation:
+            await expire_pages_generation(redis_client, previous_generation)
+        await bump_response_cache_version(redis_client)
+
+        logger.info(f"В кэше размещено {total_pages} страниц (поколение {generation}).")
         return total_profiles, total_pages
 
     except Exception as e:
@@ -1063,18 +1895,95 @@ async def create_pages_from_cached_profiles(redis_client: redis.Redis) -> Tuple[
         raise
 
 
+# Ограничиваем время жизни прошлого поколения страниц
+async def expire_pages_generation(redis_client: redis.Redis, generation) -> None:
+    meta_key = f"pages:{generation}:meta"
+    old_total_pages = await redis_client.hget(meta_key, "total_pages")
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for page_number in range(1, int(old_total_pages or 0) + 1):
+            pipe.expire(f"pages:{generation}:page_{page_number}", PAGES_OLD_GENERATION_TTL_SEK)
+        pipe.expire(meta_key, PAGES_OLD_GENERATION_TTL_SEK)
+        await pipe.execute()
+
+
+# Текущее поколение страниц и его итоги
+async def get_pages_generation(redis_client: redis.Redis) -> Optional[Dict]:
+    """
+    Возвращает текущее поколение страниц: {"generation", "total_profiles", "total_pages", "built_at"}
+    или None, если страницы еще не собраны.
+    """
+    generation = await redis_client.get(PAGES_GENERATION_KEY)
+    if not generation:
+        return None
+
+    meta = await redis_client.hgetall(f"pages:{generation}:meta")
+    if not meta:
+        return None
+
+    return {
+        "generation": generation,
+        "total_profiles": int(meta.get("total_profiles", 0)),
+        "total_pages": int(meta.get("total_pages", 0)),
+        "built_at": int(meta.get("built_at", 0)),
+    }
+
+
+# Пересборка кэша профилей и страниц под блокировкой (планировщик и фоновый запуск из запросов)
+async def refresh_profiles_cache(redis_client: redis.Redis) -> Optional[Tuple[int, int]]:
+    """
+    Запускает fetch_and_cache_profiles, если его не выполняет кто-то другой.
+
+    :return: (всего профилей, всего страниц) или None, если пересборка уже идет.
+    """
+    lease_token = await acquire_lease(redis_client, PAGES_REFRESH_FLIGHT_KEY, PAGES_REFRESH_LEASE_SEK)
+    if not lease_token:
+        logger.info("Пересборка кэша профилей уже выполняется, пропускаем.")
+        return None
+
+    try:
+        return await fetch_and_cache_profiles(redis_client)
+    finally:
+        await release_lease(redis_client, PAGES_REFRESH_FLIGHT_KEY, lease_token)
+
+
+# Фоновая пересборка без ожидания (запрос получает текущие страницы сразу, stale-while-revalidate)
+def trigger_profiles_cache_refresh(redis_client: redis.Redis) -> None:
+    refresh_in_background(
+        redis_client, PAGES_REFRESH_FLIGHT_KEY, lambda: fetch_and_cache_profiles(redis_client), PAGES_REFRESH_LEASE_SEK
+    )
+
+
+# Фоновая пересборка только страниц из смешанной ленты (профили и индексы уже в кэше)
+def trigger_pages_rebuild(redis_client: redis.Redis) -> None:
+    """ Если сейчас идет полная пересборка, она и так соберет страницы - тогда ничего не запускаем """
+    refresh_in_background(
+        redis_client, PAGES_REFRESH_FLIGHT_KEY, lambda: create_pages_from_cached_profiles(redis_client), PAGES_REFRESH_LEASE_SEK
+    )
+
+
 # Получение данных страницы из Редис
 async def get_page_data_from_cache(
     page_number: int,
     redis_client: redis.Redis,
     total_profiles: int,
-    total_pages: int
+    total_pages: int,
+    generation
 ) -> Dict:
     try:
-        cache_key = f"page_{page_number}"
-        page_profiles = await redis_client.get(cache_key)
+        cache_key = f"pages:{generation}:page_{page_number}"
+
+        # Список ID страницы поколения не меняется - держим его в локальном кэше процесса
+        profile_ids = local_cache.get(cache_key)
+        if profile_ids is MISS:
+            page_value = await redis_binary_client.get(cache_key)
+            profile_ids = decode_value(page_value) if page_value else None
+            if profile_ids is not None:
+                local_cache.set(cache_key, profile_ids, len(page_value), LOCAL_CACHE_PAGE_TTL_SEK)
 
-        if not page_profiles:
+        # Сами профили - из profile:{id} (локальный кэш, затем один MGET)
+        profiles = await hydrate_profiles(profile_ids) if profile_ids else []
+
+        if not profiles:
             return {
                 "theme": "Макс, это для тебя корешок ^^",
                 "page_number": page_number,
@@ -1084,13 +1993,10 @@ async def get_page_data_from_cache(
                 "profiles": [],
             }
 
-        await redis_client.expire(cache_key, CACHE_PROFILES_TTL_SEK)
-
-        profiles = json.loads(page_profiles)
         is_last_page = page_number == total_pages
-        is_incomplete_page = len(profiles) < 50
+        is_incomplete_page = len(profiles) < PAGE_SIZE
 
-        start_index = (page_number - 1) * 50 + 1
+        start_index = (page_number - 1) * PAGE_SIZE + 1
         end_index = min(start_index + len(profiles) - 1, total_profiles)  # Корректный конечный индекс
 
         message = f"Показаны профили {start_index}-{end_index} из {total_profiles}."
@@ -1122,128 +2028,146 @@ async def fetch_and_cache_profiles(redis_client: redis.Redis) -> tuple[int, int]
     После кеширования профилей формирует страницы.
     Запускается каждые 5 минут в фоновом процессе через планировщик.
 
+    Профили читаются потоком (серверный курсор, пачки по REFRESH_BATCH_SIZE) только нужными колонками,
+    хэштеги - одним запросом на пачку, запись в Redis - пайплайнами по REFRESH_PIPELINE_PROFILES профилей.
+    Память не зависит от числа профилей (кроме множества их ID), время - от числа строк, а не обращений к Redis.
+
     :param redis_client: Клиент Redis.
     :return: Кортеж (общее количество профилей, общее количество страниц).
     """
     try:
+        db_profile_ids: Set[int] = set()
+        processed_count = 0
+
         async with get_db_session_for_worker() as session:
-            # Формируем запрос с загрузкой хэштегов и данных пользователя
-            query = (
-                select(UserProfiles)
-                .options(
-                    selectinload(UserProfiles.profile_hashtags).selectinload(ProfileHashtag.hashtag),
-                    selectinload(UserProfiles.user)  # Загружаем данные о пользователе
-                )
+            result = await session.stream(
+                select(*PROFILE_CACHE_COLUMNS)
+                .join(User, UserProfiles.user_id == User.id)
+                .execution_options(yield_per=REFRESH_BATCH_SIZE)
             )
+            async for rows in result.partitions():
+                db_profile_ids.update(row.id for row in rows)
+                processed_count += await cache_profiles_batch(redis_client, rows)
+
+        if not db_profile_ids:
+            logger.info("Нет профилей для кэширования.")
+            return 0, 0
+
+        # Получаем ID закэшированных профилей из индекса (SSCAN вместо KEYS)
+        await bootstrap_index(redis_client, CACHED_PROFILES_INDEX_KEY)
+        cached_profile_ids = await get_index_ids(redis_client, CACHED_PROFILES_INDEX_KEY)
+
+        # Находим профили, которые нужно удалить из Redis
+        profiles_to_delete = cached_profile_ids - db_profile_ids
+        if profiles_to_delete:
+            logger.info(f"Найдено {len(profiles_to_delete)} профилей для удаления из Redis.")
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for profile_id in profiles_to_delete:
+                    pipe.delete(f"{PROFILE_KEY_PREFIX}{profile_id}")
+                    pipe.zrem("profiles:newest", profile_id)
+                    pipe.zrem("profiles:popularity", profile_id)
+                    pipe.zrem(FEED_MIXED_KEY, profile_id)
+                await pipe.execute()
+            for profile_id in profiles_to_delete:
+                await remove_profile_hashtags(redis_client, profile_id)
+                await remove_profile_facets(redis_client, profile_id)
+            await prune_index(redis_client, CACHED_PROFILES_INDEX_KEY, list(profiles_to_delete))
+            logger.info(f"Удалено {len(profiles_to_delete)} профилей из Redis.")
+
+        logger.info(f"Успешно обработано и закэшировано {processed_count} профилей в Redis.")
+
+        # Профили перезаписаны - сбрасываем их локальные копии во всех процессах
+        await publish_invalidation(redis_client, [f"{PROFILE_KEY_PREFIX}*"])
+
+        # После кеширования профилей формируем страницы
+        total_profiles, total_pages = await create_pages_from_cached_profiles(redis_client)
+        logger.info(f"Сформировано и закэшировано {total_pages} страниц из {total_profiles} профилей.")
 
-            # Выполняем запрос
-            result = await session.execute(query)
-            profiles = result.scalars().all()
+        return total_profiles, total_pages
 
-            if not profiles:
-                logger.info("Нет профилей для кэширования.")
-                return 0, 0
+    except Exception as e:
+        logger.error(f"Ошибка при выполнении запроса и кэшировании профилей: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Ошибка при выполнении запроса и кэшировании профилей."
+        )
 
-            # Получаем список ID профилей из базы данных
-            db_profile_ids = {profile.id for profile in profiles}
 
-            # Получаем текущие ключи профилей из Redis
-            cached_profile_keys = await redis_client.keys("profile:*")
-            cached_profile_ids = {int(key.split(":")[1]) for key in cached_profile_keys}
+# Кэширование пачки профилей (строки выборки PROFILE_CACHE_COLUMNS) пайплайнами
+async def cache_profiles_batch(redis_client: redis.Redis, rows) -> int:
+    """
+    На пачку: один запрос хэштегов в БД и одно чтение из Redis (прежние хэштеги и фасеты, живые счетчики),
+    затем запись пайплайнами по REFRESH_PIPELINE_PROFILES профилей.
 
-            # Находим профили, которые нужно удалить из Redis
-            profiles_to_delete = cached_profile_ids - db_profile_ids
-            if profiles_to_delete:
-                logger.info(f"Найдено {len(profiles_to_delete)} профилей для удаления из Redis.")
-                for profile_id in profiles_to_delete:
-                    await redis_client.delete(f"profile:{profile_id}")
-                    await redis_client.zrem("profiles:newest", profile_id)
-                    await redis_client.zrem("profiles:popularity", profile_id)
-                logger.info(f"Удалено {len(profiles_to_delete)} профилей из Redis.")
-
-            # Обрабатываем профили
-            processed_count = 0
-            for profile in profiles:
+    :return: Сколько профилей закэшировано.
+    """
+    profile_ids = [row.id for row in rows]
+
+    # Хэштеги пачки (отдельная сессия: основная занята потоковым курсором)
+    hashtags: Dict[int, List[str]] = {profile_id: [] for profile_id in profile_ids}
+    async with get_db_session_for_worker() as session:
+        tag_rows = await session.execute(
+            select(ProfileHashtag.profile_id, Hashtag.tag)
+            .join(Hashtag, ProfileHashtag.hashtag_id == Hashtag.id)
+            .where(ProfileHashtag.profile_id.in_(profile_ids))
+        )
+        for profile_id, tag in tag_rows:
+            hashtags[profile_id].append(tag)
+
+    # Прежние хэштеги и фасеты профилей (чтобы снять их со старых значений) и живые счетчики подписчиков
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for profile_id in profile_ids:
+            pipe.smembers(f"{PROFILE_TAGS_KEY_PREFIX}{profile_id}")
+            pipe.smembers(f"{PROFILE_FACETS_KEY_PREFIX}{profile_id}")
+        pipe.mget([f"subscribers_count:{profile_id}" for profile_id in profile_ids])
+        *old_sets, live_counts = await pipe.execute()
+
+    cached_count = 0
+    for chunk_start in range(0, len(rows), REFRESH_PIPELINE_PROFILES):
+        chunk_ids = []
+        async with redis_binary_client.pipeline(transaction=False) as binary_pipe, \
+                redis_client.pipeline(transaction=False) as pipe:
+            for index in range(chunk_start, min(chunk_start + REFRESH_PIPELINE_PROFILES, len(rows))):
+                row = rows[index]
                 try:
-                    # Обрабатываем координаты
-                    coordinates = None
-                    if profile.coordinates:
-                        geometry = to_shape(profile.coordinates)  # Преобразуем WKB в Shapely
-                        if isinstance(geometry, Point):
-                            coordinates = {
-                                "longitude": float(geometry.x),
-                                "latitude": float(geometry.y),
-                            }
-                        elif isinstance(geometry, MultiPoint):
-                            first_point = list(geometry.geoms)[0]
-                            coordinates = {
-                                "longitude": float(first_point.x),
-                                "latitude": float(first_point.y),
-                            }
-
-                    # Получаем данные о пользователе
-                    user_data = {
-                        "id": profile.user.id if profile.user else None,
-                        "wallet_number": profile.user.wallet_number if profile.user else None,
-                    }
-
-                    # Формируем данные профиля
-                    profile_data = {
-                        "id": profile.id,
-                        "name": profile.name,
-                        "user_logo_url": profile.user_logo_url,
-                        "video_url": profile.video_url,
-                        "preview_url": profile.preview_url,
-                        "poster_url": profile.poster_url,
-                        "activity_and_hobbies": profile.activity_and_hobbies,
-                        "is_moderated": profile.is_moderated,
-                        "is_incognito": profile.is_incognito,
-                        "is_in_mlm": profile.is_in_mlm,
-                        "adress": profile.adress,
-                        "city": profile.city,
-                        "coordinates": coordinates,
-                        "followers_count": profile.followers_count,
-                        "created_at": profile.created_at.isoformat() if profile.created_at else None,
-                        "hashtags": [ph.hashtag.tag for ph in profile.profile_hashtags],
-                        "website_or_social": profile.website_or_social,
-                        "is_admin": profile.is_admin,
-                        "language": profile.language,
-                        "user_link": profile.user_link,
-                        "user": user_data,  # Добавлен блок данных о пользователе
-                    }
-
-                    # Кэшируем профиль в Redis под ключом `profile:{id}`
-                    await redis_client.setex(
-                        f"profile:{profile.id}",
-                        int(timedelta(seconds=CACHE_PROFILES_TTL_SEK).total_seconds()),  # Преобразуем часы в секунды
-                        json.dumps(profile_data, default=str)
+                    profile_data = profile_cache_data(row, hashtags[row.id], row.user_id, row.wallet_number)
+                    old_tags, old_facet_keys = old_sets[2 * index], old_sets[2 * index + 1]
+                    # Популярность - живое значение счетчика, если он уже есть в кэше
+                    live_count = live_counts[index]
+                    followers_count = max(int(live_count), 0) if live_count is not None else (row.followers_count or 0)
+
+                    # Кэшируем профиль в Redis под ключом `profile:{id}` (с разбросом TTL, чтобы профили не истекали одновременно)
+                    binary_pipe.setex(f"{PROFILE_KEY_PREFIX}{row.id}", jittered_ttl(CACHE_PROFILES_TTL_SEK), encode_value(profile_data))
+                    pipe.sadd(CACHED_PROFILES_INDEX_KEY, row.id)
+
+                    # Рейтинг популярности ведется в реальном времени скриптами избранного - здесь только
+                    # добавляем новые профили (NX) и засеваем счетчик значением из БД, если его нет в Redis
+                    if row.created_at:
+                        pipe.zadd("profiles:newest", {row.id: int(row.created_at.timestamp())})
+                    if row.followers_count:
+                        pipe.zadd("profiles:popularity", {row.id: row.followers_count}, nx=True)
+                    pipe.set(f"subscribers_count:{row.id}", row.followers_count or 0, nx=True)
+
+                    # Сверяем обратный индекс хэштегов и фасеты с БД, оценку в смешанной ленте
+                    queue_profile_hashtags(
+                        pipe, row.id, old_tags, profile_data["hashtags"], row.created_at, followers_count, not row.is_incognito
                     )
+                    queue_profile_facets(pipe, row.id, old_facet_keys, profile_facets(profile_data))
+                    if row.created_at:
+                        pipe.zadd(FEED_MIXED_KEY, {row.id: profile_mixed_feed_score(profile_data, row.created_at, followers_count)})
 
-                    # Добавляем профиль в Sorted Sets для сортировки
-                    if profile.created_at:
-                        created_at_timestamp = int(profile.created_at.timestamp())
-                        await redis_client.zadd("profiles:newest", {profile.id: created_at_timestamp})
-                    if profile.followers_count:
-                        await redis_client.zadd("profiles:popularity", {profile.id: profile.followers_count})
-
-                    processed_count += 1
+                    chunk_ids.append(row.id)
                 except Exception as e:
-                    logger.error(f"Ошибка при обработке профиля {profile.id}: {str(e)}")
+                    logger.error(f"Ошибка при обработке профиля {row.id}: {str(e)}")
 
-            logger.info(f"Успешно обработано и закэшировано {processed_count} профилей в Redis.")
-
-            # После кеширования профилей формируем страницы
-            total_profiles, total_pages = await create_pages_from_cached_profiles(redis_client)
-            logger.info(f"Сформировано и закэшировано {total_pages} страниц из {total_profiles} профилей.")
-
-            return total_profiles, total_pages
+            try:
+                await binary_pipe.execute()
+                await pipe.execute()
+                cached_count += len(chunk_ids)
+            except redis.RedisError as e:
+                logger.error(f"Ошибка Redis при кэшировании пачки профилей (первый ID {chunk_ids[0] if chunk_ids else None}): {str(e)}")
 
-    except Exception as e:
-        logger.error(f"Ошибка при выполнении запроса и кэшировании профилей: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Ошибка при выполнении запроса и кэшировании профилей."
-        )
+    return cached_count
 
 
 # Функция для получения данных страницы из Redis
@@ -1314,17 +2238,47 @@ async def fetch_and_cache_profiles(redis_client: redis.Redis) -> tuple[int, int]
 async def get_all_profiles_by_page(
     page: int = 1,  # Номер страницы
     sort_by: Optional[str] = None,  # Параметр сортировки (newest или popularity)
-    redis_client: redis.Redis = None  # Клиент Redis
+    redis_client: redis.Redis = None,  # Клиент Redis
+    cursor: Optional[str] = None,  # Курсор следующей страницы смешанной ленты
+    user_id: Optional[int] = None  # Авторизованный пользователь: лента без просмотренных профилей
 ) -> Dict:
     """
     Возвращает страницу с профилями, учитывая сортировку и пагинацию.
+    Без сортировки - смешанная лента: по номеру страницы из собранного поколения страниц,
+    по курсору - прямо из feed:mixed (одна выборка ZREVRANGEBYSCORE, без смещения).
 
     :param page: Номер страницы.
     :param sort_by: Параметр сортировки (newest или popularity).
     :param redis_client: Клиент Redis.
-    :return: Словарь с данными о профилях, включая пагинацию и общее количество.
+    :param cursor: Курсор из next_cursor прошлого ответа (только без сортировки).
+    :param user_id: Пользователь, для которого лента пропускает уже просмотренные профили (только без сортировки).
+    :return: Словарь с данными о профилях, включая пагинацию, общее количество и next_cursor.
     """
     try:
+        if not sort_by and (cursor or user_id):
+            total_profiles = await redis_client.zcard(FEED_MIXED_KEY)
+            if user_id:
+                profile_ids, next_cursor = await read_unseen_feed_page(user_id, cursor)
+            else:
+                rows, next_cursor = await read_sorted_set_page(redis_client, FEED_MIXED_KEY, FEED_MIXED_KEY, 0, PAGE_SIZE, cursor)
+                profile_ids = [member for member, _ in rows]
+            profiles = await hydrate_profiles(profile_ids)
+            if user_id:
+                await mark_seen(redis_client, user_id, [profile["id"] for profile in profiles])
+            return {
+                "theme": "Макс, это для тебя корешок ^^",  # Сообщение на фронт
+                "page_number": page,
+                "total_profiles": total_profiles,
+                "total_pages": ceil(total_profiles / PAGE_SIZE),
+                "message": (
+                    f"Показано {len(profiles)} профилей." if profiles
+                    else "Профили просмотрены. Начните с первой страницы." if next_cursor is None
+                    else "Все профили этой части ленты уже просмотрены, запросите следующую по next_cursor."
+                ),
+                "profiles": profiles,
+                "next_cursor": next_cursor,
+            }
+
         # Если передана сортировка, используем отсортированные списки
         if sort_by:
             sorted_set_key = f"profiles:{sort_by}"
@@ -1362,16 +2316,8 @@ async def get_all_profiles_by_page(
             # Получаем ID профилей из отсортированного списка
             profile_ids = await redis_client.zrange(sorted_set_key, offset, end)
 
-            # Получаем данные профилей по их ID
-            profiles = []
-            for profile_id in profile_ids:
-                profile_data = await redis_client.get(f"profile:{profile_id}")
-                if profile_data:
-                    try:
-                        profiles.append(json.loads(profile_data))
-                    except json.JSONDecodeError as e:
-                        logger.error(f"Ошибка при декодировании профиля {profile_id}: {str(e)}")
-                        continue
+            # Получаем данные профилей по их ID (один MGET, промахи - одной выборкой из БД)
+            profiles = await hydrate_profiles(profile_ids)
 
             # Вычисляем общее количество страниц
             total_pages = (total_profiles + page_size - 1) // page_size
@@ -1400,9 +2346,28 @@ async def get_all_profiles_by_page(
                 "profiles": profiles,
             }
 
-        # Если сортировка не передана, используем заранее сформированные страницы
-        # Получаем общее количество профилей и страниц
-        total_profiles, total_pages = await fetch_and_cache_profiles(redis_client)
+        # Если сортировка не передана, используем заранее сформированные страницы текущего поколения
+        pages_generation = await get_pages_generation(redis_client)
+
+        if not pages_generation:
+            # Кэш еще не собран (холодный старт) - собираем в фоне, запрос не ждет полного прохода по БД
+            trigger_profiles_cache_refresh(redis_client)
+            logger.warning("Страницы профилей еще не собраны, запущена фоновая сборка.")
+            return {
+                "theme": "Макс, это для тебя корешок ^^",  # Сообщение на фронт
+                "page_number": page,
+                "total_profiles": 0,
+                "total_pages": 0,
+                "message": "Профили обновляются. Повторите запрос через несколько секунд.",
+                "profiles": [],
+            }
+
+        # Поколение устарело - отдаем его, но запускаем одну фоновую пересборку
+        if time.time() - pages_generation["built_at"] > PAGES_FRESHNESS_SEK:
+            trigger_profiles_cache_refresh(redis_client)
+
+        total_profiles = pages_generation["total_profiles"]
+        total_pages = pages_generation["total_pages"]
 
         # Логируем запрос
         logger.info(f"Запрошена страница {page}. Всего профилей: {total_profiles}, всего страниц: {total_pages}.")
@@ -1412,14 +2377,23 @@ async def get_all_profiles_by_page(
             page_number=page,
             redis_client=redis_client,
             total_profiles=total_profiles,
-            total_pages=total_pages
+            total_pages=total_pages,
+            generation=pages_generation["generation"]
         )
 
+        # Курсор для продолжения по живой ленте с последнего профиля страницы
+        page_data["next_cursor"] = None
+        if len(page_data["profiles"]) == PAGE_SIZE:
+            last_id = page_data["profiles"][-1]["id"]
+            page_data["next_cursor"] = await feed_cursor_after(redis_client, last_id)
+
         # Логируем успешное выполнение
         logger.info(f"Показана страница {page} из {total_pages}. Профили: {len(page_data['profiles'])}.")
 
         return page_data
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при получении страницы {page}: {str(e)}")
         raise HTTPException(status_code=500, detail="Ошибка при получении профилей")
\ No newline at end of file
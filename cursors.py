@@ -0,0 +1,82 @@
+""" Модуль курсорной (keyset) пагинации.
+
+    Вместо OFFSET клиент получает непрозрачный курсор с ключом сортировки последнего профиля страницы
+    (например, created_at и id), и следующая страница выбирается условием WHERE (ключ) < (курсор) по индексу
+    или границей ZREVRANGEBYSCORE в Redis. Время выдачи любой страницы одинаковое, а вставка новых
+    профилей не сдвигает уже просмотренные.
+
+    Общее количество для таких выдач берется из кэша, а не COUNT(*) на каждый запрос. """
+
+import os
+import json
+import base64
+import binascii
+from typing import Awaitable, Callable, List, Optional
+
+import redis.asyncio as redis
+from fastapi import HTTPException
+
+from logging_config import get_logger
+
+logger = get_logger()
+
+COUNT_CACHE_TTL_SEK = int(os.getenv("COUNT_CACHE_TTL_SEK", 60))
+COUNT_CACHE_KEY_PREFIX = "count:"
+
+
+# Курсор: base64 от JSON [вид выдачи, ...ключ последнего профиля]
+def encode_cursor(kind: str, *values) -> str:
+    raw = json.dumps([kind, *values], separators=(",", ":"), default=str).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+# Разбор курсора с проверкой, что он выдан для этой же выдачи
+def decode_cursor(cursor: str, kind: str, *converters: Callable) -> List:
+    """
+    :param kind: Вид выдачи (например, city:newest) - курсор другой выдачи или сортировки не принимается.
+    :param converters: Преобразования значений ключа (int, datetime.fromisoformat, ...), по одному на значение.
+    :raises HTTPException: 400, если курсор поврежден или от другой выдачи.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Некорректный курсор.")
+
+    if not isinstance(data, list) or len(data) != len(converters) + 1 or data[0] != kind:
+        raise HTTPException(status_code=400, detail="Курсор не подходит для этой выдачи.")
+
+    try:
+        return [convert(value) for convert, value in zip(converters, data[1:])]
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Некорректный курсор.")
+
+
+# Сообщение о пагинации для страницы по курсору: номер страницы и диапазон профилей по курсору неизвестны
+def cursor_page_message(shown: int, total: int, next_cursor: Optional[str]) -> str:
+    if total == 0:
+        return "Нет профилей для отображения."
+    if not shown:
+        return "Нет профилей для отображения на этой странице."
+    message = f"Показано {shown} профилей из {total}."
+    if next_cursor is None:
+        message += " Это последняя страница. Начните просмотр профилей со страницы номер 1."
+    return message
+
+
+# Количество из кэша (COUNT(*) выполняется не чаще раза в COUNT_CACHE_TTL_SEK)
+async def get_cached_count(client: redis.Redis, name: str, loader: Callable[[], Awaitable[int]], ttl_sek: int = COUNT_CACHE_TTL_SEK) -> int:
+    key = f"{COUNT_CACHE_KEY_PREFIX}{name}"
+    try:
+        cached = await client.get(key)
+        if cached is not None:
+            return int(cached)
+    except redis.RedisError as e:
+        logger.warning(f"Не удалось прочитать количество {key} из кэша: {e}")
+
+    total = await loader()
+    try:
+        await client.set(key, total, ex=ttl_sek)
+    except redis.RedisError as e:
+        logger.warning(f"Не удалось сохранить количество {key} в кэш: {e}")
+    return total
@@ -0,0 +1,74 @@
+""" Модуль случайной выдачи профилей (discovery) с сидом на сессию.
+
+    Вместо ORDER BY random() (сортировка всей таблицы) и перемешивания каждого запроса заново
+    клиент получает сид, и выдача - перестановка позиций 0..N-1 списка ID, заданная этим сидом.
+    Позицию i-го профиля выдачи считает шифр Фейстеля по сиду с cycle-walking (перестановка любого N
+    без хранения самой перестановки): страница стоит O(размер страницы), один сид - всегда один порядок,
+    повторов между страницами нет.
+
+    Сид и N лежат в токене сессии: пока клиент листает, N не меняется, даже если профилей стало больше.
+    Перестановка применяется к живому списку по позициям: удаление профиля во время сессии сдвигает все
+    следующие позиции на одну, и на стыке страниц профиль может повториться или выпасть. Снимок списка
+    на каждую сессию стоил бы O(N) при старте, поэтому этот редкий сдвиг допускается. """
+
+import re
+import hashlib
+import secrets
+from typing import List, Tuple
+
+from fastapi import HTTPException
+
+from cursors import encode_cursor, decode_cursor
+
+DISCOVERY_CURSOR_KIND = "discover"
+FEISTEL_ROUNDS = 4
+DISCOVERY_SEED_RE = re.compile(r"[0-9a-f]{16}")  # secrets.token_hex(8)
+
+
+# Новая сессия: случайный сид и размер списка на момент старта
+def new_discovery_token(total: int) -> str:
+    return encode_cursor(DISCOVERY_CURSOR_KIND, secrets.token_hex(8), total)
+
+
+# Сид и размер списка из токена сессии
+def parse_discovery_token(token: str) -> Tuple[str, int]:
+    """
+    :raises HTTPException: 400, если токен поврежден.
+    """
+    seed, total = decode_cursor(token, DISCOVERY_CURSOR_KIND, str, int)
+    # Сид идет ключом в blake2b (не длиннее 64 байт) - принимаем только то, что выдает new_discovery_token
+    if not DISCOVERY_SEED_RE.fullmatch(seed) or total < 0:
+        raise HTTPException(status_code=400, detail="Некорректный токен сессии.")
+    return seed, total
+
+
+def _round_value(seed: str, round_number: int, value: int, bits: int) -> int:
+    digest = hashlib.blake2b(f"{round_number}:{value}".encode(), key=seed.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") & ((1 << bits) - 1)
+
+
+# Перестановка на [0, 2^(2*half_bits)): сбалансированная сеть Фейстеля
+def _feistel(seed: str, value: int, half_bits: int) -> int:
+    mask = (1 << half_bits) - 1
+    left, right = value >> half_bits, value & mask
+    for round_number in range(FEISTEL_ROUNDS):
+        left, right = right, left ^ _round_value(seed, round_number, right, half_bits)
+    return (left << half_bits) | right
+
+
+# Позиция в списке для i-го профиля выдачи (перестановка [0, total))
+def permuted_position(seed: str, index: int, total: int) -> int:
+    """
+    Домен шифра - ближайшая сверху четная степень двойки (не больше 4 * total), значения за пределами
+    [0, total) шифруются повторно (cycle-walking) - в среднем меньше четырех шагов на позицию.
+    """
+    half_bits = max(1, ((total - 1).bit_length() + 1) // 2)
+    position = _feistel(seed, index, half_bits)
+    while position >= total:
+        position = _feistel(seed, position, half_bits)
+    return position
+
+
+# Позиции для страницы выдачи
+def permuted_positions(seed: str, total: int, start: int, count: int) -> List[int]:
+    return [permuted_position(seed, index, total) for index in range(start, min(start + count, total))]
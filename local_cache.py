@@ -0,0 +1,156 @@
+""" Модуль локального (L1) кэша процесса перед Redis.
+
+    Горячие объекты (профили, страницы ленты) держим прямо в памяти воркера uvicorn уже
+    распарсенными: LRU с TTL и ограничением по объему. Изменения рассылаются через канал
+    Redis pub/sub, каждый процесс сбрасывает у себя указанные ключи. Ключи страниц содержат
+    номер поколения, поэтому новое поколение вытесняет старое само, без рассылки.
+
+    Значения из кэша общие для всех запросов процесса - их нельзя изменять, только читать. """
+
+import os
+import json
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import redis.asyncio as redis
+
+from logging_config import get_logger
+
+logger = get_logger()
+
+LOCAL_CACHE_MAX_BYTES = int(os.getenv("LOCAL_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+LOCAL_CACHE_DEFAULT_TTL_SEK = float(os.getenv("LOCAL_CACHE_DEFAULT_TTL_SEK", 30))
+LOCAL_CACHE_INVALIDATION_CHANNEL = "cache:invalidate"
+
+MISS = object()  # Признак промаха (None может быть валидным значением)
+
+
+class LocalCache:
+    """ LRU-кэш с TTL на запись и общим бюджетом по байтам (размер оценивается по сериализованному значению) """
+
+    def __init__(self, max_bytes: int = LOCAL_CACHE_MAX_BYTES, default_ttl: float = LOCAL_CACHE_DEFAULT_TTL_SEK):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._entries: "OrderedDict[str, Tuple[Any, int, float]]" = OrderedDict()  # key -> (value, size, expires_at)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: str) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISS
+
+        value, size, expires_at = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return MISS
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any, size: int, ttl: Optional[float] = None) -> None:
+        if size > self.max_bytes:
+            return  # Слишком большой объект не кэшируем, чтобы не вытеснить все остальное
+
+        if key in self._entries:
+            self._remove(key)
+
+        self._entries[key] = (value, size, time.monotonic() + (ttl or self.default_ttl))
+        self._bytes += size
+
+        while self._bytes > self.max_bytes and self._entries:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def invalidate(self, key: str) -> None:
+        if key in self._entries:
+            self._remove(key)
+            self.invalidations += 1
+
+    def invalidate_prefix(self, prefix: str) -> None:
+        for key in [key for key in self._entries if key.startswith(prefix)]:
+            self._remove(key)
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def _remove(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        requests = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / requests, 4) if requests else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+# Кэш процесса
+local_cache = LocalCache()
+
+
+# Рассылка сброса ключей всем процессам (ключ с * в конце - сброс по префиксу)
+async def publish_invalidation(client: redis.Redis, keys: Iterable[str]) -> None:
+    keys = list(keys)
+    if not keys:
+        return
+    apply_invalidation(keys)  # Свой процесс сбрасываем сразу, не дожидаясь сообщения
+    try:
+        await client.publish(LOCAL_CACHE_INVALIDATION_CHANNEL, json.dumps(keys))
+    except Exception as e:
+        # Не критично: записи все равно истекут по TTL
+        logger.warning(f"Не удалось разослать сброс локального кэша: {e}")
+
+
+def apply_invalidation(keys: Iterable[str]) -> None:
+    for key in keys:
+        if key.endswith("*"):
+            local_cache.invalidate_prefix(key[:-1])
+        else:
+            local_cache.invalidate(key)
+
+
+# Подписка процесса на сброс ключей (запускается при старте приложения)
+async def run_invalidation_listener(client: redis.Redis) -> None:
+    while True:
+        pubsub = client.pubsub()
+        try:
+            await pubsub.subscribe(LOCAL_CACHE_INVALIDATION_CHANNEL)
+            logger.info(f"Локальный кэш подписан на канал {LOCAL_CACHE_INVALIDATION_CHANNEL}")
+            async for message in pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                try:
+                    apply_invalidation(json.loads(message["data"]))
+                except (ValueError, TypeError) as e:
+                    logger.warning(f"Некорректное сообщение сброса локального кэша: {e}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Пока подписка не восстановлена, сообщения могли потеряться - сбрасываем все
+            logger.error(f"Подписка локального кэша прервана: {e}. Переподключение через 5 секунд.")
+            local_cache.clear()
+            await asyncio.sleep(5)
+        finally:
+            try:
+                await pubsub.close()
+            except Exception:
+                pass
@@ -2,8 +2,9 @@ import os
 import asyncio
 import json
 from pydantic import HttpUrl
-from datetime import timedelta
-from fastapi import FastAPI, UploadFile, HTTPException, File, Depends, Query, status
+from datetime import datetime, timedelta
+from uuid import uuid4
+from fastapi import FastAPI, UploadFile, HTTPException, File, Depends, Query, Header, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
@@ -29,7 +30,13 @@ from fake_profiles import generate_profiles
 
 from database import init_db, engine, get_db_session
 from logging_config import get_logger
-from video_handle.video_handler_publisher import publish_task
+from video_handle.video_handler_publisher import publish_task, build_idempotency_key, claim_idempotency_key
+from video_handle.video_handler_worker import probe_video, validate_probe
+from video_handle.storage_gc import collect_storage_garbage
+from video_handle.storage_backends import STORAGE_BACKEND, STORAGE_LOCAL_ROOT, STORAGE_LOCAL_BASE_URL
+from local_cache import local_cache, run_invalidation_listener
+from response_cache import cached_json_response
+from cache_index import normalize_tag
 from views import (
     save_video_to_temp,
     save_image_to_temp,
@@ -49,8 +56,6 @@ from views import (
 from schemas import FormData, TokenResponse, UserProfileResponse, UserResponse, is_valid_image, is_valid_video, serialize_form_data, validate_and_process_form
 from models import User, UserProfiles, Favorite, Hashtag, ProfileHashtag
 from cashe import (
-    increment_subscribers_count,
-    decrement_subscribers_count,
     get_subscribers_count_from_cache,
     add_to_favorites,
     remove_from_favorites,
@@ -60,10 +65,17 @@ from cashe import (
     get_profiles_by_hashtag,
     get_cached_profiles,
     fetch_and_cache_profiles,
+    refresh_profiles_cache,
+    reconcile_popularity,
+    refresh_mixed_feed,
     get_profiles_by_ids,
     save_profile_to_db_without_video,
-    get_all_profiles_by_page
+    get_all_profiles_by_page,
+    query_profiles_by_facets,
+    get_discovery_page,
+    redis_binary_client
 )
+from single_flight import single_flight
 from tokens import TokenData, create_tokens, verify_access_token, verify_refresh_token
 from utils import scheduled_cleanup_task, parse_coordinates, process_coordinates_for_response, datetime_to_str, clean_old_logs
 
@@ -81,10 +93,15 @@ directories_to_create = {
     "user_video_posters": "./user_video_posters"
 }
 
+# Метаданные ffprobe для загруженных видео (живут столько же, сколько временные файлы)
+VIDEO_PROBE_KEY_PREFIX = "video_probe:"
+VIDEO_PROBE_TTL_SEK = 48 * 3600
+
 app = FastAPI()
 
 # Используем HTTPBearer, так как нам нужен только токен, а не полноценный OAuth2
 oauth2_scheme = HTTPBearer()
+optional_oauth2_scheme = HTTPBearer(auto_error=False)  # Для открытых эндпоинтов, где токен не обязателен
 
 # Настройка CORS (Это Максу - разрешить доступ фронту, разрешить отправлять мне запросы)
 app.add_middleware(
@@ -95,12 +112,28 @@ app.add_middleware(
     allow_headers=["*"],  # Разрешенные заголовки
 )
 
+
+# Раздача логотипов и постеров, которые еще не перенесены в облако. Имена файлов уникальные (uuid),
+# содержимое по пути не меняется, поэтому отдаем с долгим кэшем для браузеров и CDN
+class ImmutableStaticFiles(StaticFiles):
+    async def get_response(self, path: str, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code == 200:
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+
 # Раздача файлов из папки user_logo (ПОТОМ С СЕРВАКА КОГДА ОТДАВАТЬ БУДЕМ СДЕЛАТЬ ПРАВИЛЬНЫЙ КОНФИГ!!!!!!)
 # TODO в функции def move_image_to_user_logo (вьюхи) тоже поставить правильный конфиг в переменной!!!!!!
 app.mount("/app/video_temp", StaticFiles(directory="/app/video_temp"), name="video_temp")
-app.mount("/app/user_logo", StaticFiles(directory="/app/user_logo"), name="user_logo")
+app.mount("/app/user_logo", ImmutableStaticFiles(directory="/app/user_logo"), name="user_logo")
 app.mount("/app/image_temp", StaticFiles(directory="/app/image_temp"), name="image_temp")
-app.mount("/app/user_video_posters", StaticFiles(directory="/app/user_video_posters"), name="user_video_posters")
+app.mount("/app/user_video_posters", ImmutableStaticFiles(directory="/app/user_video_posters"), name="user_video_posters")
+
+# Локальное хранилище объектов (офлайн-режим без облака): ключи уникальные, содержимое не меняется
+if STORAGE_BACKEND == "local":
+    os.makedirs(STORAGE_LOCAL_ROOT, exist_ok=True)
+    app.mount(STORAGE_LOCAL_BASE_URL, ImmutableStaticFiles(directory=STORAGE_LOCAL_ROOT), name="object_storage")
 
 
 # Установка зависимости для подключения Редиса, чтобы прокидывать потом в нужные эндпоинты
@@ -116,13 +149,15 @@ async def start_scheduler():
     # Получаем redis_client из состояния приложения
     redis_client = app.state.redis_client
 
-    # Задача, которая выполняется каждые 5 минут (обновление профилей в Redis)
+    # Задача, которая выполняется каждые 5 минут (обновление профилей и страниц в Redis), первый запуск сразу
     scheduler.add_job(
-        fetch_and_cache_profiles,  # Функция
+        refresh_profiles_cache,  # Функция (fetch_and_cache_profiles под блокировкой)
         IntervalTrigger(minutes=5),  # Триггер (интервал 5 минут)
-        args=[redis_client]  # Аргументы для функции
+        args=[redis_client],  # Аргументы для функции
+        next_run_time=datetime.now(),
+        max_instances=1
     )
-    logger.info("Задача fetch_and_cache_profiles добавлена в расписание (каждые 8 минут).")
+    logger.info("Задача refresh_profiles_cache добавлена в расписание (каждые 5 минут).")
 
     # Задача, которая выполняется каждые 8 минут (синхронизация данных из Redis в БД)
     scheduler.add_job(
@@ -131,6 +166,22 @@ async def start_scheduler():
     )
     logger.info("Задача sync_data_to_db добавлена в расписание (каждые 8 минут).")
 
+    # Сверка рейтинга популярности со счетчиками и БД (сам рейтинг обновляется при каждой подписке)
+    scheduler.add_job(
+        reconcile_popularity,
+        IntervalTrigger(minutes=30),
+        max_instances=1
+    )
+    logger.info("Задача reconcile_popularity добавлена в расписание (каждые 30 минут).")
+
+    # Пересчет смешанной ленты: оценки догоняют изменения подписчиков (пишутся только изменившиеся)
+    scheduler.add_job(
+        refresh_mixed_feed,
+        IntervalTrigger(minutes=5),
+        max_instances=1
+    )
+    logger.info("Задача refresh_mixed_feed добавлена в расписание (каждые 5 минут).")
+
     # Очистка логов каждые 5 минут
     scheduler.add_job(
         clean_old_logs,
@@ -147,6 +198,15 @@ async def start_scheduler():
     )
     logger.info("Задача очистки временных файлов добавлена в расписание (каждый день в 00:00).")
 
+    # Сборщик очереди удаления старых папок видео из облака
+    scheduler.add_job(
+        collect_storage_garbage,
+        IntervalTrigger(minutes=2),
+        args=[redis_client],
+        max_instances=1
+    )
+    logger.info("Задача collect_storage_garbage добавлена в расписание (каждые 2 минуты).")
+
 
     # Старт планировщика
     scheduler.start()
@@ -179,6 +239,9 @@ async def startup():
         if dirs_created:
             logger.info(f"Директории для использования успешно созданы: {dirs_created}")
 
+        # Подписка локального кэша процесса на сброс ключей
+        app.state.local_cache_listener = asyncio.create_task(run_invalidation_listener(redis_client))
+
         # Запуск планировщика задач
         await start_scheduler()
 
@@ -199,6 +262,9 @@ async def startup():
 async def shutdown():
     """Функция завершения работы приложения"""
     await engine.dispose()
+    local_cache_listener = getattr(app.state, "local_cache_listener", None)
+    if local_cache_listener:
+        local_cache_listener.cancel()
     redis_client = app.state.get("redis_client")
     if redis_client:
         await redis_client.close()  # Закрыть соединение с Redis
@@ -222,6 +288,19 @@ async def check_user_token(credentials: HTTPAuthorizationCredentials = Depends(o
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired access token")
 
 
+# Пользователь по токену, если он передан (открытые ленты: с токеном - персональная выдача)
+async def get_optional_user(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_oauth2_scheme)
+) -> Optional[TokenData]:
+    if not credentials or not credentials.credentials:
+        return None
+    try:
+        return await verify_access_token(credentials.credentials)
+    except Exception as e:
+        logger.info(f"Токен не принят, выдача без персонализации: {str(e)}")
+        return None
+
+
 # Эндпоинт для регистрации/авторизации пользователя, отдача избранного и информации о профиле на фронт, генерация токенов
 @app.post("/api/user/login")
 async def login(
@@ -369,7 +448,11 @@ async def upload_image(file: UploadFile = File(...), current_user: TokenData = D
 
 # Эндпоинт для загрузки видео
 @app.post("/api/upload_video/")
-async def upload_video(file: UploadFile = File(...), current_user: TokenData = Depends(check_user_token)):
+async def upload_video(
+    file: UploadFile = File(...),
+    current_user: TokenData = Depends(check_user_token),
+    redis_client: redis.Redis = Depends(get_redis_client)
+):
     try:
         logger.info("Получен запрос на загрузку видео от пользователя с ID: {current_user.user_id}")
 
@@ -384,8 +467,25 @@ async def upload_video(file: UploadFile = File(...), current_user: TokenData = D
         # Сохранение видео
         video_path = await save_video_to_temp(file, created_dirs)
 
+        # Проверка содержимого через ffprobe: битые и не проходящие по лимитам файлы отсекаем сразу,
+        # чтобы они не занимали воркер
+        try:
+            video_probe = await probe_video(video_path, logger)
+            validate_probe(video_probe)
+        except ValueError as e:
+            logger.warning(f"Видео отклонено после проверки: {video_path}: {e}")
+            os.remove(video_path)
+            raise HTTPException(status_code=400, detail=str(e))
+
+        # Метаданные сохраняем на сервере, при сохранении профиля они уйдут в задачу воркеру
+        await redis_client.setex(
+            f"{VIDEO_PROBE_KEY_PREFIX}{os.path.abspath(video_path)}",
+            VIDEO_PROBE_TTL_SEK,
+            json.dumps(video_probe)
+        )
+
         logger.info(f"Видео успешно загружено: {video_path}")
-        return {"message": "Видео успешно загружено", "video_path": video_path}
+        return {"message": "Видео успешно загружено", "video_path": video_path, "video_info": video_probe}
 
     except HTTPException as e:
         logger.error(f"Ошибка валидации видео: {str(e)}")
@@ -436,12 +536,17 @@ async def save_profile(
     image_data: dict,
     video_data: dict,
     new_user_image: bool = True,  # Новый параметр
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
     _: TokenData = Depends(check_user_token)
 ):
     """
     Получение данных профиля из формы, пути к изображению и видео (в виде JSON),
     проверка путей и отправка задачи на обработку в Redis.
+    Повтор запроса (тот же Idempotency-Key или то же содержимое) возвращает id уже поставленной задачи.
     """
+    redis_client = app.state.redis_client
+    claimed_key = None
+
     try:
         # Преобразование данных формы в словарь
         form_data_dict = profile_data.dict()
@@ -487,6 +592,17 @@ async def save_profile(
             logger.error(f"Путь к видео не ведет к файлу: {absolute_video_path}")
             raise HTTPException(status_code=400, detail="Указанный путь к видео не ведет к файлу.")
 
+        # Идемпотентность: проверяем до переноса изображения, иначе повтор упадет на уже перемещенном файле
+        job_id = uuid4().hex
+        request_key = build_idempotency_key(
+            wallet_number, idempotency_key, absolute_video_path, image_path, new_user_image, form_data_dict
+        )
+        existing_job_id = await claim_idempotency_key(redis_client, request_key, job_id)
+        if existing_job_id:
+            logger.info(f"Повторный запрос сохранения профиля, задача уже поставлена: {existing_job_id}")
+            return {"message": "Ваш профиль успешно сохранен и отправлен на модерацию.", "job_id": existing_job_id}
+        claimed_key = request_key
+
         # Обработка изображения
         user_logo_path = None
         if new_user_image:
@@ -522,10 +638,12 @@ async def save_profile(
         # Лог начала обработки запроса
         logger.info("Обработка данных профиля...")
 
-        # Подключение к Redis из состояния приложения
-        redis_client = app.state.redis_client
         logger.info("Соединение с Redis для публикации задачи в канал установлено.")
 
+        # Метаданные видео, полученные при загрузке (если протухли - воркер проверит видео сам)
+        cached_probe = await redis_client.get(f"{VIDEO_PROBE_KEY_PREFIX}{absolute_video_path}")
+        video_probe = json.loads(cached_probe) if cached_probe else None
+
         # Лог задачи перед отправкой в Redis
         logger.info(f"Публикуемые данные в Redis: {{"
                     f"input_path: {absolute_video_path}, "
@@ -543,12 +661,15 @@ async def save_profile(
             preview_path=created_dirs["output_preview"],  # Путь для превью
             user_logo_url=user_logo_path,  # Путь к изображению
             wallet_number=wallet_number,  # Кошелек
-            form_data=form_data_dict  # Данные формы для сохранения в БД
+            form_data=form_data_dict,  # Данные формы для сохранения в БД
+            video_probe=video_probe,  # Метаданные видео
+            job_id=job_id  # Id задачи (последняя задача кошелька отменяет предыдущие)
         )
-        logger.info("Задача успешно отправлена в Redis.")
+        claimed_key = None
+        logger.info(f"Задача успешно отправлена в Redis: {job_id}")
 
         # Ответ клиенту
-        return {"message": "Ваш профиль успешно сохранен и отправлен на модерацию."}
+        return {"message": "Ваш профиль успешно сохранен и отправлен на модерацию.", "job_id": job_id}
 
     except ValueError as e:
         logger.error(f"Ошибка при обработке данных: {str(e)}")
@@ -557,9 +678,18 @@ async def save_profile(
         # Лог ошибок при работе с Redis
         logger.error(f"Ошибка при подключении или публикации в Redis: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ошибка при сохранении профиля в Redis: {str(e)}")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при сохранении профиля: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ошибка при сохранении профиля: {str(e)}")
+    finally:
+        # Задача не поставлена - освобождаем ключ, чтобы клиент мог повторить запрос
+        if claimed_key:
+            try:
+                await redis_client.delete(claimed_key)
+            except redis.RedisError as e:
+                logger.warning(f"Не удалось освободить ключ идемпотентности {claimed_key}: {e}")
 
 
 # Эндпоинт для сохранения юзера в БД без видео (нет смысла запускать фоновую задачу)
@@ -612,29 +742,25 @@ async def add_to_favorites_and_increment(
     try:
         logger.info(f"Начало обработки запроса для user_id={user_id}, profile_id={profile_id}")
 
-        # 1. Проверяем, есть ли профиль уже в избранном
-        is_favorite = await redis_client.sismember(f"favorites:{user_id}", profile_id)
-        if is_favorite:
+        # 1. Проверка, добавление в избранное и увеличение счётчика - один атомарный вызов Redis
+        result = await add_to_favorites(user_id, profile_id, redis_client)
+        new_count = result["subscribers_count"]
+
+        if result["status"] == "already_in_favorites":
             logger.info(f"Профиль {profile_id} уже в избранном у пользователя {user_id}")
             return {
                 "message": f"Профиль {profile_id} уже в избранном",
                 "user_id": user_id,
                 "favorites": await get_favorites_from_cache(user_id),
-                "new_subscriber_count": await get_subscribers_count(profile_id)
+                "new_subscriber_count": new_count
             }
 
-        # 2. Добавляем профиль в избранное
-        await redis_client.sadd(f"favorites:{user_id}", profile_id)
-        logger.info(f"Профиль {profile_id} добавлен в избранное пользователя {user_id}")
-
-        # 3. Увеличиваем счётчик подписчиков
-        new_count = await increment_subscribers_count(profile_id)
-        logger.info(f"Счётчик подписчиков для профиля {profile_id} увеличен до {new_count}")
+        logger.info(f"Профиль {profile_id} добавлен в избранное пользователя {user_id}, подписчиков: {new_count}")
 
-        # 4. Получаем обновлённый список избранного
+        # 2. Получаем обновлённый список избранного
         favorites_list = await get_favorites_from_cache(user_id)
 
-        # 5. Формируем ответ
+        # 3. Формируем ответ
         return {
             "message": f"Профиль {profile_id} добавлен в избранное",
             "user_id": user_id,
@@ -666,29 +792,25 @@ async def remove_from_favorites_and_decrement(
     try:
         logger.info(f"Начало обработки запроса для user_id={user_id}, profile_id={profile_id}")
 
-        # 1. Проверяем, есть ли профиль в избранном
-        is_favorite = await redis_client.sismember(f"favorites:{user_id}", profile_id)
-        if not is_favorite:
+        # 1. Проверка, удаление из избранного и уменьшение счётчика (не ниже нуля) - один атомарный вызов Redis
+        result = await remove_from_favorites(user_id, profile_id, redis_client)
+        new_count = result["subscribers_count"]
+
+        if result["status"] == "not_in_favorites":
             logger.info(f"Профиль {profile_id} не был в избранном у пользователя {user_id}")
             return {
                 "message": f"Профиль {profile_id} не был в избранном у пользователя {user_id}",
                 "user_id": user_id,
                 "favorites": await get_favorites_from_cache(user_id),
-                "new_subscriber_count": await get_subscribers_count(profile_id)
+                "new_subscriber_count": new_count
             }
 
-        # 2. Удаляем профиль из избранного
-        await redis_client.srem(f"favorites:{user_id}", profile_id)
-        logger.info(f"Профиль {profile_id} удалён из избранного пользователя {user_id}")
-
-        # 3. Уменьшаем счётчик подписчиков
-        new_count = await decrement_subscribers_count(profile_id)
-        logger.info(f"Счётчик подписчиков для профиля {profile_id} уменьшен до {new_count}")
+        logger.info(f"Профиль {profile_id} удалён из избранного пользователя {user_id}, подписчиков: {new_count}")
 
-        # 4. Получаем обновлённый список избранного
+        # 2. Получаем обновлённый список избранного
         favorites_list = await get_favorites_from_cache(user_id)
 
-        # 5. Формируем ответ
+        # 3. Формируем ответ
         return {
             "message": f"Профиль {profile_id} удалён из избранного",
             "user_id": user_id,
@@ -701,6 +823,13 @@ async def remove_from_favorites_and_decrement(
         raise HTTPException(status_code=500, detail="Ошибка сервера")
 
 
+# Статистика локального кэша процесса (попадания, промахи, объем)
+@app.get("/api/cache/stats")
+async def get_local_cache_stats(_: TokenData = Depends(check_user_token)):
+    """ Статистика L1-кэша текущего процесса uvicorn (у каждого воркера своя) """
+    return {"pid": os.getpid(), **local_cache.stats()}
+
+
 # Эндпоинт для получения текущего счётчика подписчиков
 @app.get("/api/subscribers/count/")
 async def get_subscribers_count(
@@ -742,28 +871,52 @@ async def get_favorites(user_id: int, redis_client: redis.Redis = Depends(get_re
 # Эндпоинт для получения всех профилей (Сначала ныряем в Редис, если там пусто - берем данные из БД)
 @app.get("/api/profiles/all/")
 async def get_all_profiles_to_client(
+    request: Request,
     page: int = Query(1, description="Номер страницы (начинается с 1).", ge=1),  # Страница (по умолчанию 1)
     sort_by: Optional[str] = Query(None, description="Параметр сортировки. Возможные значения: newest, popularity.", enum=["newest", "popularity"]),
-    redis_client: redis.Redis = Depends(get_redis_client)  # Зависимость для Redis
+    cursor: Optional[str] = Query(None, description="Курсор следующей страницы смешанной ленты (next_cursor из прошлого ответа)."),
+    redis_client: redis.Redis = Depends(get_redis_client),  # Зависимость для Redis
+    current_user: Optional[TokenData] = Depends(get_optional_user)
 ):
     """
     Получает все профили пользователей с пагинацией и сортировкой.
 
     :param page: Номер страницы (начинается с 1).
     :param sort_by: Параметр сортировки (опционально). Возможные значения: "newest", "popularity".
+    :param cursor: Курсор смешанной ленты (без сортировки), вместо номера страницы.
     :return: Словарь с данными о профилях, включая пагинацию и общее количество.
+    С токеном авторизации лента без сортировки пропускает уже просмотренные пользователем профили.
+    Общие (не персональные) ответы отдаются из кэша готовых ответов с ETag.
     """
-    try:
+    user_id = current_user.user_id if current_user and not sort_by else None
+
+    async def build_response() -> dict:
         # Пытаемся получить данные из кэша
-        profiles_data = await get_all_profiles_by_page(page=page, sort_by=sort_by, redis_client=redis_client)
+        profiles_data = await get_all_profiles_by_page(
+            page=page, sort_by=sort_by, redis_client=redis_client, cursor=cursor, user_id=user_id
+        )
 
-        # # Если в кэше ничего нет, обращаемся к базе данных
-        if not profiles_data.get("profiles"):  # Используем .get() для безопасного доступа
+        # Если в кэше ничего нет, обращаемся к базе данных. Только для страниц по номеру без персонализации:
+        # пустая страница по курсору - конец ленты, пустая персональная - все уже просмотрено
+        if not profiles_data.get("profiles") and cursor is None and user_id is None:
             logger.info("Кэш пуст, запрашиваем данные из базы данных.")
-            profiles_data = await get_all_profiles(page=page, sort_by=sort_by)
-
-        # Возвращаем данные
+            # Холодный кэш под нагрузкой: в БД идет один запрос на страницу, остальные ждут его результат
+            profiles_data = await single_flight(
+                redis_binary_client,
+                f"profiles_all:{page}:{sort_by}",
+                lambda: get_all_profiles(page=page, sort_by=sort_by)
+            )
         return profiles_data
+
+    try:
+        # Персональная лента (без просмотренных) в общий кэш ответов не попадает
+        if user_id:
+            return await build_response()
+
+        return await cached_json_response(
+            redis_binary_client, request, f"all:{page}:{sort_by}:{cursor}", build_response,
+            should_cache=lambda data: bool(data.get("profiles"))  # Пустой ответ холодного кэша не запоминаем
+        )
     except HTTPException:
         raise  # Пробрасываем HTTP-исключения без изменений
     except Exception as e:
@@ -771,16 +924,69 @@ async def get_all_profiles_to_client(
         raise HTTPException(status_code=500, detail="Ошибка при получении профилей")
 
 
+# Эндпоинт фильтрации профилей по любому сочетанию признаков (из индексов Redis, без БД)
+@app.get("/api/profiles/filter/")
+async def filter_profiles_endpoint(
+    city: Optional[str] = Query(None, description="Город"),
+    language: Optional[str] = Query(None, description="Язык профиля"),
+    is_in_mlm: Optional[int] = Query(None, description="Участие в МЛМ"),
+    has_video: Optional[bool] = Query(None, description="Только профили с видео (true) или без него (false)"),
+    moderated: Optional[bool] = Query(None, description="Только прошедшие модерацию (true) или ожидающие ее (false)"),
+    page: int = Query(default=1, ge=1),
+    per_page: int = Query(default=50, ge=1, le=100),
+    sort_by: Optional[str] = Query(None, enum=["newest", "popularity"])
+):
+    """
+    Возвращает страницу профилей, подходящих под все указанные фильтры, и количество профилей
+    по каждому значению признаков (facets) для построения фильтров на фронте.
+    Скрытые (инкогнито) профили не отдаются никогда, модерация - фильтр moderated.
+    """
+    try:
+        filters = {"city": city, "language": language, "is_in_mlm": is_in_mlm, "has_video": has_video, "moderated": moderated}
+        return await query_profiles_by_facets(filters, page, per_page, sort_by)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка в эндпоинте /profiles/filter/: {str(e)}")
+        raise HTTPException(status_code=500, detail="Ошибка при фильтрации профилей")
+
+
+# Эндпоинт случайной выдачи профилей: порядок задан сидом сессии и не меняется между страницами
+@app.get("/api/profiles/discover/")
+async def discover_profiles_endpoint(
+    page: int = Query(default=1, ge=1),
+    per_page: int = Query(default=50, ge=1, le=100),
+    token: Optional[str] = Query(None, description="discovery_token из прошлого ответа (без него - новая сессия)."),
+    current_user: Optional[TokenData] = Depends(get_optional_user)
+):
+    """
+    Возвращает страницу профилей в случайном порядке. Первый запрос без токена начинает сессию,
+    следующие страницы запрашиваются с discovery_token из ответа - профили не повторяются.
+    С токеном авторизации уже просмотренные пользователем профили пропускаются.
+    """
+    try:
+        return await get_discovery_page(page, per_page, token, current_user.user_id if current_user else None)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка в эндпоинте /profiles/discover/: {str(e)}")
+        raise HTTPException(status_code=500, detail="Ошибка при получении профилей")
+
+
 # Эндпоинт для получения профилей по городу
 @app.get("/api/profiles/city/")
 async def get_profiles(
+    request: Request,
     city: str,
     page: int = Query(1, ge=1),  # Стартовая страница по умолчанию 1, минимум 1
     per_page: int = Query(50, le=100),  # По умолчанию 25 профилей, максимум 100
-    sort_by: Optional[str] = Query(None, enum=["newest", "popularity"])
+    sort_by: Optional[str] = Query(None, enum=["newest", "popularity"]),
+    cursor: Optional[str] = Query(None, description="Курсор следующей страницы (next_cursor из прошлого ответа)")
 ):
-    result = await get_profiles_by_city(city, page, sort_by, per_page)
-    return result
+    return await cached_json_response(
+        redis_binary_client, request, f"city:{city}:{page}:{per_page}:{sort_by}:{cursor}",
+        lambda: get_profiles_by_city(city, page, sort_by, per_page, cursor)
+    )
 
 
 # Эндпоинт получения пользователя по номеру кошелька
@@ -825,30 +1031,24 @@ async def get_profile_by_username_endpoint(username: str):
         raise HTTPException(status_code=500, detail="Ошибка сервера при получении профиля.")
 
 
-# Эндпоинт для получения профилей по хэштегу с кэшированием и сортировкой
+# Эндпоинт для получения профилей по хэштегу с сортировкой
 @app.get("/api/profiles/by-hashtag/")
 async def get_profiles_by_hashtag_endpoint(
+    request: Request,
     hashtag: str,
     page: int = Query(default=1, ge=1),
     per_page: int = Query(default=50, ge=50, le=100),
     sort_by: Optional[str] = Query(None, enum=["newest", "popularity"]),
+    cursor: Optional[str] = Query(None, description="Курсор следующей страницы (next_cursor из прошлого ответа)"),
     redis_client: redis.Redis = Depends(get_redis_client)
 ):
     try:
-        # Формируем ключ кэша на основе параметров запроса
-        cache_key = f"profiles_hashtag_{hashtag}_page_{page}_per_page_{per_page}_sort_{sort_by}"
-
-        # Проверяем, есть ли данные в кэше
-        cached_data = await redis_client.get(cache_key)
-        if cached_data:
-            logger.info(f"Данные найдены в кэше для ключа {cache_key}.")
-            return JSONResponse(content=json.loads(cached_data))
-
-        # Если кэш пуст, получаем данные из базы данных
-        response_data = await get_profiles_by_hashtag(hashtag, page, per_page, sort_by)
-        logger.info("Профили успешно загружены из базы данных.")
-
-        return JSONResponse(content=response_data)
+        # Страница собирается из обратного индекса хэштегов в Redis (ZRANGE + пакетная гидратация),
+        # готовое сжатое тело ответа - в кэше ответов
+        return await cached_json_response(
+            redis_binary_client, request, f"hashtag:{normalize_tag(hashtag)}:{page}:{per_page}:{sort_by}:{cursor}",
+            lambda: get_profiles_by_hashtag(hashtag, page, per_page, sort_by, cursor)
+        )
 
     except HTTPException:
         raise  # Пробрасываем HTTP-исключения без изменений
@@ -962,6 +1162,7 @@ async def grant_admin_rights_endpoint(
 async def moderation_endpoint(
     page: int = 1,
     per_page: int = Query(default=50, ge=50, le=100),  # Параметр per_page с ограничениями
+    cursor: Optional[str] = None,  # Курсор следующей страницы (next_cursor из прошлого ответа)
     token_data: TokenData = Depends(check_user_token)  # Зависимость для проверки токена
 ):
     """
@@ -982,7 +1183,7 @@ async def moderation_endpoint(
         user_id = token_data.user_id
 
         # Вызываем функцию для получения профилей
-        return await get_profiles_for_moderation(user_id, page, per_page)
+        return await get_profiles_for_moderation(user_id, page, per_page, cursor)
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -0,0 +1,86 @@
+""" Скрипт переноса уже сохраненных логотипов и постеров в облако.
+    Загружает локальные файлы под ключами по хэшу содержимого и переписывает ссылки в БД.
+    Запуск: python migrate_media_to_s3.py (внутри контейнера приложения, после миграции alembic) """
+
+import asyncio
+from sqlalchemy import or_, update
+from sqlalchemy.future import select
+
+from database import get_db_session_for_worker
+from logging_config import get_logger
+from models import UserProfiles
+from cashe import on_profile_changed
+from video_handle.video_handler_worker import offload_media_file, remove_local_media_files
+
+logger = get_logger()
+
+BATCH_SIZE = 100  # Сколько профилей обрабатываем за один проход
+
+
+async def migrate_media_to_s3(batch_size: int = BATCH_SIZE) -> dict:
+    """
+    Переносит локальные логотипы и постеры всех профилей в облако.
+
+    :param batch_size: Размер пачки профилей.
+    :return: Статистика переноса.
+    """
+    stats = {"profiles": 0, "logos": 0, "posters": 0}
+    last_id = 0
+
+    while True:
+        async with get_db_session_for_worker() as session:
+            # Берем только профили, у которых хотя бы один файл еще лежит локально
+            query = (
+                select(UserProfiles.id, UserProfiles.user_logo_url, UserProfiles.poster_url)
+                .where(
+                    UserProfiles.id > last_id,
+                    or_(
+                        UserProfiles.user_logo_url.notlike("http%"),
+                        UserProfiles.poster_url.notlike("http%")
+                    )
+                )
+                .order_by(UserProfiles.id)
+                .limit(batch_size)
+            )
+            rows = (await session.execute(query)).all()
+
+            if not rows:
+                break
+
+            offloaded_paths = []  # Локальные копии удаляем только после коммита новых ссылок
+            changed_profile_ids = []
+            for profile_id, logo_url, poster_url in rows:
+                last_id = profile_id
+                new_logo_url = await offload_media_file(logo_url, "logos", logger, remove_local=False)
+                new_poster_url = await offload_media_file(poster_url, "posters", logger, remove_local=False)
+
+                if new_logo_url == logo_url and new_poster_url == poster_url:
+                    continue
+
+                await session.execute(
+                    update(UserProfiles)
+                    .where(UserProfiles.id == profile_id)
+                    .values(user_logo_url=new_logo_url, poster_url=new_poster_url)
+                )
+                changed_profile_ids.append(profile_id)
+                stats["profiles"] += 1
+                stats["logos"] += int(new_logo_url != logo_url)
+                stats["posters"] += int(new_poster_url != poster_url)
+                offloaded_paths += [
+                    old_url for old_url, new_url in ((logo_url, new_logo_url), (poster_url, new_poster_url)) if new_url != old_url
+                ]
+
+            await session.commit()
+
+            # Кэш профилей должен указывать на облако раньше, чем пропадут локальные файлы
+            for profile_id in changed_profile_ids:
+                await on_profile_changed(profile_id)
+            remove_local_media_files(offloaded_paths, logger)
+            logger.info(f"Перенос медиа в облако: обработаны профили до id={last_id}, итого {stats}")
+
+    logger.info(f"Перенос медиа в облако завершен: {stats}")
+    return stats
+
+
+if __name__ == "__main__":
+    print(asyncio.run(migrate_media_to_s3()))
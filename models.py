@@ -31,7 +31,7 @@ class UserProfiles(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     name = Column(String(100), nullable=False)
     website_or_social = Column(String(255), nullable=True)
-    user_logo_url = Column(String(255), nullable=False, unique=True)
+    user_logo_url = Column(String(255), nullable=False)  # Не unique: одинаковые логотипы в облаке лежат под одним ключом
     poster_url = Column(String(255), nullable=True)
     video_url = Column(String(255), nullable=True)
     preview_url = Column(String(255), nullable=True)
@@ -55,10 +55,19 @@ class UserProfiles(Base):
 
     favorited_by = relationship('Favorite', back_populates='profile', cascade="all, delete-orphan")
 
-    # Частичные индексы для video_url и preview_url
+    # Частичные индексы для video_url и preview_url, индекс поиска по имени,
+    # индексы курсорной пагинации списка по городу (ключ сортировки + id) и очереди модерации
     __table_args__ = (
         Index('ix_user_profiles_video_url_unique', video_url, unique=True, postgresql_where=video_url.isnot(None)),
         Index('ix_user_profiles_preview_url_unique', preview_url, unique=True, postgresql_where=preview_url.isnot(None)),
+        Index('ix_user_profiles_name_lower', func.lower(name)),  # Поиск по имени без учета регистра
+        Index('ix_user_profiles_city_id', city, id.desc(), postgresql_where=is_incognito == False),
+        Index('ix_user_profiles_city_created_at', city, created_at.desc(), id.desc(), postgresql_where=is_incognito == False),
+        Index(
+            'ix_user_profiles_city_popularity', city, func.coalesce(followers_count, 0).desc(), id.desc(),
+            postgresql_where=is_incognito == False
+        ),
+        Index('ix_user_profiles_unmoderated_id', id, postgresql_where=is_moderated == False),
     )
 
 
@@ -99,3 +108,20 @@ class ProfileHashtag(Base):
         Index('ix_profile_hashtags_profile_id', 'profile_id'),
         Index('ix_profile_hashtags_hashtag_id', 'hashtag_id'),
     )
+
+
+# Очередь отложенного удаления папок из облака (намерения пишутся в одной транзакции с профилем)
+class StorageGcIntent(Base):
+    __tablename__ = 'storage_gc_intents'
+
+    id = Column(Integer, primary_key=True)
+    prefix = Column(String(512), unique=True, nullable=False)  # Префикс папки в бакете (videos/<folder>/)
+    source_url = Column(String(512), nullable=True)  # URL, по которому поставлено удаление (для логов)
+    attempts = Column(Integer, default=0, nullable=False)
+    last_error = Column(String(1000), nullable=True)
+    next_attempt_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=True)  # NULL - попытки исчерпаны
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index('ix_storage_gc_intents_next_attempt_at', 'next_attempt_at'),
+    )
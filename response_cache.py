@@ -0,0 +1,141 @@
+""" Модуль кэша готовых ответов списков профилей.
+
+    Вместо того чтобы на каждое попадание собирать словарь ответа и заново сериализовать его в JSON,
+    кэш хранит итоговое тело ответа уже сжатым (gzip, и brotli, если установлен) вместе с ETag.
+    Попадание - отдача байтов как есть; клиент с совпадающим If-None-Match получает 304 без тела.
+
+    Ключи содержат номер версии (resp:{версия}:...): любое изменение профилей или пересборка страниц
+    увеличивает версию, и все прежние ответы перестают читаться сразу, а в Redis доживают свой короткий TTL.
+    Значения бинарные - клиент Redis должен быть без decode_responses. """
+
+import os
+import gzip
+import json
+import hashlib
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import redis.asyncio as redis
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+from local_cache import local_cache, MISS
+from logging_config import get_logger
+
+logger = get_logger()
+
+# Необязательное сжатие brotli: если библиотека не установлена, отдаем только gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+RESPONSE_CACHE_TTL_SEK = int(os.getenv("RESPONSE_CACHE_TTL_SEK", 60))  # Страхует от изменений без смены версии (подписчики)
+RESPONSE_CACHE_LOCAL_TTL_SEK = 10
+RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", 6))
+RESPONSE_BROTLI_QUALITY = int(os.getenv("RESPONSE_BROTLI_QUALITY", 5))
+
+RESPONSE_CACHE_KEY_PREFIX = "resp:"
+RESPONSE_CACHE_VERSION_KEY = "resp:version"
+
+
+# Новая версия кэша ответов (после изменения данных, которые в них попадают)
+async def bump_response_cache_version(client: redis.Redis) -> None:
+    try:
+        await client.incr(RESPONSE_CACHE_VERSION_KEY)
+    except redis.RedisError as e:
+        logger.warning(f"Не удалось сменить версию кэша ответов: {e}")  # Ответы истекут по TTL
+
+
+# Тело ответа так же, как его сериализует JSONResponse
+def render_json(data: Any) -> bytes:
+    return json.dumps(
+        jsonable_encoder(data), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+# Запись кэша: ETag и сжатые варианты тела
+def build_entry(body: bytes) -> Dict[str, bytes]:
+    entry = {
+        "etag": f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'.encode(),
+        "gzip": gzip.compress(body, RESPONSE_GZIP_LEVEL, mtime=0),
+    }
+    if brotli is not None:
+        entry["br"] = brotli.compress(body, quality=RESPONSE_BROTLI_QUALITY)
+    return entry
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+def _accepted_encodings(accept_encoding: Optional[str]) -> set:
+    encodings = set()
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if name and params.replace(" ", "") not in ("q=0", "q=0.0"):
+            encodings.add(name.lower())
+    return encodings
+
+
+# Ответ из записи кэша: 304, сжатое тело или (клиент без gzip) распакованное
+def entry_response(request: Request, entry: Dict[str, bytes]) -> Response:
+    etag = entry["etag"].decode()
+    headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    encodings = _accepted_encodings(request.headers.get("accept-encoding"))
+    if "br" in encodings and entry.get("br"):
+        return Response(entry["br"], media_type="application/json", headers={**headers, "Content-Encoding": "br"})
+    if "gzip" in encodings:
+        return Response(entry["gzip"], media_type="application/json", headers={**headers, "Content-Encoding": "gzip"})
+    return Response(gzip.decompress(entry["gzip"]), media_type="application/json", headers=headers)
+
+
+# Ответ списка профилей из кэша готовых ответов (при промахе - builder и запись в кэш)
+async def cached_json_response(
+    client: redis.Redis,
+    request: Request,
+    cache_key: str,
+    builder: Callable[[], Awaitable[Any]],
+    should_cache: Callable[[Any], bool] = lambda data: True,
+    ttl_sek: int = RESPONSE_CACHE_TTL_SEK
+) -> Response:
+    """
+    :param cache_key: Ключ ответа без версии (эндпоинт и все параметры запроса).
+    :param builder: Сборка словаря ответа (как без кэша).
+    :param should_cache: Кэшировать ли собранный ответ (например, не кэшировать пустой при холодном кэше).
+    """
+    try:
+        version = await client.get(RESPONSE_CACHE_VERSION_KEY)
+        key = f"{RESPONSE_CACHE_KEY_PREFIX}{int(version or 0)}:{cache_key}"
+
+        entry = local_cache.get(key)
+        if entry is MISS:
+            raw_entry = await client.hgetall(key)
+            entry = {field.decode(): value for field, value in raw_entry.items()} if raw_entry else None
+            if entry:
+                local_cache.set(key, entry, sum(len(value) for value in entry.values()), RESPONSE_CACHE_LOCAL_TTL_SEK)
+        if entry:
+            return entry_response(request, entry)
+    except redis.RedisError as e:
+        logger.warning(f"Кэш ответов недоступен ({cache_key}): {e}")
+        key = None
+
+    data = await builder()
+    entry = build_entry(render_json(data))
+
+    if key and should_cache(data):
+        try:
+            async with client.pipeline(transaction=True) as pipe:
+                pipe.hset(key, mapping=entry)
+                pipe.expire(key, ttl_sek)
+                await pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Не удалось сохранить ответ {cache_key} в кэш: {e}")
+
+    return entry_response(request, entry)
@@ -0,0 +1,137 @@
+""" Модуль фильтра просмотренных профилей (Bloom-фильтр на пользователя).
+
+    Лента пропускает профили, которые пользователь уже видел, без списков NOT IN и без множества
+    всех просмотренных ID: на пользователя - один Bloom-фильтр фиксированного размера.
+    Размер задается ожидаемым числом профилей и долей ложных срабатываний (ложное срабатывание -
+    непросмотренный профиль будет пропущен; обратной ошибки нет - просмотренный повторно не покажется).
+
+    Если в Redis есть модуль RedisBloom - используется BF.*, иначе битовый массив на SETBIT/GETBIT
+    с k хэшами (двойное хэширование). Когда в фильтр добавлено capacity профилей, он начинается заново:
+    доля ложных срабатываний дальше росла бы, а память - нет. """
+
+import os
+import math
+import hashlib
+from typing import Iterable, List, Optional
+
+import redis.asyncio as redis
+from redis.exceptions import ResponseError
+
+from logging_config import get_logger
+
+logger = get_logger()
+
+SEEN_FILTER_BACKEND = os.getenv("SEEN_FILTER_BACKEND", "auto").lower()  # auto, redisbloom, bitmap
+SEEN_FILTER_CAPACITY = int(os.getenv("SEEN_FILTER_CAPACITY", 10000))  # Профилей до сброса фильтра
+SEEN_FILTER_ERROR_RATE = float(os.getenv("SEEN_FILTER_ERROR_RATE", 0.01))
+SEEN_FILTER_TTL_SEK = int(os.getenv("SEEN_FILTER_TTL_SEK", 7 * 24 * 3600))  # Продлевается при каждом просмотре
+
+SEEN_BLOOM_KEY_PREFIX = "seen:bf:"  # seen:bf:{user_id} - фильтр RedisBloom
+SEEN_BITS_KEY_PREFIX = "seen:bits:"  # seen:bits:{user_id} - битовый массив
+SEEN_COUNT_KEY_PREFIX = "seen:count:"  # seen:count:{user_id} - сколько профилей добавлено в фильтр
+
+# Размер битового массива и число хэшей под capacity и долю ошибок (при 10000 и 1% - около 12 КБ и 7 хэшей)
+SEEN_FILTER_BITS = max(8, math.ceil(-SEEN_FILTER_CAPACITY * math.log(SEEN_FILTER_ERROR_RATE) / math.log(2) ** 2))
+SEEN_FILTER_HASHES = max(1, round(SEEN_FILTER_BITS / SEEN_FILTER_CAPACITY * math.log(2)))
+
+_bloom_module_available: Optional[bool] = None if SEEN_FILTER_BACKEND == "auto" else SEEN_FILTER_BACKEND == "redisbloom"
+
+
+# Позиции битов профиля: h1 + i * h2 по модулю размера массива
+def _bit_positions(profile_id) -> List[int]:
+    digest = hashlib.blake2b(str(profile_id).encode(), digest_size=16).digest()
+    h1, h2 = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big") | 1
+    return [(h1 + i * h2) % SEEN_FILTER_BITS for i in range(SEEN_FILTER_HASHES)]
+
+
+# Какой вариант фильтра использовать (наличие RedisBloom проверяется один раз на процесс)
+async def _use_bloom_module(client: redis.Redis) -> bool:
+    global _bloom_module_available
+
+    if _bloom_module_available is None:
+        try:
+            await client.execute_command("BF.EXISTS", f"{SEEN_BLOOM_KEY_PREFIX}probe", 0)
+            _bloom_module_available = True
+        except ResponseError as e:
+            if "unknown command" not in str(e).lower():
+                raise
+            logger.info("RedisBloom недоступен, фильтр просмотренных - битовый массив на SETBIT.")
+            _bloom_module_available = False
+    return _bloom_module_available
+
+
+# Есть ли ID в фильтре (по одному флагу на ID)
+async def _contains(client: redis.Redis, user_id: int, profile_ids: List) -> List[bool]:
+    if await _use_bloom_module(client):
+        flags = await client.execute_command("BF.MEXISTS", f"{SEEN_BLOOM_KEY_PREFIX}{user_id}", *profile_ids)
+        return [bool(flag) for flag in flags]
+
+    bits_key = f"{SEEN_BITS_KEY_PREFIX}{user_id}"
+    async with client.pipeline(transaction=False) as pipe:
+        for profile_id in profile_ids:
+            for position in _bit_positions(profile_id):
+                pipe.getbit(bits_key, position)
+        bits = await pipe.execute()
+
+    return [all(bits[i:i + SEEN_FILTER_HASHES]) for i in range(0, len(bits), SEEN_FILTER_HASHES)]
+
+
+# Отбор непросмотренных ID (порядок сохраняется)
+async def filter_unseen(client: redis.Redis, user_id: int, profile_ids: Iterable) -> List:
+    profile_ids = list(profile_ids)
+    if not profile_ids:
+        return []
+    try:
+        seen_flags = await _contains(client, user_id, profile_ids)
+    except redis.RedisError as e:
+        logger.warning(f"Фильтр просмотренных пользователя {user_id} недоступен, лента без фильтра: {e}")
+        return profile_ids
+    return [profile_id for profile_id, seen in zip(profile_ids, seen_flags) if not seen]
+
+
+# Отметка профилей просмотренными (после отдачи страницы)
+async def mark_seen(client: redis.Redis, user_id: int, profile_ids: Iterable) -> None:
+    profile_ids = list(profile_ids)
+    if not profile_ids:
+        return
+
+    count_key = f"{SEEN_COUNT_KEY_PREFIX}{user_id}"
+    try:
+        # Фильтр заполнен - начинаем заново (иначе он пропускал бы все больше непросмотренных)
+        if int(await client.get(count_key) or 0) >= SEEN_FILTER_CAPACITY:
+            await reset_seen(client, user_id)
+
+        if await _use_bloom_module(client):
+            bloom_key = f"{SEEN_BLOOM_KEY_PREFIX}{user_id}"
+            added = await client.execute_command(
+                "BF.INSERT", bloom_key, "CAPACITY", SEEN_FILTER_CAPACITY, "ERROR", SEEN_FILTER_ERROR_RATE,
+                "NONSCALING", "ITEMS", *profile_ids
+            )
+            new_count = sum(1 for flag in added if flag == 1)
+            filter_key = bloom_key
+        else:
+            filter_key = f"{SEEN_BITS_KEY_PREFIX}{user_id}"
+            async with client.pipeline(transaction=False) as pipe:
+                for profile_id in profile_ids:
+                    for position in _bit_positions(profile_id):
+                        pipe.setbit(filter_key, position, 1)
+                old_bits = await pipe.execute()
+            # Новый профиль - хотя бы один бит был нулем
+            new_count = sum(
+                1 for i in range(0, len(old_bits), SEEN_FILTER_HASHES) if not all(old_bits[i:i + SEEN_FILTER_HASHES])
+            )
+
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.incrby(count_key, new_count)
+            pipe.expire(count_key, SEEN_FILTER_TTL_SEK)
+            pipe.expire(filter_key, SEEN_FILTER_TTL_SEK)
+            await pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Не удалось отметить просмотренные профили пользователя {user_id}: {e}")
+
+
+# Сброс фильтра пользователя
+async def reset_seen(client: redis.Redis, user_id: int) -> None:
+    await client.delete(
+        f"{SEEN_BLOOM_KEY_PREFIX}{user_id}", f"{SEEN_BITS_KEY_PREFIX}{user_id}", f"{SEEN_COUNT_KEY_PREFIX}{user_id}"
+    )
@@ -0,0 +1,166 @@
+""" Модуль защиты от лавины промахов кэша (single-flight) и разброса TTL.
+
+    Когда ключ кэша пропал, тяжелую загрузку выполняет только один исполнитель:
+    - внутри процесса одинаковые запросы ждут один и тот же Future;
+    - между процессами ведущий берет короткую аренду в Redis (sf:lease:{key}) и кладет результат
+      в sf:result:{key}, остальные ждут этот результат, а не идут в БД сами.
+    Если ведущий не успел за время аренды (упал или завис), загрузку берет на себя следующий.
+
+    Ключи, записанные одновременно, получают TTL с разбросом, чтобы не истечь в одну секунду.
+
+    Результаты хранятся в формате cache_codec - клиент Redis должен быть без decode_responses. """
+
+import os
+import time
+import random
+import asyncio
+import secrets
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+import redis.asyncio as redis
+
+from cache_codec import encode_value, decode_value, CodecError
+from logging_config import get_logger
+
+logger = get_logger()
+
+SINGLE_FLIGHT_LEASE_SEK = float(os.getenv("SINGLE_FLIGHT_LEASE_SEK", 10))  # Аренда ведущего загрузчика
+SINGLE_FLIGHT_RESULT_TTL_SEK = float(os.getenv("SINGLE_FLIGHT_RESULT_TTL_SEK", 5))  # Сколько результат доступен ожидающим
+SINGLE_FLIGHT_POLL_SEK = 0.05
+TTL_JITTER_RATIO = float(os.getenv("TTL_JITTER_RATIO", 0.1))  # Разброс TTL: +-10%
+
+LEASE_KEY_PREFIX = "sf:lease:"
+RESULT_KEY_PREFIX = "sf:result:"
+
+# Снимаем только свою аренду
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_inflight: Dict[str, asyncio.Task] = {}  # Загрузки процесса: ключ -> общая задача загрузки
+_refreshing: Set[str] = set()  # Ключи, обновляемые в фоне этим процессом
+_background_tasks: Set[asyncio.Task] = set()
+
+
+# TTL с разбросом (ключи одной пересборки истекают в разное время)
+def jittered_ttl(ttl_sek: float, ratio: float = TTL_JITTER_RATIO) -> int:
+    return max(1, int(ttl_sek * random.uniform(1 - ratio, 1 + ratio)))
+
+
+# Попытка взять аренду (None - аренда у другого процесса)
+async def acquire_lease(client: redis.Redis, key: str, lease_sek: float = SINGLE_FLIGHT_LEASE_SEK) -> Optional[str]:
+    token = secrets.token_hex(8)
+    if await client.set(f"{LEASE_KEY_PREFIX}{key}", token, nx=True, px=int(lease_sek * 1000)):
+        return token
+    return None
+
+
+# Снятие своей аренды
+async def release_lease(client: redis.Redis, key: str, token: str) -> None:
+    try:
+        await client.eval(RELEASE_LEASE_SCRIPT, 1, f"{LEASE_KEY_PREFIX}{key}", token)
+    except redis.RedisError as e:
+        logger.warning(f"Не удалось снять аренду {key}: {e}")  # Истечет сама
+
+
+# Загрузка одним исполнителем на ключ
+async def single_flight(
+    client: redis.Redis,
+    key: str,
+    loader: Callable[[], Awaitable[Any]],
+    lease_sek: float = SINGLE_FLIGHT_LEASE_SEK
+) -> Any:
+    """
+    Выполняет loader один раз на ключ: в процессе - общая задача, между процессами - аренда в Redis.
+    Загрузка идет в отдельной задаче, и все запросы (включая первый) ждут ее через shield:
+    отмена одного запроса (клиент отключился, таймаут) не прерывает загрузку для остальных.
+
+    :param key: Ключ загрузки (что именно грузим).
+    :param loader: Загрузка (обычно из БД с записью в кэш). Результат должен сериализоваться cache_codec.
+    :return: Результат loader (свой или ведущего).
+    """
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_run_with_lease(client, key, loader, lease_sek))
+        _inflight[key] = task
+        task.add_done_callback(lambda done: _finish_inflight(key, done))
+    return await asyncio.shield(task)
+
+
+# Загрузка завершена: ключ освобождается, ошибка считается полученной (даже если все ожидающие отменены)
+def _finish_inflight(key: str, task: asyncio.Task) -> None:
+    if _inflight.get(key) is task:
+        del _inflight[key]
+    if not task.cancelled():
+        task.exception()
+
+
+async def _run_with_lease(client: redis.Redis, key: str, loader, lease_sek: float) -> Any:
+    result_key = f"{RESULT_KEY_PREFIX}{key}"
+
+    while True:
+        try:
+            token = await acquire_lease(client, key, lease_sek)
+        except redis.RedisError as e:
+            # Без Redis координация между процессами невозможна - грузим сами
+            logger.warning(f"single-flight {key}: Redis недоступен ({e}), загрузка без аренды")
+            return await loader()
+
+        if token:
+            try:
+                result = await loader()
+                try:
+                    await client.set(result_key, encode_value(result), px=int(SINGLE_FLIGHT_RESULT_TTL_SEK * 1000))
+                except (redis.RedisError, TypeError) as e:
+                    logger.warning(f"single-flight {key}: не удалось передать результат ожидающим: {e}")
+                return result
+            finally:
+                await release_lease(client, key, token)
+
+        # Аренда у другого процесса - ждем его результат, пока аренда жива
+        deadline = time.monotonic() + lease_sek
+        while time.monotonic() < deadline:
+            await asyncio.sleep(SINGLE_FLIGHT_POLL_SEK)
+            raw = await client.get(result_key)
+            if raw is not None:
+                try:
+                    return decode_value(raw)
+                except CodecError as e:
+                    logger.warning(f"single-flight {key}: не удалось прочитать результат ведущего: {e}")
+                    break
+            if not await client.exists(f"{LEASE_KEY_PREFIX}{key}"):
+                break  # Ведущий закончил без результата (ошибка) - пробуем сами
+
+
+# Фоновое обновление (stale-while-revalidate): отдаем старое значение, обновляет один исполнитель
+def refresh_in_background(
+    client: redis.Redis,
+    key: str,
+    loader: Callable[[], Awaitable[Any]],
+    lease_sek: float = SINGLE_FLIGHT_LEASE_SEK
+) -> None:
+    """ Запускает loader в фоне, если ключ не обновляется ни в этом процессе, ни в другом (аренда) """
+    if key in _inflight or key in _refreshing:
+        return
+
+    async def run():
+        try:
+            token = await acquire_lease(client, key, lease_sek)
+            if not token:
+                return  # Обновляет другой процесс
+            try:
+                await loader()
+            finally:
+                await release_lease(client, key, token)
+        except Exception as e:
+            logger.error(f"Ошибка фонового обновления {key}: {e}")
+        finally:
+            _refreshing.discard(key)
+
+    _refreshing.add(key)
+    task = asyncio.create_task(run())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
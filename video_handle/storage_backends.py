@@ -0,0 +1,497 @@
+"""
+Модуль хранилищ объектов: единый интерфейс поверх S3, локальной файловой системы и памяти.
+
+Бэкенд выбирается переменной окружения STORAGE_BACKEND (s3 - по умолчанию, local, memory).
+Локальный бэкенд не требует зависимостей и облака: файлы копируются через shutil.copyfile
+(на Linux это os.sendfile, без копирования через память процесса) и раздаются приложением
+через StaticFiles. In-memory бэкенд нужен для тестов и замеров без диска и сети.
+"""
+
+import os
+import io
+import time
+import asyncio
+import shutil
+import mimetypes
+import urllib.parse
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import aiofiles
+from aiobotocore.session import get_session
+from dotenv import load_dotenv
+
+from logging_config import get_logger
+
+logger = get_logger()
+
+load_dotenv()
+
+# HLS-типы есть не во всех системных mime-базах
+mimetypes.add_type("application/vnd.apple.mpegurl", ".m3u8")
+mimetypes.add_type("video/mp2t", ".ts")
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "s3").lower()
+
+# Конфиги для облака
+S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
+AWS_REGION = os.getenv("AWS_REGION")
+AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
+AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # Для S3-совместимых хранилищ (MinIO и т.п.)
+
+# Конфиги локального хранилища
+STORAGE_LOCAL_ROOT = os.getenv("STORAGE_LOCAL_ROOT", "/app/object_storage")
+STORAGE_LOCAL_BASE_URL = os.getenv("STORAGE_LOCAL_BASE_URL", "/app/object_storage")
+
+DELETE_BATCH_LIMIT = 1000  # Максимум ключей в одном delete_objects
+MULTIPART_THRESHOLD = int(os.getenv("STORAGE_MULTIPART_THRESHOLD", 16 * 1024 * 1024))  # С какого размера грузим частями
+MULTIPART_PART_SIZE = int(os.getenv("STORAGE_MULTIPART_PART_SIZE", 8 * 1024 * 1024))  # Не меньше 5 МБ (лимит S3)
+MULTIPART_CONCURRENCY = int(os.getenv("STORAGE_MULTIPART_CONCURRENCY", 4))
+
+
+def guess_content_type(path: str) -> str:
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+# Чтение файла кусками в отдельном потоке (не блокируем event loop)
+def _read_part(file_path: str, offset: int, size: int) -> bytes:
+    with open(file_path, "rb") as source:
+        source.seek(offset)
+        return source.read(size)
+
+
+class StorageError(Exception):
+    """ Ошибка операции с хранилищем (в том числе частичная ошибка пакетного удаления) """
+
+
+class StorageBackend(ABC):
+    """ Интерфейс хранилища объектов. Ключи - пути вида videos/<folder>/<file> """
+
+    name = "abstract"
+
+    @abstractmethod
+    async def check(self) -> bool:
+        """ Проверка доступности хранилища (исключение, если недоступно) """
+
+    @abstractmethod
+    async def put_file(self, key: str, file_path: str, content_type: Optional[str] = None,
+                       cache_control: Optional[str] = None) -> str:
+        """ Загрузка локального файла. Возвращает публичный URL """
+
+    @abstractmethod
+    async def put_stream(self, key: str, chunks: AsyncIterator[bytes], content_type: Optional[str] = None,
+                         cache_control: Optional[str] = None) -> str:
+        """ Загрузка из асинхронного потока байтов неизвестной длины. Возвращает публичный URL """
+
+    @abstractmethod
+    async def put_multipart(self, key: str, file_path: str, content_type: Optional[str] = None,
+                            cache_control: Optional[str] = None, part_size: int = MULTIPART_PART_SIZE) -> str:
+        """ Загрузка большого файла частями. Возвращает публичный URL """
+
+    @abstractmethod
+    async def exists(self, key: str) -> bool:
+        """ Есть ли объект с таким ключом """
+
+    @abstractmethod
+    async def list_keys(self, prefix: str) -> List[str]:
+        """ Все ключи по префиксу """
+
+    @abstractmethod
+    async def delete_keys(self, keys: List[str]) -> List[str]:
+        """ Пакетное удаление (до DELETE_BATCH_LIMIT ключей). Возвращает ключи, которые удалить не удалось """
+
+    @abstractmethod
+    async def presign(self, key: str, expires_in: int = 3600) -> str:
+        """ Временная ссылка на объект """
+
+    @abstractmethod
+    def public_url(self, key: str) -> str:
+        """ Постоянный публичный URL объекта """
+
+    @abstractmethod
+    def key_from_url(self, url: str) -> Optional[str]:
+        """ Ключ объекта по его публичному URL (None - URL не из этого хранилища) """
+
+    async def close(self):
+        """ Освобождение соединений """
+
+    async def delete_prefix(self, prefix: str) -> int:
+        """
+        Удаляет все объекты по префиксу пачками по DELETE_BATCH_LIMIT.
+        Частичные ошибки поднимаются StorageError, чтобы вызывающий код мог повторить попытку.
+
+        :return: Количество удаленных объектов.
+        """
+        keys = await self.list_keys(prefix)
+        deleted = 0
+        for start in range(0, len(keys), DELETE_BATCH_LIMIT):
+            batch = keys[start:start + DELETE_BATCH_LIMIT]
+            failed = await self.delete_keys(batch)
+            deleted += len(batch) - len(failed)
+            if failed:
+                raise StorageError(f"Не удалось удалить {len(failed)} объектов по префиксу {prefix}: {failed[:5]}")
+        return deleted
+
+
+class S3StorageBackend(StorageBackend):
+    """ AWS S3 (или совместимое хранилище) через aiobotocore. Клиент один на процесс - переиспользуем соединения """
+
+    name = "s3"
+
+    def __init__(self, bucket: str = S3_BUCKET_NAME, region: str = AWS_REGION, endpoint_url: Optional[str] = S3_ENDPOINT_URL):
+        self.bucket = bucket
+        self.region = region
+        self.endpoint_url = endpoint_url
+        self._client = None
+        self._client_cm = None
+        self._client_lock = asyncio.Lock()
+
+    async def _get_client(self):
+        if self._client is None:
+            async with self._client_lock:
+                if self._client is None:
+                    self._client_cm = get_session().create_client(
+                        "s3",
+                        region_name=self.region,
+                        endpoint_url=self.endpoint_url,
+                        aws_access_key_id=AWS_ACCESS_KEY_ID,
+                        aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+                    )
+                    self._client = await self._client_cm.__aenter__()
+        return self._client
+
+    async def close(self):
+        if self._client_cm is not None:
+            await self._client_cm.__aexit__(None, None, None)
+            self._client = None
+            self._client_cm = None
+
+    @staticmethod
+    def _extra_args(content_type: Optional[str], cache_control: Optional[str]) -> dict:
+        extra = {}
+        if content_type:
+            extra["ContentType"] = content_type
+        if cache_control:
+            extra["CacheControl"] = cache_control
+        return extra
+
+    async def check(self) -> bool:
+        client = await self._get_client()
+        await client.list_objects_v2(Bucket=self.bucket, MaxKeys=1)
+        return True
+
+    async def put_file(self, key, file_path, content_type=None, cache_control=None) -> str:
+        content_type = content_type or guess_content_type(file_path)
+        if os.path.getsize(file_path) >= MULTIPART_THRESHOLD:
+            return await self.put_multipart(key, file_path, content_type, cache_control)
+
+        client = await self._get_client()
+        body = await asyncio.to_thread(_read_part, file_path, 0, -1)
+        await client.put_object(Bucket=self.bucket, Key=key, Body=body, **self._extra_args(content_type, cache_control))
+        return self.public_url(key)
+
+    async def put_stream(self, key, chunks, content_type=None, cache_control=None) -> str:
+        client = await self._get_client()
+        buffer = bytearray()
+        upload_id = None
+        parts = []
+
+        try:
+            async for chunk in chunks:
+                buffer.extend(chunk)
+                if len(buffer) >= MULTIPART_PART_SIZE:
+                    if upload_id is None:
+                        created = await client.create_multipart_upload(
+                            Bucket=self.bucket, Key=key, **self._extra_args(content_type, cache_control)
+                        )
+                        upload_id = created["UploadId"]
+                    part_number = len(parts) + 1
+                    response = await client.upload_part(
+                        Bucket=self.bucket, Key=key, UploadId=upload_id,
+                        PartNumber=part_number, Body=bytes(buffer)
+                    )
+                    parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+                    buffer.clear()
+
+            # Поток меньше одной части - обычный put_object
+            if upload_id is None:
+                await client.put_object(
+                    Bucket=self.bucket, Key=key, Body=bytes(buffer), **self._extra_args(content_type, cache_control)
+                )
+                return self.public_url(key)
+
+            if buffer:
+                part_number = len(parts) + 1
+                response = await client.upload_part(
+                    Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=bytes(buffer)
+                )
+                parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+            await client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts}
+            )
+            return self.public_url(key)
+
+        except Exception:
+            if upload_id is not None:
+                await client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+
+    async def put_multipart(self, key, file_path, content_type=None, cache_control=None, part_size=MULTIPART_PART_SIZE) -> str:
+        client = await self._get_client()
+        file_size = os.path.getsize(file_path)
+        created = await client.create_multipart_upload(
+            Bucket=self.bucket, Key=key,
+            **self._extra_args(content_type or guess_content_type(file_path), cache_control)
+        )
+        upload_id = created["UploadId"]
+        semaphore = asyncio.Semaphore(MULTIPART_CONCURRENCY)
+
+        async def upload_part(part_number: int, offset: int) -> dict:
+            async with semaphore:
+                body = await asyncio.to_thread(_read_part, file_path, offset, part_size)
+                response = await client.upload_part(
+                    Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=body
+                )
+                return {"ETag": response["ETag"], "PartNumber": part_number}
+
+        try:
+            parts = await asyncio.gather(*(
+                upload_part(number, offset)
+                for number, offset in enumerate(range(0, file_size, part_size), start=1)
+            ))
+            await client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": list(parts)}
+            )
+            return self.public_url(key)
+        except Exception:
+            await client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+
+    async def exists(self, key) -> bool:
+        client = await self._get_client()
+        try:
+            await client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except client.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    async def list_keys(self, prefix) -> List[str]:
+        client = await self._get_client()
+        keys = []
+        paginator = client.get_paginator("list_objects_v2")
+        async for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            keys.extend(obj["Key"] for obj in page.get("Contents", []))
+        return keys
+
+    async def delete_keys(self, keys) -> List[str]:
+        if not keys:
+            return []
+        client = await self._get_client()
+        response = await client.delete_objects(
+            Bucket=self.bucket,
+            Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True}
+        )
+        errors = response.get("Errors", [])
+        for item in errors[:5]:
+            logger.warning(f"S3: не удалось удалить {item['Key']}: {item.get('Message')}")
+        return [item["Key"] for item in errors]
+
+    async def presign(self, key, expires_in=3600) -> str:
+        client = await self._get_client()
+        return await client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": key}, ExpiresIn=expires_in
+        )
+
+    def public_url(self, key) -> str:
+        if self.endpoint_url:
+            return f"{self.endpoint_url.rstrip('/')}/{self.bucket}/{key}"
+        return f"https://{self.bucket}.s3.{self.region}.amazonaws.com/{key}"
+
+    def key_from_url(self, url) -> Optional[str]:
+        path = urllib.parse.urlparse(url).path.lstrip("/")
+        if self.endpoint_url and path.startswith(f"{self.bucket}/"):
+            path = path[len(self.bucket) + 1:]
+        return path or None
+
+
+class LocalStorageBackend(StorageBackend):
+    """
+    Хранилище в локальной папке. Объекты раздаются приложением через StaticFiles
+    по адресу STORAGE_LOCAL_BASE_URL открыто, поэтому временная ссылка совпадает с постоянной.
+    """
+
+    name = "local"
+
+    def __init__(self, root: str = STORAGE_LOCAL_ROOT, base_url: str = STORAGE_LOCAL_BASE_URL):
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip("/")
+
+    def _path(self, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise StorageError(f"Недопустимый ключ: {key}")
+        return path
+
+    async def check(self) -> bool:
+        await asyncio.to_thread(os.makedirs, self.root, exist_ok=True)
+        if not os.access(self.root, os.W_OK):
+            raise StorageError(f"Нет прав на запись в {self.root}")
+        return True
+
+    @staticmethod
+    def _copy(file_path: str, target: str):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Пишем во временный файл и переименовываем: читатели не увидят недописанный объект
+        tmp_target = f"{target}.part"
+        shutil.copyfile(file_path, tmp_target)  # Внутри os.sendfile на Linux
+        os.replace(tmp_target, target)
+
+    async def put_file(self, key, file_path, content_type=None, cache_control=None) -> str:
+        await asyncio.to_thread(self._copy, file_path, self._path(key))
+        return self.public_url(key)
+
+    async def put_stream(self, key, chunks, content_type=None, cache_control=None) -> str:
+        target = self._path(key)
+        await asyncio.to_thread(os.makedirs, os.path.dirname(target), exist_ok=True)
+        tmp_target = f"{target}.part"
+        async with aiofiles.open(tmp_target, "wb") as out_file:
+            async for chunk in chunks:
+                await out_file.write(chunk)
+        await asyncio.to_thread(os.replace, tmp_target, target)
+        return self.public_url(key)
+
+    async def put_multipart(self, key, file_path, content_type=None, cache_control=None, part_size=MULTIPART_PART_SIZE) -> str:
+        # На локальном диске части не нужны: одна копия через sendfile быстрее
+        return await self.put_file(key, file_path, content_type, cache_control)
+
+    async def exists(self, key) -> bool:
+        return await asyncio.to_thread(os.path.isfile, self._path(key))
+
+    async def list_keys(self, prefix) -> List[str]:
+        def walk() -> List[str]:
+            keys = []
+            base_dir = self._path(prefix.rstrip("/")) if prefix.strip("/") else self.root
+            if os.path.isfile(base_dir):
+                base_dir = os.path.dirname(base_dir)
+            for root, _, files in os.walk(base_dir):
+                for file_name in files:
+                    key = os.path.relpath(os.path.join(root, file_name), self.root).replace(os.sep, "/")
+                    if key.startswith(prefix) and not key.endswith(".part"):
+                        keys.append(key)
+            return sorted(keys)
+
+        return await asyncio.to_thread(walk)
+
+    async def delete_keys(self, keys) -> List[str]:
+        def remove_all() -> List[str]:
+            failed = []
+            for key in keys:
+                try:
+                    os.remove(self._path(key))
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    failed.append(key)
+            return failed
+
+        return await asyncio.to_thread(remove_all)
+
+    async def delete_prefix(self, prefix) -> int:
+        deleted = await super().delete_prefix(prefix)
+        # Убираем опустевшие папки
+        folder = self._path(prefix.rstrip("/"))
+        if prefix.strip("/") and os.path.isdir(folder):
+            await asyncio.to_thread(shutil.rmtree, folder, True)
+        return deleted
+
+    async def presign(self, key, expires_in=3600) -> str:
+        # Папка раздается открыто (StaticFiles), подпись ничего бы не защищала - отдаем постоянный URL
+        return self.public_url(key)
+
+    def public_url(self, key) -> str:
+        return f"{self.base_url}/{key}"
+
+    def key_from_url(self, url) -> Optional[str]:
+        path = urllib.parse.urlparse(url).path
+        if not path.startswith(f"{self.base_url}/"):
+            return None
+        return path[len(self.base_url) + 1:] or None
+
+
+class InMemoryStorageBackend(StorageBackend):
+    """ Хранилище в памяти процесса (тесты, замеры накладных расходов без диска и сети) """
+
+    name = "memory"
+
+    def __init__(self, base_url: str = "memory://storage"):
+        self.base_url = base_url
+        self.objects: Dict[str, Tuple[bytes, dict]] = {}
+
+    async def check(self) -> bool:
+        return True
+
+    async def put_file(self, key, file_path, content_type=None, cache_control=None) -> str:
+        body = await asyncio.to_thread(_read_part, file_path, 0, -1)
+        self.objects[key] = (body, {"content_type": content_type or guess_content_type(file_path), "cache_control": cache_control})
+        return self.public_url(key)
+
+    async def put_stream(self, key, chunks, content_type=None, cache_control=None) -> str:
+        buffer = io.BytesIO()
+        async for chunk in chunks:
+            buffer.write(chunk)
+        self.objects[key] = (buffer.getvalue(), {"content_type": content_type, "cache_control": cache_control})
+        return self.public_url(key)
+
+    async def put_multipart(self, key, file_path, content_type=None, cache_control=None, part_size=MULTIPART_PART_SIZE) -> str:
+        return await self.put_file(key, file_path, content_type, cache_control)
+
+    async def exists(self, key) -> bool:
+        return key in self.objects
+
+    async def list_keys(self, prefix) -> List[str]:
+        return sorted(key for key in self.objects if key.startswith(prefix))
+
+    async def delete_keys(self, keys) -> List[str]:
+        for key in keys:
+            self.objects.pop(key, None)
+        return []
+
+    async def presign(self, key, expires_in=3600) -> str:
+        return f"{self.public_url(key)}?expires={int(time.time()) + expires_in}"
+
+    def public_url(self, key) -> str:
+        return f"{self.base_url}/{key}"
+
+    def key_from_url(self, url) -> Optional[str]:
+        prefix = f"{self.base_url}/"
+        return url[len(prefix):] if url.startswith(prefix) else None
+
+
+STORAGE_BACKENDS = {
+    "s3": S3StorageBackend,
+    "local": LocalStorageBackend,
+    "memory": InMemoryStorageBackend,
+}
+
+_storage: Optional[StorageBackend] = None
+
+
+def create_storage(backend: str) -> StorageBackend:
+    """ Новый экземпляр бэкенда по имени (s3, local, memory) """
+    try:
+        return STORAGE_BACKENDS[backend]()
+    except KeyError:
+        raise ValueError(f"Неизвестный бэкенд хранилища: {backend}. Доступны: {', '.join(STORAGE_BACKENDS)}")
+
+
+def get_storage() -> StorageBackend:
+    """ Хранилище процесса (выбирается STORAGE_BACKEND) """
+    global _storage
+    if _storage is None:
+        _storage = create_storage(STORAGE_BACKEND)
+        logger.info(f"Хранилище объектов: {_storage.name}")
+    return _storage
@@ -0,0 +1,185 @@
+"""
+Модуль отложенной очистки облака.
+
+Сохранение профиля не ходит в хранилище: старая папка видео записывается как намерение на удаление
+(таблица storage_gc_intents) в той же транзакции, что и сам профиль. Сборщик по расписанию
+забирает намерения пачкой и удаляет папки через бэкенд хранилища (постраничный листинг,
+пакетное удаление по 1000 ключей), неудачи откладывает с экспоненциальной задержкой и пишет метрики.
+"""
+
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Optional, List
+
+from dotenv import load_dotenv
+from sqlalchemy import delete, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from database import get_db_session_for_worker
+from models import StorageGcIntent
+from video_handle.storage_backends import get_storage
+from logging_config import get_logger
+
+logger = get_logger()
+
+load_dotenv()
+
+# Конфиги сборщика
+GC_INTENTS_PER_RUN = int(os.getenv("GC_INTENTS_PER_RUN", 100))  # Сколько намерений забираем за один запуск
+GC_LEASE_SEK = int(os.getenv("GC_LEASE_SEK", 600))  # На это время намерение скрыто от других сборщиков
+GC_MAX_ATTEMPTS = int(os.getenv("GC_MAX_ATTEMPTS", 10))
+GC_RETRY_BASE_SEK = 60
+GC_RETRY_MAX_SEK = 6 * 3600
+GC_METRICS_KEY = "metrics:storage_gc"  # Хэш в Redis со счетчиками сборщика
+
+
+# Префикс папки в бакете по URL файла (None - удалять нечего или нельзя)
+def build_gc_prefix(url: Optional[str]) -> Optional[str]:
+    """ Префикс папки по URL файла, кроме mock-папок и файлов в корне бакета """
+    if not url:
+        return None
+
+    key = get_storage().key_from_url(url)
+    if not key:
+        return None
+
+    path_parts = key.split('/')
+
+    if any('mock' in part.lower() for part in path_parts):
+        return None
+
+    # Файл в корне бакета - префикс был бы пустым и удалил бы весь бакет
+    if len(path_parts) < 2 or not all(path_parts[:-1]):
+        return None
+
+    return '/'.join(path_parts[:-1]) + '/'
+
+
+# Запись намерения на удаление (вызывается внутри транзакции сохранения профиля, без обращения к S3)
+async def enqueue_storage_gc(session: AsyncSession, url: Optional[str], logger) -> bool:
+    """
+    Добавляет папку файла в очередь на удаление. Коммит делает вызывающая транзакция.
+
+    :return: True, если намерение записано (или уже было в очереди).
+    """
+    prefix = build_gc_prefix(url)
+    if not prefix:
+        logger.info(f"Удаление из облака не требуется (mock или пустой префикс): {url}")
+        return False
+
+    await session.execute(
+        insert(StorageGcIntent)
+        .values(prefix=prefix, source_url=url, attempts=0)
+        .on_conflict_do_nothing(index_elements=[StorageGcIntent.prefix])
+    )
+    logger.info(f"Папка поставлена в очередь на удаление из облака: {prefix}")
+    return True
+
+
+# Задержка перед следующей попыткой (экспонента с джиттером)
+def retry_delay_sek(attempts: int) -> float:
+    delay = min(GC_RETRY_BASE_SEK * (2 ** max(attempts - 1, 0)), GC_RETRY_MAX_SEK)
+    return delay * random.uniform(0.8, 1.2)
+
+
+# Забираем пачку намерений под аренду, чтобы параллельный запуск их не взял
+async def lease_gc_intents(limit: int) -> List[StorageGcIntent]:
+    now = datetime.now(timezone.utc)
+    async with get_db_session_for_worker() as session:
+        async with session.begin():
+            result = await session.execute(
+                select(StorageGcIntent)
+                .where(StorageGcIntent.next_attempt_at <= now)
+                .order_by(StorageGcIntent.next_attempt_at, StorageGcIntent.id)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
+            )
+            intents = result.scalars().all()
+
+            if intents:
+                await session.execute(
+                    update(StorageGcIntent)
+                    .where(StorageGcIntent.id.in_([intent.id for intent in intents]))
+                    .values(next_attempt_at=now + timedelta(seconds=GC_LEASE_SEK))
+                )
+    return intents
+
+
+# Сборщик по расписанию
+async def collect_storage_garbage(redis_client=None) -> dict:
+    """
+    Обрабатывает очередь намерений на удаление.
+    Успешные намерения удаляются из таблицы, неудачные откладываются, после GC_MAX_ATTEMPTS
+    намерение остается в таблице с next_attempt_at = NULL для ручного разбора.
+
+    :param redis_client: Клиент Redis для метрик (необязательно).
+    :return: Метрики запуска.
+    """
+    metrics = {"intents_done": 0, "intents_retried": 0, "intents_dead": 0, "objects_deleted": 0}
+
+    try:
+        intents = await lease_gc_intents(GC_INTENTS_PER_RUN)
+    except Exception as e:
+        logger.error(f"Сборщик облака: не удалось получить очередь намерений: {e}")
+        return metrics
+
+    if not intents:
+        return metrics
+
+    done_ids = []
+    failures = []  # (intent, ошибка)
+
+    storage = get_storage()
+    for intent in intents:
+        try:
+            metrics["objects_deleted"] += await storage.delete_prefix(intent.prefix)
+            done_ids.append(intent.id)
+        except Exception as e:
+            logger.warning(f"Сборщик облака: ошибка удаления {intent.prefix} (попытка {intent.attempts + 1}): {e}")
+            failures.append((intent, str(e)))
+
+    # Фиксируем результат
+    now = datetime.now(timezone.utc)
+    try:
+        async with get_db_session_for_worker() as session:
+            async with session.begin():
+                if done_ids:
+                    await session.execute(delete(StorageGcIntent).where(StorageGcIntent.id.in_(done_ids)))
+                    metrics["intents_done"] = len(done_ids)
+
+                for intent, error in failures:
+                    attempts = intent.attempts + 1
+                    if attempts >= GC_MAX_ATTEMPTS:
+                        next_attempt_at = None
+                        metrics["intents_dead"] += 1
+                        logger.error(f"Сборщик облака: попытки исчерпаны для {intent.prefix}: {error}")
+                    else:
+                        next_attempt_at = now + timedelta(seconds=retry_delay_sek(attempts))
+                        metrics["intents_retried"] += 1
+
+                    await session.execute(
+                        update(StorageGcIntent)
+                        .where(StorageGcIntent.id == intent.id)
+                        .values(attempts=attempts, last_error=error[:1000], next_attempt_at=next_attempt_at)
+                    )
+    except Exception as e:
+        # Аренда истечет, и намерения будут взяты повторно (удаление идемпотентно)
+        logger.error(f"Сборщик облака: не удалось сохранить результат: {e}")
+
+    logger.info(f"Сборщик облака: {metrics}")
+
+    if redis_client is not None:
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for name, value in metrics.items():
+                    if value:
+                        pipe.hincrby(GC_METRICS_KEY, name, value)
+                pipe.hset(GC_METRICS_KEY, "last_run_at", now.isoformat())
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Сборщик облака: не удалось записать метрики в Redis: {e}")
+
+    return metrics
@@ -2,6 +2,8 @@
 
 import json
 import asyncio
+import hashlib
+from uuid import uuid4
 from pydantic import HttpUrl
 from typing import Optional
 from redis.asyncio import Redis
@@ -12,18 +14,64 @@ logger = get_logger()
 
 CHANNEL = "video_tasks"
 
+# Реестр "последняя задача побеждает": для каждого кошелька храним id последней поставленной задачи.
+# Воркер пропускает и отменяет задачи, которые уже перекрыты более новой
+LATEST_JOB_KEY_PREFIX = "video_jobs:latest:"
+LATEST_JOB_TTL_SEK = 48 * 3600
 
-async def publish_task(redis: Redis, input_path, output_path, preview_path, form_data, wallet_number, user_logo_url: Optional[HttpUrl] = None):
-    """ Функция для отправки задачи в канал Redis """
+# Ключи идемпотентности для /api/save_profile/ (повтор запроса клиентом не ставит задачу второй раз)
+IDEMPOTENCY_KEY_PREFIX = "idempotency:save_profile:"
+IDEMPOTENCY_TTL_SEK = 24 * 3600
 
-    # Собираем данные задачи
+
+# Ключ идемпотентности по умолчанию, если клиент не прислал заголовок Idempotency-Key
+def build_idempotency_key(wallet_number: str, client_key: Optional[str], *payload) -> str:
+    """
+    Ключ идемпотентности, привязанный к кошельку.
+    Без ключа от клиента считаем одинаковыми запросы с одинаковым содержимым (видео, логотип, форма).
+    """
+    if not client_key:
+        client_key = hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+    return f"{IDEMPOTENCY_KEY_PREFIX}{wallet_number}:{client_key}"
+
+
+# Захват ключа идемпотентности
+async def claim_idempotency_key(redis: Redis, idempotency_key: str, job_id: str) -> Optional[str]:
+    """
+    Пытается закрепить ключ за новой задачей.
+
+    :return: None, если ключ свободен и закреплен за job_id, иначе id уже поставленной задачи.
+    """
+    claimed = await redis.set(idempotency_key, job_id, nx=True, ex=IDEMPOTENCY_TTL_SEK)
+    if claimed:
+        return None
+    return await redis.get(idempotency_key)
+
+
+# Проверка, что задача не перекрыта более новой задачей того же кошелька
+async def is_job_superseded(redis: Redis, wallet_number: str, job_id: Optional[str]) -> bool:
+    """ True, если для кошелька уже поставлена более новая задача """
+    if not job_id:
+        return False  # Задачи без id (старый формат) не отменяем
+    latest_job_id = await redis.get(f"{LATEST_JOB_KEY_PREFIX}{wallet_number}")
+    return latest_job_id is not None and latest_job_id != job_id
+
+
+async def publish_task(redis: Redis, input_path, output_path, preview_path, form_data, wallet_number, user_logo_url: Optional[HttpUrl] = None, video_probe: Optional[dict] = None, job_id: Optional[str] = None):
+    """ Функция для отправки задачи в канал Redis. Возвращает id задачи """
+
+    job_id = job_id or uuid4().hex
+
+    # Собираем данные задачи (video_probe - метаданные ffprobe с момента загрузки, чтобы воркер не проверял видео повторно)
     task_data = {
+        "job_id": job_id,
         "input_path": input_path,
         "output_path": output_path,
         "preview_path": preview_path,
         "form_data": form_data,
         "wallet_number": wallet_number,
-        "user_logo_url": user_logo_url
+        "user_logo_url": user_logo_url,
+        "video_probe": video_probe
     }
 
     # Преобразование всех объектов HttpUrl в строки
@@ -36,10 +84,13 @@ async def publish_task(redis: Redis, input_path, output_path, preview_path, form
 
     while retries > 0:
         try:
+            # Сначала отмечаем задачу последней для кошелька (все предыдущие станут неактуальными), потом публикуем
+            await redis.set(f"{LATEST_JOB_KEY_PREFIX}{wallet_number}", job_id, ex=LATEST_JOB_TTL_SEK)
+
             # Публикация задачи в канал Redis
             await redis.publish(CHANNEL, json.dumps(task_data))
             logger.info(f"Задача успешно отправлена в канал {CHANNEL}: {task_data}")
-            break  # Прерывание цикла после успешной публикации
+            return job_id
 
         except Exception as e:
             logger.error(f"Ошибка при публикации задачи в Redis: {e}")
@@ -6,6 +6,7 @@
 import json
 import asyncio
 import os
+import shutil
 from datetime import datetime, timedelta
 from sqlalchemy.exc import SQLAlchemyError
 from database import get_db_session_for_worker
@@ -17,8 +18,12 @@ from video_handle.video_handler_worker import (
     check_s3_connection,
     create_hls_playlist,
     extract_frame,
-    delete_video_folder
+    delete_video_folder,
+    offload_media_file,
+    remove_local_media_files,
+    JobCancelledError
 )
+from video_handle.video_handler_publisher import is_job_superseded
 from logging_config import get_logger
 
 
@@ -29,24 +34,41 @@ REDIS_HOST = "redis"
 
 
 # Функция обработки задач на микросервисе
-async def handle_task(task_data):
+async def handle_task(task_data, redis: Redis):
     """Обработка всех задач последовательно с генерацией HLS"""
     logger.info(f"Получена задача для обработки: {task_data}")
 
+    video_folder = None
+    poster_path = None
+
     try:
         # Извлечение входных данных
+        job_id = task_data.get("job_id")
         input_video = task_data["input_path"]
         output_path = task_data["output_path"]["path"]
         form_data = task_data["form_data"]
         user_logo = task_data["user_logo_url"]
         wallet_hash = task_data["wallet_number"]
+        video_probe = task_data.get("video_probe")
+
+        # Проверка актуальности задачи (пользователь мог уже сохранить профиль с другим видео)
+        async def is_cancelled() -> bool:
+            return await is_job_superseded(redis, wallet_hash, job_id)
+
+        async def ensure_not_cancelled(stage: str):
+            if await is_cancelled():
+                raise JobCancelledError(f"Задача {job_id} перекрыта более новой (этап: {stage})")
+
+        await ensure_not_cancelled("очередь")
 
         # 1. Конвертация видео
         logger.info(f"Конвертация видео: {input_video}")
         conversion_result = await convert_to_h264(
             input_path=input_video,
             output_path=output_path,
-            logger=logger
+            logger=logger,
+            probe=video_probe,
+            cancel_check=is_cancelled
         )
         video_file_path = conversion_result["video_path"]
         video_folder = conversion_result["folder_path"]
@@ -56,7 +78,8 @@ async def handle_task(task_data):
         logger.info("Генерация HLS плейлиста")
         hls_result = await create_hls_playlist(
             conversion_result={"converted_path": video_file_path, "video_folder": video_folder},
-            logger=logger
+            logger=logger,
+            cancel_check=is_cancelled
         )
         logger.info(f"HLS создан: {hls_result['master_playlist']}")
 
@@ -71,6 +94,7 @@ async def handle_task(task_data):
         logger.info(f"Постер сохранен: {poster_path}")
 
         # 4. Загрузка в облачное хранилище
+        await ensure_not_cancelled("загрузка в облако")
         logger.info("Загрузка файлов в S3")
         upload_result = await upload_to_s3(
             processing_data={
@@ -82,7 +106,18 @@ async def handle_task(task_data):
         )
         logger.info(f"Файлы загружены: {upload_result['video_url']}")
 
-        # 5. Сохранение данных в БД
+        # 4.1. Перенос постера и логотипа в облако (ключи по хэшу содержимого, раздача мимо приложения)
+        # Локальные копии удаляются только после сохранения ссылок на облако в БД
+        local_media_paths = [poster_path, user_logo]
+        poster_path = await offload_media_file(poster_path, "posters", logger, remove_local=False)
+        user_logo = await offload_media_file(user_logo, "logos", logger, remove_local=False)
+        logger.info(f"Постер: {poster_path}, логотип: {user_logo}")
+
+        # 5. Сохранение данных в БД (если задача успела устареть - загруженную папку сразу удаляем)
+        if await is_cancelled():
+            await delete_video_folder(upload_result["video_url"], logger)
+            raise JobCancelledError(f"Задача {job_id} перекрыта более новой (этап: сохранение в БД)")
+
         logger.info("Сохранение профиля в базе данных")
         async with get_db_session_for_worker() as db_session:
             await save_profile_to_db(
@@ -96,6 +131,18 @@ async def handle_task(task_data):
                 logger=logger
             )
         logger.info("Профиль успешно сохранен")
+        remove_local_media_files(
+            [local_path for local_path, saved_path in zip(local_media_paths, (poster_path, user_logo)) if saved_path != local_path],
+            logger
+        )
+
+    except JobCancelledError as e:
+        # Не ошибка: результат все равно был бы сразу заменен, просто убираем локальные файлы
+        logger.info(f"Задача пропущена: {e}")
+        if video_folder:
+            shutil.rmtree(video_folder, ignore_errors=True)
+        if poster_path and os.path.isfile(poster_path):
+            os.remove(poster_path)
 
     except Exception as e:
         logger.error(f"Ошибка обработки задачи: {str(e)}", exc_info=True)
@@ -160,7 +207,7 @@ async def main():
                     if message:
                         logger.info(f"Получено сообщение от Redis: {message}")
                         task_data = json.loads(message["data"])  # Декодировка данных задачи
-                        await handle_task(task_data)
+                        await handle_task(task_data, redis)
 
                 except Exception as e:
                     current_time = datetime.now()
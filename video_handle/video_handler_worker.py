@@ -1,14 +1,18 @@
 """ Модуль реализации асинхронных функций для обработки видео и сохранения профиля в БД """
 
 import time
+import json
+import asyncio
+import hashlib
+import mimetypes
 import ffmpeg
 from pathlib import Path
 import aiofiles
 import io
-import urllib.parse
 from uuid import uuid4
 from prettyconf import config
 import os
+import shutil
 from dotenv import load_dotenv
 
 from fastapi import HTTPException
@@ -17,15 +21,16 @@ from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import HTTPException
-from aiobotocore.session import get_session
 from geoalchemy2 import Geometry
 from geoalchemy2.shape import to_shape
 from shapely.geometry import Point, MultiPoint
-from typing import Optional
+from typing import Optional, Callable, Awaitable, Iterable
 
 from models import UserProfiles, Hashtag, ProfileHashtag, User
 from schemas import FormData
 from utils import get_file_size, generate_unique_link
+from video_handle.storage_backends import get_storage
+from video_handle.storage_gc import build_gc_prefix, enqueue_storage_gc
 
 
 
@@ -39,7 +44,6 @@ REDIS_HOST = "redis"
 
 PREVIEW_DURATION = 5  # Длительность превью
 
-
 load_dotenv()
 
 # Конфиги для облака
@@ -48,8 +52,158 @@ AWS_REGION = os.getenv("AWS_REGION")
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 
+# Конфиги для раздачи логотипов и постеров из облака (ключи по хэшу содержимого, кэш навсегда)
+MEDIA_OFFLOAD_ENABLED = os.getenv("MEDIA_OFFLOAD_ENABLED", "True").lower() == "true"
+MEDIA_PUBLIC_BASE_URL = os.getenv("MEDIA_PUBLIC_BASE_URL")  # CDN перед хранилищем (без него - публичный URL бэкенда)
+MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+MEDIA_KEY_PREFIX = "media"
+
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", 8))  # Параллельные загрузки файлов папки видео
+
+# Лимиты для входящего видео (проверяются ffprobe сразу после загрузки, до постановки задачи)
+MAX_VIDEO_DURATION_SEK = float(os.getenv("MAX_VIDEO_DURATION_SEK", 180))
+MAX_VIDEO_SIDE_PX = int(os.getenv("MAX_VIDEO_SIDE_PX", 3840))  # Большая сторона кадра (вертикальные видео тоже)
+ALLOWED_VIDEO_CODECS = {
+    codec.strip() for codec in os.getenv(
+        "ALLOWED_VIDEO_CODECS",
+        "h264,hevc,vp8,vp9,av1,mpeg4,mpeg2video,mpeg1video,prores,theora,wmv3,msmpeg4v3"
+    ).split(",") if codec.strip()
+}
+PROBE_TIMEOUT_SEK = float(os.getenv("PROBE_TIMEOUT_SEK", 15))
+PROBE_CONCURRENCY = int(os.getenv("PROBE_CONCURRENCY", 4))  # Сколько ffprobe может работать одновременно
+
+# Ограничитель одновременных ffprobe, чтобы пачка загрузок не съела CPU приложения
+probe_semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+
+
+# Задача перекрыта более новой задачей того же пользователя
+class JobCancelledError(Exception):
+    """Обработка задачи прервана, так как она больше не актуальна"""
+
+
+# Запуск ffmpeg без блокировки цикла событий с возможностью прервать процесс
+async def run_ffmpeg(stream, logger, cancel_check: Optional[Callable[[], Awaitable[bool]]] = None, poll_interval: float = 1.0):
+    """
+    Запускает собранную команду ffmpeg отдельным процессом и ждет завершения.
+    Раз в poll_interval секунд вызывает cancel_check: если он вернул True - процесс убивается.
+
+    :param stream: Собранный ffmpeg-python граф (с output и overwrite_output).
+    :param logger: Логгер для записи событий.
+    :param cancel_check: Корутина-проверка необходимости отмены.
+    :param poll_interval: Интервал проверки (сек.).
+    :raises JobCancelledError: Если задача была отменена.
+    :raises ffmpeg.Error: Если ffmpeg завершился с ошибкой.
+    """
+    process = stream.run_async(pipe_stderr=True)
+    communicate_task = asyncio.create_task(asyncio.to_thread(process.communicate))
+
+    while True:
+        done, _ = await asyncio.wait({communicate_task}, timeout=poll_interval)
+        if done:
+            break
+        if cancel_check and await cancel_check():
+            process.kill()
+            await communicate_task
+            logger.info("Процесс ffmpeg остановлен: задача больше не актуальна")
+            raise JobCancelledError("Задача перекрыта более новой")
+
+    _, stderr = communicate_task.result()
+    if process.returncode != 0:
+        raise ffmpeg.Error("ffmpeg", None, stderr)
+
+
+# Приведение вывода ffprobe к компактному виду (эти данные летят вместе с задачей в воркер)
+def normalize_probe(probe: dict) -> dict:
+    """
+    Оставляет из вывода ffprobe только то, что нужно для проверки лимитов и конвертации.
+
+    :param probe: Сырой JSON от ffprobe (-show_format -show_streams).
+    :return: Нормализованные метаданные видео.
+    """
+    streams = probe.get("streams", [])
+    video_stream = next((s for s in streams if s.get("codec_type") == "video"), None)
+    audio_stream = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    format_info = probe.get("format", {})
+
+    if not video_stream:
+        raise ValueError("В файле нет видеопотока")
+
+    duration = format_info.get("duration") or video_stream.get("duration")
+
+    return {
+        "duration": float(duration) if duration else None,
+        "width": int(video_stream.get("width") or 0),
+        "height": int(video_stream.get("height") or 0),
+        "video_codec": video_stream.get("codec_name"),
+        "audio_codec": audio_stream.get("codec_name") if audio_stream else None,
+        "has_audio": audio_stream is not None,
+        "bit_rate": int(format_info["bit_rate"]) if format_info.get("bit_rate") else None,
+        "size_bytes": int(format_info["size"]) if format_info.get("size") else None,
+        "format_name": format_info.get("format_name"),
+    }
+
+
+# Проверка видео на лимиты по длительности, разрешению и кодеку
+def validate_probe(probe: dict):
+    """Кидает ValueError с причиной, если видео не проходит по лимитам"""
+    if probe["video_codec"] not in ALLOWED_VIDEO_CODECS:
+        raise ValueError(f"Неподдерживаемый видеокодек: {probe['video_codec']}")
+
+    if not probe["width"] or not probe["height"]:
+        raise ValueError("Не удалось определить разрешение видео")
+
+    if max(probe["width"], probe["height"]) > MAX_VIDEO_SIDE_PX:
+        raise ValueError(f"Слишком большое разрешение: {probe['width']}x{probe['height']} (макс. {MAX_VIDEO_SIDE_PX}px по большей стороне)")
+
+    if probe["duration"] is None:
+        raise ValueError("Не удалось определить длительность видео")
 
-async def convert_to_h264(input_path, output_path, logger):
+    if probe["duration"] > MAX_VIDEO_DURATION_SEK:
+        raise ValueError(f"Слишком длинное видео: {probe['duration']:.0f} сек. (макс. {MAX_VIDEO_DURATION_SEK:.0f} сек.)")
+
+
+# Ограниченный по времени и количеству одновременных запусков ffprobe
+async def probe_video(input_path: str, logger) -> dict:
+    """
+    Запускает ffprobe отдельным процессом (не блокируя цикл событий) с таймаутом
+    и возвращает нормализованные метаданные видео.
+
+    :param input_path: Путь к видеофайлу.
+    :param logger: Логгер для записи событий.
+    :return: Нормализованные метаданные (см. normalize_probe).
+    :raises ValueError: Файл не является видео, битый или ffprobe не уложился в таймаут.
+    """
+    start_time = time.time()
+
+    async with probe_semaphore:
+        process = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", input_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=PROBE_TIMEOUT_SEK)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            logger.error(f"ffprobe не уложился в {PROBE_TIMEOUT_SEK} сек.: {input_path}")
+            raise ValueError("Не удалось проверить видео за отведенное время")
+
+    if process.returncode != 0:
+        error_msg = stderr.decode("utf-8", errors="replace").strip()
+        logger.warning(f"ffprobe не смог прочитать файл {input_path}: {error_msg}")
+        raise ValueError("Файл не является корректным видео")
+
+    try:
+        probe = normalize_probe(json.loads(stdout))
+    except (json.JSONDecodeError, TypeError) as e:
+        raise ValueError(f"Некорректный ответ ffprobe: {e}")
+
+    logger.info(f"Видео проверено за {time.time() - start_time:.2f} сек.: {input_path} {probe}")
+    return probe
+
+
+async def convert_to_h264(input_path, output_path, logger, probe: Optional[dict] = None, cancel_check: Optional[Callable[[], Awaitable[bool]]] = None):
     """Конвертация в H.264 с оптимальным балансом качества/размера"""
     start_time = time.time()
     filename = os.path.splitext(os.path.basename(input_path))[0]
@@ -62,10 +216,13 @@ async def convert_to_h264(input_path, output_path, logger):
         input_size = os.path.getsize(input_path) / (1024 * 1024)  # в MB
         logger.info(f"Начало конвертации: {input_path} (размер: {input_size:.2f} MB)")
 
-        # Получаем метаданные для адаптивного сжатия
-        probe = ffmpeg.probe(input_path)
-        video_stream = next((s for s in probe['streams'] if s['codec_type'] == 'video'), None)
-        width = int(video_stream['width']) if video_stream else 1280
+        # Получаем метаданные для адаптивного сжатия (обычно уже пришли с задачей после проверки при загрузке)
+        if probe and probe.get("width"):
+            width = int(probe["width"])
+        else:
+            raw_probe = ffmpeg.probe(input_path)
+            video_stream = next((s for s in raw_probe['streams'] if s['codec_type'] == 'video'), None)
+            width = int(video_stream['width']) if video_stream else 1280
 
         # Адаптивные параметры сжатия
         crf = 22 if width >= 1280 else 24  # Более агрессивное сжатие для HD+
@@ -92,13 +249,14 @@ async def convert_to_h264(input_path, output_path, logger):
                 'preset': 'fast'  # Ускоряем конвертацию
             })
 
-        # Запуск конвертации
-        (
+        # Запуск конвертации (в отдельном процессе, с возможностью отмены перекрытой задачи)
+        await run_ffmpeg(
             ffmpeg
             .input(input_path)
             .output(output_file, **args)
-            .overwrite_output()
-            .run()
+            .overwrite_output(),
+            logger,
+            cancel_check=cancel_check
         )
 
         # Проверка результата
@@ -124,12 +282,16 @@ async def convert_to_h264(input_path, output_path, logger):
         error_msg = e.stderr.decode('utf-8', errors='replace') if e.stderr else str(e)
         logger.error(f"Ошибка конвертации: {error_msg}")
         raise RuntimeError(f"Ошибка конвертации: {error_msg}")
+    except JobCancelledError:
+        # Папка результата еще не передана вызывающему коду - недоделанный файл убираем здесь
+        shutil.rmtree(video_folder, ignore_errors=True)
+        raise
     except Exception as e:
         logger.error(f"Неожиданная ошибка: {str(e)}")
         raise
 
 
-async def create_hls_playlist(conversion_result: dict, logger):
+async def create_hls_playlist(conversion_result: dict, logger, cancel_check: Optional[Callable[[], Awaitable[bool]]] = None):
     """Генерация HLS с согласованными именами файлов"""
     input_video_path = conversion_result["converted_path"]
     video_folder = conversion_result["video_folder"]
@@ -146,7 +308,7 @@ async def create_hls_playlist(conversion_result: dict, logger):
         playlist_path = os.path.join(hls_dir, master_playlist)
 
         # Параметры генерации HLS
-        (
+        await run_ffmpeg(
             ffmpeg
             .input(input_video_path)
             .output(
@@ -161,8 +323,9 @@ async def create_hls_playlist(conversion_result: dict, logger):
                 hls_flags='independent_segments',
                 loglevel='warning'
             )
-            .overwrite_output()
-            .run()
+            .overwrite_output(),
+            logger,
+            cancel_check=cancel_check
         )
 
         # Проверка результатов
@@ -185,6 +348,8 @@ async def create_hls_playlist(conversion_result: dict, logger):
         error_msg = e.stderr.decode('utf-8', errors='replace') if e.stderr else str(e)
         logger.error(f"FFmpeg error: {error_msg}")
         raise HTTPException(status_code=500, detail=f"HLS generation failed: {error_msg}")
+    except JobCancelledError:
+        raise
     except Exception as e:
         logger.error(f"HLS generation error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"HLS processing error: {str(e)}")
@@ -238,25 +403,19 @@ async def extract_frame(video_path, posters_folder="user_video_posters", frame_t
 
 # Проверка соединения с AWS S3 перед загрузкой
 async def check_s3_connection(logger):
-    """ Проверка соединения с AWS S3 перед загрузкой. """
+    """ Проверка соединения с хранилищем (S3 или локальным, см. STORAGE_BACKEND) перед загрузкой. """
+    storage = get_storage()
     try:
-        async with get_session().create_client(
-                "s3",
-                region_name=AWS_REGION,
-                aws_access_key_id=AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-        ) as s3_client:
-            # Проверка подключения, попытка получить список объектов из бакета
-            await s3_client.list_objects_v2(Bucket=S3_BUCKET_NAME)
-            logger.info("Соединение с AWS S3 установлено успешно.")  # Лог об успешном соединении
-            return True  # Возвращаем True, если соединение успешно
+        await storage.check()
+        logger.info(f"Соединение с хранилищем ({storage.name}) установлено успешно.")  # Лог об успешном соединении
+        return True  # Возвращаем True, если соединение успешно
     except Exception as e:
-        logger.error(f"Не удалось установить соединение с AWS S3: {e}")
-        raise RuntimeError(f"Не удалось подключиться к AWS S3: {e}")
+        logger.error(f"Не удалось установить соединение с хранилищем ({storage.name}): {e}")
+        raise RuntimeError(f"Не удалось подключиться к хранилищу: {e}")
 
 
 async def upload_to_s3(processing_data: dict, logger) -> dict:
-    """Рекурсивная загрузка всей папки (видео + HLS) в S3"""
+    """Рекурсивная загрузка всей папки (видео + HLS) в хранилище"""
     if processing_data.get("status") != "success":
         raise ValueError("Нет данных для загрузки")
 
@@ -264,123 +423,177 @@ async def upload_to_s3(processing_data: dict, logger) -> dict:
     folder_name = os.path.basename(video_folder)
 
     try:
+        storage = get_storage()
         await check_s3_connection(logger)
         base_s3_path = f"videos/{folder_name}"
 
-        async with get_session().create_client(
-                "s3",
-                region_name=AWS_REGION,
-                aws_access_key_id=AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-        ) as s3_client:
-            # 1. Загружаем основное видео (не из папки hls)
-            video_files = [f for f in os.listdir(video_folder)
-                           if not f.startswith('.') and f != 'hls']
-
-            if not video_files:
-                raise FileNotFoundError("Основной видеофайл не найден")
-
-            video_file = video_files[0]
-            video_path = os.path.join(video_folder, video_file)
-
-            await s3_client.put_object(
-                Bucket=S3_BUCKET_NAME,
-                Key=f"{base_s3_path}/{video_file}",
-                Body=open(video_path, 'rb')
-            )
+        # 1. Основное видео (не из папки hls)
+        video_files = [f for f in os.listdir(video_folder)
+                       if not f.startswith('.') and f != 'hls']
 
-            # 2. Рекурсивная загрузка папки hls
-            hls_dir = os.path.join(video_folder, "hls")
-            if os.path.exists(hls_dir):
-                for root, _, files in os.walk(hls_dir):
-                    for file in files:
-                        local_path = os.path.join(root, file)
-                        relative_path = os.path.relpath(local_path, video_folder)
-                        s3_key = f"{base_s3_path}/{relative_path.replace(os.sep, '/')}"
-
-                        await s3_client.put_object(
-                            Bucket=S3_BUCKET_NAME,
-                            Key=s3_key,
-                            Body=open(local_path, 'rb')
-                        )
+        if not video_files:
+            raise FileNotFoundError("Основной видеофайл не найден")
 
-            # 3. Формируем URL (используем реальное имя файла из папки hls)
-            hls_files = os.listdir(hls_dir)
-            master_playlist = next((f for f in hls_files if f.endswith('.m3u8')), None)
+        video_file = video_files[0]
+        uploads = [(os.path.join(video_folder, video_file), f"{base_s3_path}/{video_file}")]
 
-            if not master_playlist:
-                raise FileNotFoundError("HLS master playlist not found")
+        # 2. Вся папка hls
+        hls_dir = os.path.join(video_folder, "hls")
+        if os.path.exists(hls_dir):
+            for root, _, files in os.walk(hls_dir):
+                for file in files:
+                    local_path = os.path.join(root, file)
+                    relative_path = os.path.relpath(local_path, video_folder)
+                    uploads.append((local_path, f"{base_s3_path}/{relative_path.replace(os.sep, '/')}"))
 
-            return {
-                "video_url": f"https://{S3_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{base_s3_path}/{video_file}",
-                "preview_url": f"https://{S3_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{base_s3_path}/hls/{master_playlist}"
-            }
+        # Сегменты грузим параллельно (большие файлы бэкенд сам грузит частями)
+        semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+        async def upload_one(local_path: str, key: str):
+            async with semaphore:
+                await storage.put_file(key, local_path)
+
+        await asyncio.gather(*(upload_one(local_path, key) for local_path, key in uploads))
+
+        # 3. Формируем URL (используем реальное имя файла из папки hls)
+        hls_files = os.listdir(hls_dir)
+        master_playlist = next((f for f in hls_files if f.endswith('.m3u8')), None)
+
+        if not master_playlist:
+            raise FileNotFoundError("HLS master playlist not found")
+
+        return {
+            "video_url": storage.public_url(f"{base_s3_path}/{video_file}"),
+            "preview_url": storage.public_url(f"{base_s3_path}/hls/{master_playlist}")
+        }
 
     except Exception as e:
         logger.error(f"Ошибка загрузки: {str(e)}", exc_info=True)
-        raise RuntimeError(f"Ошибка загрузки в S3: {str(e)}")
+        raise RuntimeError(f"Ошибка загрузки в хранилище: {str(e)}")
 
 
-# Логика удаления старых файлов с облака
-async def delete_video_folder(video_url: str, logger) -> bool:
-    """Удаляет все файлы по префиксу, кроме папок с 'mock' в названии"""
+# Путь к локальному медиафайлу (в БД пути лежат без точки в начале: /user_logo/...)
+def resolve_local_media_path(media_path: str) -> Optional[str]:
+    """Возвращает существующий локальный путь к файлу логотипа/постера или None"""
+    if not media_path or media_path.startswith(("http://", "https://")):
+        return None
+
+    for candidate in (media_path, f".{media_path}", media_path.lstrip("/")):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+# Хэш содержимого файла (читаем кусками, чтобы не тащить весь файл в память)
+def hash_media_file(file_path: str) -> str:
+    """Считает sha256 содержимого файла"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as media_file:
+        for chunk in iter(lambda: media_file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Ключ в облаке по хэшу содержимого
+def build_media_key(content_hash: str, file_path: str, kind: str) -> str:
+    """
+    Формирует ключ вида media/{kind}/{ab}/{hash}.{ext}.
+    Содержимое по ключу никогда не меняется, поэтому его можно кэшировать навсегда.
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    return f"{MEDIA_KEY_PREFIX}/{kind}/{content_hash[:2]}/{content_hash}{extension}"
+
+
+# Загрузка логотипа/постера в облако под ключом по хэшу содержимого
+async def upload_media_to_s3(file_path: str, kind: str, logger) -> str:
+    """
+    Загружает логотип или постер в S3 с заголовком Cache-Control: immutable.
+    Если объект с таким хэшем уже есть в бакете - повторно не загружаем.
+
+    :param file_path: Путь к локальному файлу.
+    :param kind: Тип медиа (logos, posters) - часть ключа.
+    :param logger: Логгер для записи событий.
+    :return: Публичный URL файла.
+    """
+    content_hash = await asyncio.to_thread(hash_media_file, file_path)
+    s3_key = build_media_key(content_hash, file_path, kind)
+    content_type = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+    storage = get_storage()
+
     try:
-        parsed = urllib.parse.urlparse(video_url)
-        path_parts = parsed.path.lstrip('/').split('/')
+        if await storage.exists(s3_key):
+            logger.info(f"Медиафайл уже есть в облаке, загрузка пропущена: {s3_key}")
+        else:
+            await storage.put_file(s3_key, file_path, content_type=content_type, cache_control=MEDIA_CACHE_CONTROL)
+            logger.info(f"Медиафайл загружен в облако: {file_path} -> {s3_key}")
 
-        # Проверяем, содержит ли путь слово 'mock'
-        if any('mock' in part.lower() for part in path_parts):
-            logger.info(f"Обнаружена папка 'mock' - удаление пропущено: {video_url}")
-            return False
+        if MEDIA_PUBLIC_BASE_URL:
+            return f"{MEDIA_PUBLIC_BASE_URL}/{s3_key}"
+        return storage.public_url(s3_key)
 
-        prefix = '/'.join(path_parts[:-1]) + '/'
+    except Exception as e:
+        logger.error(f"Ошибка загрузки медиафайла {file_path} в S3: {str(e)}")
+        raise RuntimeError(f"Ошибка загрузки медиафайла в S3: {str(e)}")
 
-        logger.info(f"Начинаем удаление по префиксу: {prefix}")
 
-        async with get_session().create_client(
-                "s3",
-                region_name=AWS_REGION,
-                aws_access_key_id=AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-        ) as s3:
-            # Логируем запрос
-            logger.info(f"Запрашиваем объекты для префикса: {prefix}")
-
-            objects = await s3.list_objects_v2(
-                Bucket=S3_BUCKET_NAME,
-                Prefix=prefix
-            )
+# Перенос логотипа/постера в облако (с откатом на локальный путь, если облако недоступно)
+async def offload_media_file(media_path: Optional[str], kind: str, logger, remove_local: bool = True) -> Optional[str]:
+    """
+    Переносит локальный логотип/постер в облако и возвращает его URL.
+    Если выгрузка выключена, файл уже в облаке или загрузка не удалась - возвращает исходный путь,
+    тогда файл продолжает раздаваться через StaticFiles.
+
+    :param media_path: Локальный путь (или уже URL) к файлу.
+    :param kind: Тип медиа (logos, posters).
+    :param logger: Логгер для записи событий.
+    :param remove_local: Удалить локальную копию после успешной загрузки.
+    :return: URL в облаке или исходный путь.
+    """
+    if not MEDIA_OFFLOAD_ENABLED or not media_path:
+        return media_path
 
-            if not objects.get('Contents'):
-                logger.warning(f"Не найдено объектов для удаления по префиксу: {prefix}")
-                return False
-
-            # Детальный лог объектов
-            file_list = "\n".join([f" - {obj['Key']} ({obj['Size']} bytes)"
-                                   for obj in objects['Contents']])
-            logger.info(f"Найдены объекты для удаления:\n{file_list}")
-
-            # Удаление с подтверждением
-            response = await s3.delete_objects(
-                Bucket=S3_BUCKET_NAME,
-                Delete={
-                    'Objects': [{'Key': obj['Key']} for obj in objects['Contents']],
-                    'Quiet': False  # Получаем подробный ответ
-                }
-            )
+    local_path = resolve_local_media_path(media_path)
+    if not local_path:
+        return media_path
+
+    try:
+        media_url = await upload_media_to_s3(local_path, kind, logger)
+    except Exception as e:
+        logger.error(f"Медиафайл оставлен локально ({media_path}): {e}")
+        return media_path
+
+    if remove_local:
+        remove_local_media_files([media_path], logger)
 
-            # Логируем результат
-            if 'Deleted' in response:
-                deleted_files = "\n".join([f" - {item['Key']}" for item in response['Deleted']])
-                logger.info(f"Успешно удалены:\n{deleted_files}")
+    return media_url
 
-            if 'Errors' in response:
-                errors = "\n".join([f" - {item['Key']}: {item['Message']}"
-                                    for item in response['Errors']])
-                logger.error(f"Ошибки при удалении:\n{errors}")
-                return False
 
-            return True
+# Удаление локальных копий перенесенных в облако файлов (после коммита ссылок на облако в БД)
+def remove_local_media_files(media_paths: Iterable[Optional[str]], logger) -> None:
+    """Удаляет локальные файлы логотипов/постеров; пути, которых уже нет (или URL), пропускаются"""
+    for media_path in media_paths:
+        local_path = resolve_local_media_path(media_path) if media_path else None
+        if not local_path:
+            continue
+        try:
+            os.unlink(local_path)
+        except OSError as e:
+            logger.warning(f"Не удалось удалить локальную копию {local_path}: {e}")
+
+
+# Логика удаления старых файлов с облака (сразу, без очереди - для папок, которые ни на что не ссылаются)
+async def delete_video_folder(video_url: str, logger) -> bool:
+    """Удаляет все файлы по префиксу (постранично, пачками), кроме папок с 'mock' в названии"""
+    try:
+        prefix = build_gc_prefix(video_url)
+        if not prefix:
+            logger.info(f"Обнаружена папка 'mock' или пустой префикс - удаление пропущено: {video_url}")
+            return False
+
+        logger.info(f"Начинаем удаление по префиксу: {prefix}")
+        deleted = await get_storage().delete_prefix(prefix)
+        logger.info(f"Удалено {deleted} объектов по префиксу: {prefix}")
+        return deleted > 0
 
     except Exception as e:
         logger.error(f"КРИТИЧЕСКАЯ ОШИБКА: {str(e)}", exc_info=True)
@@ -405,6 +618,17 @@ async def delete_old_media_files(
         def is_mock_file(path: str) -> bool:
             return path and 'mock' in path.lower()
 
+        # Файлы в облаке лежат по хэшу содержимого и могут быть общими для нескольких профилей - не трогаем
+        def is_cloud_file(path: str) -> bool:
+            return path and path.startswith(("http://", "https://"))
+
+        if is_cloud_file(old_logo_url):
+            logger.info(f"Логотип лежит в облаке, локальное удаление пропущено: {old_logo_url}")
+            old_logo_url = None
+        if is_cloud_file(old_poster_url):
+            logger.info(f"Постер лежит в облаке, локальное удаление пропущено: {old_poster_url}")
+            old_poster_url = None
+
         # Обработка логотипа
         if old_logo_url and not is_mock_file(old_logo_url):
             logo_path = Path(old_logo_url)
@@ -446,18 +670,14 @@ async def save_profile_to_db(session: AsyncSession, form_data: FormData, video_u
             if not user:
                 raise HTTPException(status_code=400, detail="Пользователь с данным кошельком не найден.")
 
-            # 2. Удаление старых файлов из облака (если профиль уже существует)
+            # 2. Старые файлы в облаке ставим в очередь на удаление (в этой же транзакции, сам S3 не трогаем)
             existing_profile_stmt = select(UserProfiles).where(UserProfiles.user_id == user.id)
             existing_profile_result = await session.execute(existing_profile_stmt)
             existing_profile = existing_profile_result.scalars().first()
 
-            if existing_profile and existing_profile.video_url:
-                try:
-                    await delete_video_folder(existing_profile.video_url, logger)
-                    logger.info(f"Старые файлы удалены из облака для {wallet_number}")
-                except Exception as e:
-                    logger.error(f"Ошибка удаления старых файлов: {e}")
-                    # Не прерываем выполнение, если не удалось удалить файлы
+            if existing_profile and existing_profile.video_url and existing_profile.video_url != video_url:
+                await enqueue_storage_gc(session, existing_profile.video_url, logger)
+                logger.info(f"Старые файлы поставлены в очередь на удаление из облака для {wallet_number}")
 
             # 3. Получаем координаты из form_data
             coordinates = form_data.get("coordinates")
@@ -606,6 +826,10 @@ async def save_profile_to_db(session: AsyncSession, form_data: FormData, video_u
         await session.commit()
         logger.info(f"Данные успешно сохранены для кошелька {wallet_number}")
 
+        # Кэш профиля и индексы обновляются сразу, не дожидаясь пересборки
+        from cashe import on_profile_changed  # Локальный импорт: cashe сам импортирует этот модуль
+        await on_profile_changed(profile.id)
+
     except SQLAlchemyError as db_error:
         logger.error(f"Ошибка базы данных: {db_error}")
         await session.rollback()
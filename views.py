@@ -2,8 +2,8 @@ import os
 import shutil
 import aiofiles
 import hashlib
-import random
 from math import ceil # Импортируем ceil для округления вверх
+from datetime import datetime
 from dotenv import load_dotenv
 from uuid import uuid4
 from fastapi import UploadFile, HTTPException, status, Query
@@ -18,14 +18,16 @@ from sqlalchemy.orm import joinedload, subqueryload, selectinload
 from sqlalchemy.future import select
 from sqlalchemy.sql.expression import not_
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import desc, func, bindparam, Integer, update, and_
+from sqlalchemy import desc, func, bindparam, Integer, update, and_, tuple_, literal, case
 import redis.asyncio as redis
 from redis.exceptions import RedisError
 
 from models import UserProfiles, Hashtag, ProfileHashtag, User
 from database import get_db_session_for_worker
 from utils import process_coordinates_for_response, datetime_to_str, get_file_size, calculate_distance, generate_unique_link
-from cashe import get_favorites_from_cache
+from cashe import get_favorites_from_cache, on_profile_changed, hydrate_profiles, lookup_profile_ids
+from cursors import encode_cursor, decode_cursor, get_cached_count, cursor_page_message
+from cache_index import FEED_RECENCY_SCALE_SEK, FEED_WEIGHT_RECENCY, FEED_WEIGHT_POPULARITY, FEED_WEIGHT_MLM, FEED_WEIGHT_VIDEO
 
 from logging_config import get_logger
 
@@ -39,6 +41,9 @@ ROYAL_WALLET = os.getenv("ROYAL_WALLET")
 # Настраиваем соединение с Redis
 redis_client = redis.Redis(host='redis', port=6379, db=0, decode_responses=True)
 
+# Размер куска при сохранении загружаемого видео (1 MB)
+VIDEO_UPLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 async def create_directories(directories_to_create: dict) -> dict:
     """
@@ -119,9 +124,10 @@ async def save_video_to_temp(file: UploadFile, created_dirs: dict):
         # Формирование пути к файлу
         temp_video_path = os.path.join(temp_video_path, f"{uuid4()}_{sanitized_video_filename}")
 
-        # Сохранение видео
+        # Сохранение видео кусками, чтобы не держать весь файл в памяти
         async with aiofiles.open(temp_video_path, "wb") as out_file:
-            await out_file.write(await file.read())
+            while chunk := await file.read(VIDEO_UPLOAD_CHUNK_SIZE):
+                await out_file.write(chunk)
 
         # Получение размера файла
         file_size = os.path.getsize(temp_video_path) / (1024 * 1024)
@@ -171,6 +177,17 @@ async def move_image_to_user_logo(image_path: str, created_dirs: dict) -> str:
         raise HTTPException(status_code=500, detail="Не удалось переместить изображение в директорию user_logo")
 
 
+# Оценка смешанной ленты в SQL - та же формула, что mixed_feed_score в cache_index.py
+def mixed_feed_order_expression():
+    has_video = and_(UserProfiles.video_url.isnot(None), not_(UserProfiles.video_url.ilike("%mock%")))
+    return (
+        FEED_WEIGHT_RECENCY * func.floor(func.extract("epoch", UserProfiles.created_at)) / FEED_RECENCY_SCALE_SEK
+        + FEED_WEIGHT_POPULARITY * func.log(1 + func.greatest(func.coalesce(UserProfiles.followers_count, 0), 0))
+        + FEED_WEIGHT_MLM * case((func.coalesce(UserProfiles.is_in_mlm, 0) != 0, 1), else_=0)
+        + FEED_WEIGHT_VIDEO * case((has_video, 1), else_=0)
+    )
+
+
 # Получение всех профилей по тому же алгоритму или сортировке по новизне/популярности
 async def get_all_profiles(
     page: int,
@@ -178,7 +195,9 @@ async def get_all_profiles(
     per_page: int = 50  # Просто число без Query
 ) -> dict:
     """
-    Получает все профили с пагинацией и сортировкой.
+    Получает все профили с пагинацией и сортировкой (выдача из БД, когда кэш еще не собран).
+    Без сортировки порядок - смешанная лента (новизна, популярность, МЛМ, видео) одним запросом
+    с ORDER BY по оценке, как в feed:mixed.
 
     :param page: Номер страницы (начинается с 1).
     :param sort_by: Параметр сортировки (newest, popularity).
@@ -195,153 +214,91 @@ async def get_all_profiles(
                 per_page = int(per_page)
                 logger.warning(f"per_page приведён к int: {per_page}")
 
-            # Базовый запрос
-            base_query = (
-                select(UserProfiles)
-                .options(
-                    joinedload(UserProfiles.user),
-                    subqueryload(UserProfiles.profile_hashtags).subqueryload(ProfileHashtag.hashtag)
-                )
-            )
-
-            # Применение сортировки
+            # Применение сортировки (id - для однозначного порядка при равных значениях)
             if sort_by == "newest":
-                query = base_query.order_by(desc(UserProfiles.created_at))
-                logger.info(f"Сортировка по новизне, страница {page}")
+                order_by = (desc(UserProfiles.created_at), desc(UserProfiles.id))
             elif sort_by == "popularity":
-                query = base_query.order_by(desc(UserProfiles.followers_count))
-                logger.info(f"Сортировка по популярности, страница {page}")
+                order_by = (desc(func.coalesce(UserProfiles.followers_count, 0)), desc(UserProfiles.id))
             else:
-                logger.info(f"Сортировка не указана, применяем алгоритм, страница {page}")
-
-                # Собираем 10 самых новых
-                newest_profiles = (await session.execute(
-                    base_query.order_by(desc(UserProfiles.created_at)).limit(10)
-                )).scalars().all()
-                logger.info(f"Собрано {len(newest_profiles)} самых новых профилей")
-
-                # Собираем 10 самых популярных
-                popular_profiles = (await session.execute(
-                    base_query.order_by(desc(UserProfiles.followers_count)).limit(10)
-                )).scalars().all()
-                logger.info(f"Собрано {len(popular_profiles)} самых популярных профилей")
-
-                # Собираем 10 профилей, где is_in_mlm != 0
-                mlm_profiles_query = base_query.filter(
-                    and_(
-                        UserProfiles.is_in_mlm != 0,
-                        UserProfiles.is_in_mlm.isnot(None)
-                    )
-                ).limit(10)
-                mlm_profiles = (await session.execute(mlm_profiles_query)).scalars().all()
-                logger.info(f"Собрано {len(mlm_profiles)} профилей с is_in_mlm != 0")
-
-                # Собираем 10 профилей, где video_url не None
-                video_profiles_query = base_query.filter(
-                    UserProfiles.video_url.isnot(None)
-                ).limit(10)
-                video_profiles = (await session.execute(video_profiles_query)).scalars().all()
-                logger.info(f"Собрано {len(video_profiles)} профилей с видео")
-
-                # Собираем 10 случайных профилей
-                random_profiles = (await session.execute(
-                    base_query.order_by(func.random()).limit(10)
-                )).scalars().all()
-                logger.info(f"Собрано {len(random_profiles)} случайных профилей")
-
-                # Объединяем все профили и убираем дубликаты
-                profiles = newest_profiles + popular_profiles + mlm_profiles + video_profiles + random_profiles
-                unique_profiles = list({profile.id: profile for profile in profiles}.values())
-                logger.info(f"Общее количество уникальных профилей после объединения: {len(unique_profiles)}")
-
-                # Добиваем до per_page случайными профилями, если нужно
-                if len(unique_profiles) < per_page:
-                    remaining_profiles_query = base_query.filter(
-                        not_(UserProfiles.id.in_([p.id for p in unique_profiles]))
-                    )
-                    remaining_profiles = (await session.execute(remaining_profiles_query)).scalars().all()
-
-                    if remaining_profiles:
-                        needed = per_page - len(unique_profiles)
-                        unique_profiles.extend(random.sample(remaining_profiles, min(needed, len(remaining_profiles))))
-                        logger.info(f"Добавлено {len(remaining_profiles)} оставшихся профилей для достижения per_page")
-
-                # Получаем все оставшиеся профили, которые не попали в выборку по алгоритму
-                remaining_all_profiles_query = base_query.filter(
-                    not_(UserProfiles.id.in_([p.id for p in unique_profiles]))
-                )
-                remaining_all_profiles = (await session.execute(remaining_all_profiles_query)).scalars().all()
-
-                # Объединяем все профили: сначала те, что по алгоритму, потом оставшиеся
-                all_profiles = unique_profiles + remaining_all_profiles
-                logger.info(f"Общее количество всех профилей после добавления оставшихся: {len(all_profiles)}")
-
-                # Формируем страницы
-                pages = [all_profiles[i:i + per_page] for i in range(0, len(all_profiles), per_page)]
-                total_pages = ceil(len(all_profiles) / per_page)  # Используем ceil для округления вверх
-                logger.info(f"Всего страниц: {total_pages}")
-
-                # Если страница выходит за пределы
-                if page > total_pages:
-                    logger.info(f"Профили просмотрены. Запрошенная страница ({page}) превышает {total_pages}.")
-                    return {
-                        "theme": "Макс, это для тебя корешок ^^",
-                        "page_number": page,
-                        "total_profiles": len(all_profiles),
-                        "total_pages": total_pages,
-                        "message": "Профили просмотрены. Начните с первой страницы.",
-                        "profiles": [],
-                    }
-
-                # Получаем профили для текущей страницы
-                current_page_profiles = pages[page - 1]
-
-                # Проверяем, является ли текущая страница последней и неполной
-                is_last_page = page == total_pages
-                is_incomplete_page = len(current_page_profiles) < per_page
+                order_by = (desc(mixed_feed_order_expression()), desc(UserProfiles.id))
+            logger.info(f"Сортировка {sort_by or 'смешанная лента'}, страница {page}")
 
-                # Формируем сообщение
-                offset = (page - 1) * per_page
-                end_index = offset + len(current_page_profiles)  # Корректный конечный индекс
-                message = f"Показаны профили {offset + 1}-{end_index} из {len(all_profiles)}."
+            # Количество - из кэша, а не COUNT(*) на каждый запрос
+            async def count_profiles() -> int:
+                return (await session.execute(select(func.count(UserProfiles.id)))).scalar() or 0
 
-                if is_last_page and is_incomplete_page:
-                    message += " Это последняя страница. Начните просмотр профилей со страницы номер 1."
-
-                # Формируем ответ
-                profiles_data = [{
-                    "id": profile.id,
-                    "created_at": await datetime_to_str(profile.created_at),
-                    "name": profile.name,
-                    "user_logo_url": profile.user_logo_url,
-                    "video_url": profile.video_url,
-                    "preview_url": profile.preview_url,
-                    "poster_url": profile.poster_url,
-                    "activity_and_hobbies": profile.activity_and_hobbies,
-                    "is_moderated": profile.is_moderated,
-                    "is_incognito": profile.is_incognito,
-                    "is_in_mlm": profile.is_in_mlm,
-                    "adress": profile.adress,
-                    "coordinates": await process_coordinates_for_response(profile.coordinates),
-                    "followers_count": profile.followers_count,
-                    "website_or_social": profile.website_or_social,
-                    "user_link": profile.user_link,
-                    "user": {
-                        "id": profile.user.id,
-                        "wallet_number": profile.user.wallet_number,
-                    },
-                    "hashtags": [ph.hashtag.tag for ph in profile.profile_hashtags if ph.hashtag is not None],
-                } for profile in current_page_profiles]
+            total_profiles = await get_cached_count(redis_client, "profiles:all", count_profiles)
+            total_pages = ceil(total_profiles / per_page)  # Используем ceil для округления вверх
 
+            # Если страница выходит за пределы
+            if page > total_pages:
+                logger.info(f"Профили просмотрены. Запрошенная страница ({page}) превышает {total_pages}.")
                 return {
                     "theme": "Макс, это для тебя корешок ^^",
                     "page_number": page,
-                    "total_profiles": len(all_profiles),
+                    "total_profiles": total_profiles,
                     "total_pages": total_pages,
-                    "message": message,
-                    "profiles": profiles_data,
+                    "message": "Профили просмотрены. Начните с первой страницы.",
+                    "profiles": [],
                 }
 
+            offset = (page - 1) * per_page
+            current_page_profiles = (await session.execute(
+                select(UserProfiles)
+                .options(
+                    joinedload(UserProfiles.user),
+                    subqueryload(UserProfiles.profile_hashtags).subqueryload(ProfileHashtag.hashtag)
+                )
+                .order_by(*order_by)
+                .offset(offset)
+                .limit(per_page)
+            )).scalars().all()
+
+            # Проверяем, является ли текущая страница последней и неполной
+            is_last_page = page == total_pages
+            is_incomplete_page = len(current_page_profiles) < per_page
+
+            # Формируем сообщение
+            end_index = offset + len(current_page_profiles)  # Корректный конечный индекс
+            message = f"Показаны профили {offset + 1}-{end_index} из {total_profiles}."
+
+            if is_last_page and is_incomplete_page:
+                message += " Это последняя страница. Начните просмотр профилей со страницы номер 1."
+
+            # Формируем ответ
+            profiles_data = [{
+                "id": profile.id,
+                "created_at": await datetime_to_str(profile.created_at),
+                "name": profile.name,
+                "user_logo_url": profile.user_logo_url,
+                "video_url": profile.video_url,
+                "preview_url": profile.preview_url,
+                "poster_url": profile.poster_url,
+                "activity_and_hobbies": profile.activity_and_hobbies,
+                "is_moderated": profile.is_moderated,
+                "is_incognito": profile.is_incognito,
+                "is_in_mlm": profile.is_in_mlm,
+                "adress": profile.adress,
+                "coordinates": await process_coordinates_for_response(profile.coordinates),
+                "followers_count": profile.followers_count,
+                "website_or_social": profile.website_or_social,
+                "user_link": profile.user_link,
+                "user": {
+                    "id": profile.user.id,
+                    "wallet_number": profile.user.wallet_number,
+                },
+                "hashtags": [ph.hashtag.tag for ph in profile.profile_hashtags if ph.hashtag is not None],
+            } for profile in current_page_profiles]
+
+            return {
+                "theme": "Макс, это для тебя корешок ^^",
+                "page_number": page,
+                "total_profiles": total_profiles,
+                "total_pages": total_pages,
+                "message": message,
+                "profiles": profiles_data,
+            }
+
     except SQLAlchemyError as e:
         logger.error(f"Ошибка запроса к базе: {e}")
         raise HTTPException(status_code=500, detail="Ошибка базы данных, попробуйте позже.")
@@ -352,8 +309,12 @@ async def get_all_profiles(
 
 
 # Получить список юзеров по городу (поисковой запрос - показать юзеров в городе) с возможностью сортировки по новизне и популярности
-async def get_profiles_by_city(city: str, page: int, sort_by: str, per_page: int):
-    """ Логика для получения профилей пользователей по городу """
+async def get_profiles_by_city(city: str, page: int, sort_by: str, per_page: int, cursor: Optional[str] = None):
+    """
+    Логика для получения профилей пользователей по городу.
+    Следующая страница выбирается по курсору (next_cursor из прошлого ответа) условием по индексу,
+    без OFFSET; page без курсора оставлен для старых клиентов.
+    """
     try:
         async with get_db_session_for_worker() as session:  # Управление сессии внутри функции
             # Базовый запрос: исключаем приватные профили
@@ -364,15 +325,32 @@ async def get_profiles_by_city(city: str, page: int, sort_by: str, per_page: int
 
             logger.info(f"Запрос профилей для города: {city}, страница: {page}, сортировка: {sort_by}, профилей на странице: {per_page}")
 
-            # Если указана сортировка
+            # Сортировка всегда с id в конце ключа, чтобы порядок был однозначным и курсор точным
+            cursor_kind = f"city:{sort_by or 'id'}"
             if sort_by == "newest":
-                query = query.order_by(desc(UserProfiles.created_at))
+                sort_column = UserProfiles.created_at
             elif sort_by == "popularity":
-                query = query.order_by(desc(UserProfiles.followers_count))
+                sort_column = func.coalesce(UserProfiles.followers_count, 0)
+            else:
+                sort_column = None
 
-            # Пагинация с учетом параметра per_page
-            offset = (page - 1) * per_page
-            query = query.offset(offset).limit(per_page)
+            if sort_column is not None:
+                query = query.order_by(desc(sort_column), desc(UserProfiles.id))
+            else:
+                query = query.order_by(desc(UserProfiles.id))
+
+            # Пагинация: курсор - условие по ключу последнего профиля прошлой страницы
+            if cursor:
+                if sort_column is not None:
+                    value_type = datetime.fromisoformat if sort_by == "newest" else int
+                    last_value, last_id = decode_cursor(cursor, cursor_kind, value_type, int)
+                    query = query.filter(tuple_(sort_column, UserProfiles.id) < tuple_(literal(last_value), literal(last_id)))
+                else:
+                    (last_id,) = decode_cursor(cursor, cursor_kind, int)
+                    query = query.filter(UserProfiles.id < last_id)
+            else:
+                query = query.offset((page - 1) * per_page)
+            query = query.limit(per_page)
 
             # Жадная загрузка через selectinload
             query = query.options(
@@ -384,19 +362,35 @@ async def get_profiles_by_city(city: str, page: int, sort_by: str, per_page: int
             result = await session.execute(query)
             profiles = result.unique().scalars().all()
 
-            # Получаем общее количество профилей
-            total_query = select(func.count()).select_from(UserProfiles).filter(
-                UserProfiles.city == city,
-                UserProfiles.is_incognito == False,  # Исключаем приватные профили
-            )
-            total_result = await session.execute(total_query)
-            total = total_result.scalar()
+            # Общее количество профилей - из кэша
+            async def count_city_profiles() -> int:
+                total_query = select(func.count()).select_from(UserProfiles).filter(
+                    UserProfiles.city == city,
+                    UserProfiles.is_incognito == False,  # Исключаем приватные профили
+                )
+                return (await session.execute(total_query)).scalar()
+
+            # Ключ - точное значение фильтра: город сравнивается в запросе без нормализации
+            total = await get_cached_count(redis_client, f"city:{city}", count_city_profiles)
+
+            # Курсор следующей страницы (ключ последнего профиля)
+            next_cursor = None
+            if len(profiles) == per_page:
+                last_profile = profiles[-1]
+                if sort_by == "newest":
+                    next_cursor = encode_cursor(cursor_kind, last_profile.created_at.isoformat(), last_profile.id)
+                elif sort_by == "popularity":
+                    next_cursor = encode_cursor(cursor_kind, last_profile.followers_count or 0, last_profile.id)
+                else:
+                    next_cursor = encode_cursor(cursor_kind, last_profile.id)
 
             # Рассчитываем общее количество страниц
             total_pages = (total + per_page - 1) // per_page
 
-            # Формируем сообщение о пагинации
-            if total == 0:
+            # Формируем сообщение о пагинации (по курсору номер страницы неизвестен)
+            if cursor:
+                message = cursor_page_message(len(profiles), total, next_cursor)
+            elif total == 0:
                 message = "Нет профилей для отображения."
             else:
                 start_index = (page - 1) * per_page + 1
@@ -406,12 +400,12 @@ async def get_profiles_by_city(city: str, page: int, sort_by: str, per_page: int
                 else:
                     message = f"Показаны профили {start_index}-{end_index} из {total}."
 
-            # Проверяем, является ли текущая страница последней и неполной
-            is_last_page = page == total_pages
-            is_incomplete_page = len(profiles) < per_page
+                # Проверяем, является ли текущая страница последней и неполной
+                is_last_page = page == total_pages
+                is_incomplete_page = len(profiles) < per_page
 
-            if is_last_page and is_incomplete_page:
-                message += " Это последняя страница. Начните просмотр профилей со страницы номер 1."
+                if is_last_page and is_incomplete_page:
+                    message += " Это последняя страница. Начните просмотр профилей со страницы номер 1."
 
             # Обработка профилей
             profiles_data = []
@@ -448,13 +442,16 @@ async def get_profiles_by_city(city: str, page: int, sort_by: str, per_page: int
             logger.info(f"Получено {len(profiles_data)} профилей для страницы {page}")
             return {
                 "theme": "Макс, это для тебя корешок ^^",  # Добавляем тему
-                "page_number": page,  # Номер текущей страницы
+                "page_number": None if cursor else page,  # Номер текущей страницы (по курсору неизвестен)
                 "total_profiles": total,  # Общее количество профилей
                 "total_pages": total_pages,  # Общее количество страниц
                 "message": message,  # Сообщение о пагинации
                 "profiles": profiles_data,  # Список профилей
+                "next_cursor": next_cursor,  # Курсор следующей страницы (None - страниц больше нет)
             }
 
+    except HTTPException:
+        raise
     except SQLAlchemyError as e:
         logger.error(f"Ошибка выполнения запроса к базе данных: {e}")
         raise Exception("Ошибка базы данных, попробуйте позже.") from e
@@ -464,63 +461,46 @@ async def get_profiles_by_city(city: str, page: int, sort_by: str, per_page: int
         raise Exception("Произошла ошибка, попробуйте позже.") from e
 
 
+# Профиль из кэша в формате ответов поиска: все точки координат [долгота, широта], адрес - как раньше
+def lookup_profile_response(profile_data: dict, wrap_adress: bool) -> dict:
+    response = {key: value for key, value in profile_data.items() if key != "points"}  # Копия: кэш не изменяем
+    coordinates = profile_data.get("coordinates")
+    response["coordinates"] = profile_data.get("points") or (
+        [[coordinates["longitude"], coordinates["latitude"]]] if coordinates else None
+    )
+    if wrap_adress:
+        response["adress"] = [profile_data["adress"]] if profile_data.get("adress") else []
+    return response
+
+
 # Получение пользователя по номеру кошелька
 async def get_profile_by_wallet_number(wallet_number: str):
     """
     Логика получения профиля пользователя по номеру кошелька (асинхронно).
+    Кошелек -> ID профиля берется из кэша поиска, сам профиль - из кэша профилей (БД - только при промахе).
 
     :param wallet_number: Номер кошелька для поиска.
     :return: Словарь с информацией о профиле.
     :raises HTTPException: Если профиль не найден или произошла ошибка.
     """
     try:
-        async with get_db_session_for_worker() as db:  # Открываем сессию внутри функции
-            # Поиск пользователя по номеру кошелька
-            query = select(User).filter(User.wallet_number == wallet_number).options(
-                selectinload(User.profile).selectinload(UserProfiles.profile_hashtags).selectinload(ProfileHashtag.hashtag)
-            )
-            result = await db.execute(query)
-            user = result.scalar_one_or_none()
+        async def load_profile_ids() -> List[int]:
+            async with get_db_session_for_worker() as db:
+                result = await db.execute(
+                    select(UserProfiles.id)
+                    .join(User, UserProfiles.user_id == User.id)
+                    .where(User.wallet_number == wallet_number, User.is_profile_created.is_(True))
+                )
+                return list(result.scalars().all())
 
-            if not user:
-                logger.error(f"Пользователь с номером кошелька {wallet_number} не найден.")
-                raise HTTPException(status_code=404, detail="Пользователь с таким номером кошелька не найден.")
+        profiles = await hydrate_profiles(await lookup_profile_ids("wallet", wallet_number, load_profile_ids))
 
-            if not user.is_profile_created or not user.profile:
-                logger.error(f"Профиль пользователя с номером кошелька {wallet_number} не найден.")
-                raise HTTPException(status_code=404, detail="Профиль пользователя не найден.")
+        if not profiles:
+            logger.error(f"Профиль пользователя с номером кошелька {wallet_number} не найден.")
+            raise HTTPException(status_code=404, detail="Профиль пользователя с таким номером кошелька не найден.")
 
-            # Формирование данных профиля для ответа
-            profile = user.profile
-            profile_data = {
-                "id": profile.id,
-                "name": profile.name,
-                "user_logo_url": profile.user_logo_url,
-                "video_url": profile.video_url,
-                "preview_url": profile.preview_url,
-                "poster_url": profile.poster_url,
-                "activity_and_hobbies": profile.activity_and_hobbies,
-                "is_moderated": profile.is_moderated,
-                "is_incognito": profile.is_incognito,
-                "is_in_mlm": profile.is_in_mlm,
-                "adress": [profile.adress] if profile.adress else [],  # Преобразуем в список
-                "city": profile.city,
-                "coordinates": await process_coordinates_for_response(profile.coordinates),
-                "followers_count": profile.followers_count,
-                "created_at": await datetime_to_str(profile.created_at),
-                "hashtags": [ph.hashtag.tag for ph in profile.profile_hashtags],
-                "website_or_social": profile.website_or_social,
-                "is_admin": profile.is_admin,
-                "language": profile.language,
-                "user_link": profile.user_link,
-                "user": {
-                    "id": user.id,
-                    "wallet_number": user.wallet_number
-                }
-            }
-
-            logger.info(f"Профиль пользователя с номером кошелька {wallet_number} успешно найден.")
-            return profile_data
+        logger.info(f"Профиль пользователя с номером кошелька {wallet_number} успешно найден.")
+        return lookup_profile_response(profiles[0], wrap_adress=True)
 
     except HTTPException as e:
         raise e
@@ -533,61 +513,31 @@ async def get_profile_by_wallet_number(wallet_number: str):
 async def get_profile_by_username(username: str) -> List[dict]:
     """
     Логика получения профилей пользователя по имени (асинхронно).
-    Поиск осуществляется по полному совпадению имени, но регистронезависимо.
+    Поиск осуществляется по полному совпадению имени, но регистронезависимо
+    (индекс ix_user_profiles_name_lower, результат - в кэше поиска).
 
     :param username: Имя пользователя для поиска (полное совпадение, регистронезависимо).
     :return: Список словарей с информацией о профилях.
     :raises HTTPException: Если произошла ошибка.
     """
     try:
-        async with get_db_session_for_worker() as db:
-            # Поиск профилей с загрузкой связанных данных
-            query = select(UserProfiles).filter(
-                func.lower(UserProfiles.name) == func.lower(username)
-            ).options(
-                selectinload(UserProfiles.profile_hashtags).selectinload(ProfileHashtag.hashtag),
-                selectinload(UserProfiles.user)
-            )
-            result = await db.execute(query)
-            profiles = result.scalars().all()
+        async def load_profile_ids() -> List[int]:
+            async with get_db_session_for_worker() as db:
+                result = await db.execute(
+                    select(UserProfiles.id)
+                    .where(func.lower(UserProfiles.name) == func.lower(username))
+                    .order_by(UserProfiles.id)
+                )
+                return list(result.scalars().all())
 
-            if not profiles:
-                logger.error(f"Профили с именем '{username}' не найдены.")
-                raise HTTPException(status_code=404, detail="Профили с таким именем не найдены.")
+        profiles = await hydrate_profiles(await lookup_profile_ids("name", username, load_profile_ids))
 
-            # Формирование данных профилей
-            profiles_data = []
-            for profile in profiles:
-                profile_data = {
-                    "id": profile.id,
-                    "name": profile.name,
-                    "user_logo_url": profile.user_logo_url,
-                    "video_url": profile.video_url,
-                    "preview_url": profile.preview_url,
-                    "poster_url": profile.poster_url,
-                    "activity_and_hobbies": profile.activity_and_hobbies,
-                    "is_moderated": profile.is_moderated,
-                    "is_incognito": profile.is_incognito,
-                    "is_in_mlm": profile.is_in_mlm,
-                    "adress": [profile.adress] if profile.adress else [],  # Преобразуем в список
-                    "city": profile.city,
-                    "coordinates": await process_coordinates_for_response(profile.coordinates),
-                    "followers_count": profile.followers_count,
-                    "created_at": await datetime_to_str(profile.created_at),
-                    "hashtags": [ph.hashtag.tag for ph in profile.profile_hashtags],
-                    "website_or_social": profile.website_or_social,
-                    "is_admin": profile.is_admin,
-                    "language": profile.language,
-                    "user_link": profile.user_link,
-                    "user": {
-                        "id": profile.user.id,
-                        "wallet_number": profile.user.wallet_number
-                    }
-                }
-                profiles_data.append(profile_data)
+        if not profiles:
+            logger.error(f"Профили с именем '{username}' не найдены.")
+            raise HTTPException(status_code=404, detail="Профили с таким именем не найдены.")
 
-            logger.info(f"Найдено {len(profiles)} профилей с именем '{username}'.")
-            return profiles_data
+        logger.info(f"Найдено {len(profiles)} профилей с именем '{username}'.")
+        return [lookup_profile_response(profile, wrap_adress=True) for profile in profiles]
 
     except HTTPException as e:
         raise e
@@ -709,7 +659,8 @@ async def fetch_nearby_profiles(longitude: float, latitude: float, radius: int =
 async def get_profiles_for_moderation(
     user_id: int,  # ID пользователя из токена
     page: int = 1,
-    per_page: int = 50
+    per_page: int = 50,
+    cursor: Optional[str] = None  # Курсор следующей страницы из прошлого ответа
 ) -> dict:
     """
     Получает профили для модерации, если запрос пришел от администратора.
@@ -718,9 +669,10 @@ async def get_profiles_for_moderation(
         user_id (int): ID пользователя, который запрашивает профили.
         page (int): Номер страницы (начинается с 1).
         per_page (int): Количество профилей на страницу (50–100).
+        cursor (str): Курсор следующей страницы (очередь идет по id, без OFFSET).
 
     Возвращает:
-        dict: Словарь с данными о профилях, включая пагинацию и общее количество.
+        dict: Словарь с данными о профилях, включая пагинацию, общее количество и next_cursor.
 
     Исключения:
         HTTPException: Если запрос не от администратора или произошла ошибка.
@@ -753,12 +705,19 @@ async def get_profiles_for_moderation(
             if per_page < 50 or per_page > 100:
                 raise HTTPException(status_code=400, detail="Параметр per_page должен быть в диапазоне 50–100.")
 
-            offset = (page - 1) * per_page
-            query = query.offset(offset).limit(per_page)
+            # Очередь модерации идет по id: курсор - id последнего профиля прошлой страницы
+            query = query.order_by(UserProfiles.id)
+            if cursor:
+                (last_id,) = decode_cursor(cursor, "moderation", int)
+                query = query.filter(UserProfiles.id > last_id)
+            else:
+                query = query.offset((page - 1) * per_page)
+            query = query.limit(per_page)
 
             # Выполняем запрос
             result = await session.execute(query)
             profiles = result.scalars().all()
+            next_cursor = encode_cursor("moderation", profiles[-1].id) if len(profiles) == per_page else None
 
             # Формируем данные для ответа
             profiles_data = []
@@ -789,17 +748,21 @@ async def get_profiles_for_moderation(
                 }
                 profiles_data.append(profile_data)
 
-            # Получаем общее количество профилей на модерацию
-            total_query = select(func.count()).filter(UserProfiles.is_moderated == False)
-            total_result = await session.execute(total_query)
-            total_profiles = total_result.scalar()
+            # Общее количество профилей на модерацию - из кэша
+            async def count_unmoderated_profiles() -> int:
+                total_query = select(func.count()).filter(UserProfiles.is_moderated == False)
+                return (await session.execute(total_query)).scalar()
+
+            total_profiles = await get_cached_count(redis_client, "moderation", count_unmoderated_profiles)
 
             # Рассчитываем общее количество страниц
             total_pages = (total_profiles + per_page - 1) // per_page
 
-            # Формируем сообщение о пагинации
+            # Формируем сообщение о пагинации (по курсору номер страницы неизвестен)
             if total_profiles == 0:
                 message = "Нет профилей для модерации."
+            elif cursor:
+                message = cursor_page_message(len(profiles), total_profiles, next_cursor)
             else:
                 start_index = (page - 1) * per_page + 1
                 end_index = min(page * per_page, total_profiles)
@@ -808,21 +771,22 @@ async def get_profiles_for_moderation(
                 else:
                     message = f"Показаны профили {start_index}-{end_index} из {total_profiles}."
 
-            # Проверяем, является ли текущая страница последней и неполной
-            is_last_page = page == total_pages
-            is_incomplete_page = len(profiles) < per_page
+                # Проверяем, является ли текущая страница последней и неполной
+                is_last_page = page == total_pages
+                is_incomplete_page = len(profiles) < per_page
 
-            if is_last_page and is_incomplete_page:
-                message += " Это последняя страница. Начните просмотр профилей со страницы номер 1."
+                if is_last_page and is_incomplete_page:
+                    message += " Это последняя страница. Начните просмотр профилей со страницы номер 1."
 
             logger.info(f"Получено {len(profiles)} профилей для модерации, страница {page}")
             return {
                 "theme": "Макс, это для тебя корешок ^^",  # Добавляем тему
-                "page_number": page,  # Номер текущей страницы
+                "page_number": None if cursor else page,  # Номер текущей страницы (по курсору неизвестен)
                 "total_profiles": total_profiles,  # Общее количество профилей
                 "total_pages": total_pages,  # Общее количество страниц
                 "message": message,  # Сообщение о пагинации
                 "profiles": profiles_data,  # Список профилей
+                "next_cursor": next_cursor,  # Курсор следующей страницы (None - страниц больше нет)
             }
 
     except HTTPException as e:
@@ -897,6 +861,7 @@ async def grant_admin_rights(user_id: int, target_wallet: str) -> bool:
 
             await db.execute(stmt)
             await db.commit()
+            await on_profile_changed(user_profile.id)
 
             logger.info(f"Права администратора успешно выданы для кошелька: {target_wallet}")
             return True
@@ -972,6 +937,7 @@ async def moderate_profile(
 
             await session.execute(stmt)
             await session.commit()
+            await on_profile_changed(profile_id)
 
             logger.info(f"Профиль с ID {profile_id} был обновлен: {message}")
             return {"message": message}
@@ -1021,6 +987,7 @@ async def regenerate_user_link(profile_id: int):
             profile.user_link = new_user_link
             session.add(profile)
             await session.commit()
+            await on_profile_changed(profile.id)
 
             # 5. Формируем данные профиля для ответа (как в /api/user/login)
             coordinates = await process_coordinates_for_response(profile.coordinates) if profile.coordinates else None
@@ -1081,82 +1048,53 @@ async def regenerate_user_link(profile_id: int):
 # Логика получения профиля по ссылке
 async def get_profile_by_link(user_link: str):
     """
-    Получает полные данные профиля по уникальной ссылке
+    Получает полные данные профиля по уникальной ссылке (публичная ссылка - из кэша, без запроса к БД)
 
     :param user_link: Уникальная ссылка профиля
     :return: Данные профиля в том же формате, что и regenerate_user_link
     """
-    async with get_db_session_for_worker() as session:
-        try:
-            # 1. Получаем профиль из БД с загрузкой хэштегов
-            stmt = select(UserProfiles).where(
-                UserProfiles.user_link == user_link
-            ).options(
-                selectinload(UserProfiles.profile_hashtags).selectinload(ProfileHashtag.hashtag),
-                selectinload(UserProfiles.user)
-            )
-            result = await session.execute(stmt)
-            profile = result.scalars().first()
-
-            if not profile:
-                raise HTTPException(status_code=404, detail="Профиль по данной ссылке не найден")
-
-            # 2. Получаем связанного пользователя
-            user = profile.user
-            if not user:
-                raise HTTPException(status_code=404, detail="Пользователь не найден")
-
-            # 3. Формируем данные профиля для ответа
-            coordinates = await process_coordinates_for_response(profile.coordinates) if profile.coordinates else None
-            created_at_str = await datetime_to_str(profile.created_at) if profile.created_at else None
-
-            profile_data = {
-                "id": profile.id,
-                "name": profile.name,
-                "user_logo_url": profile.user_logo_url,
-                "video_url": profile.video_url,
-                "preview_url": profile.preview_url,
-                "poster_url": profile.poster_url,
-                "activity_and_hobbies": profile.activity_and_hobbies,
-                "is_moderated": profile.is_moderated,
-                "is_incognito": profile.is_incognito,
-                "is_in_mlm": profile.is_in_mlm,
-                "adress": profile.adress,
-                "city": profile.city,
-                "coordinates": coordinates,
-                "followers_count": profile.followers_count,
-                "created_at": created_at_str,
-                "hashtags": [ph.hashtag.tag for ph in profile.profile_hashtags],
-                "website_or_social": profile.website_or_social,
-                "is_admin": profile.is_admin,
-                "language": profile.language,
-                "user_link": profile.user_link
-            }
-
-            # 4. Получаем избранное (для текущего пользователя, если авторизован)
-            favorites = []
-            if user:
-                favorites = await get_favorites_from_cache(user.id)
-                logger.info(f"Получено избранное для пользователя {user.id}")
-
-            # 5. Формируем итоговый ответ
-            response_data = {
-                "id": user.id,
-                "profile": profile_data,
-                "favorites": favorites
-            }
-
-            return response_data
-
-        except SQLAlchemyError as e:
-            logger.error(f"Ошибка базы данных: {str(e)}")
-            raise HTTPException(
-                status_code=500,
-                detail="Ошибка работы с базой данных"
-            )
-        except Exception as e:
-            logger.error(f"Непредвиденная ошибка: {str(e)}")
-            raise HTTPException(
-                status_code=500,
-                detail="Ошибка при обработке запроса"
-            )
\ No newline at end of file
+    try:
+        async def load_profile_ids() -> List[int]:
+            async with get_db_session_for_worker() as session:
+                result = await session.execute(select(UserProfiles.id).where(UserProfiles.user_link == user_link))
+                return list(result.scalars().all())
+
+        # 1. Ссылка -> ID профиля, сам профиль - из кэша профилей
+        profiles = await hydrate_profiles(await lookup_profile_ids("link", user_link, load_profile_ids))
+        if not profiles:
+            raise HTTPException(status_code=404, detail="Профиль по данной ссылке не найден")
+
+        # 2. Связанный пользователь
+        user_id = (profiles[0].get("user") or {}).get("id")
+        if not user_id:
+            raise HTTPException(status_code=404, detail="Пользователь не найден")
+
+        # 3. Данные профиля для ответа
+        profile_data = lookup_profile_response(profiles[0], wrap_adress=False)
+        profile_data.pop("user", None)
+
+        # 4. Получаем избранное
+        favorites = await get_favorites_from_cache(user_id)
+        logger.info(f"Получено избранное для пользователя {user_id}")
+
+        # 5. Формируем итоговый ответ
+        return {
+            "id": user_id,
+            "profile": profile_data,
+            "favorites": favorites
+        }
+
+    except HTTPException:
+        raise
+    except SQLAlchemyError as e:
+        logger.error(f"Ошибка базы данных: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail="Ошибка работы с базой данных"
+        )
+    except Exception as e:
+        logger.error(f"Непредвиденная ошибка: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail="Ошибка при обработке запроса"
+        )